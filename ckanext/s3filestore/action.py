@@ -0,0 +1,472 @@
+'''
+API actions working on the resource files stored on S3.
+
+A client can upload files straight to S3: it first calls
+`s3filestore_upload_init` to get a presigned POST (or a set of presigned
+multipart part urls), sends the file to S3 and then calls
+`s3filestore_upload_finalize` so the resource points to the uploaded file.
+The file never goes through the CKAN workers.
+
+Resources and datasets can be cloned, and resource files renamed, with
+server side copies.
+'''
+import os
+import math
+import datetime
+import logging
+
+import botocore
+import ckantoolkit as toolkit
+
+import ckan.model as model
+import ckan.lib.munge as munge
+
+from ckanext.s3filestore import db, retry, settings
+from ckanext.s3filestore.uploader import S3ResourceUploader, MB
+
+log = logging.getLogger(__name__)
+
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+
+def _get_resource_uploader(data_dict):
+    resource_id = toolkit.get_or_bust(data_dict, 'id')
+    resource = model.Resource.get(resource_id)
+    if not resource or resource.state == 'deleted':
+        raise toolkit.ObjectNotFound(toolkit._('Resource not found'))
+    return resource, S3ResourceUploader({'id': resource.id})
+
+
+def _clear_old_key(context, upload, filepath):
+    '''Remove the previous file of a resource once it has been updated.
+
+    The resource already points to its new file, so a failed delete is only
+    logged, and the file is reported by `paster s3 scan`.
+    '''
+    try:
+        upload.clear_key(filepath)
+    except (botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError,
+            retry.CircuitOpenError):
+        return
+    # With deferred deletes the key is queued after the update committed
+    if not context.get('defer_commit'):
+        model.repo.commit()
+
+
+def _get_filename(data_dict):
+    filename = munge.munge_filename(toolkit.get_or_bust(data_dict,
+                                                        'filename'))
+    if not filename:
+        raise toolkit.ValidationError({'filename': ['Missing value']})
+    return filename
+
+
+def _get_max_size():
+    return settings.get().max_resource_size * MB
+
+
+def _get_expiry():
+    return settings.get().direct_upload_expiry
+
+
+def s3filestore_upload_init(context, data_dict):
+    '''Start a direct upload of a resource file to S3.
+
+    :param id: the id of the resource the file belongs to
+    :type id: string
+    :param filename: the name of the file being uploaded
+    :type filename: string
+    :param content_type: the mimetype of the file (optional)
+    :type content_type: string
+    :param size: the size of the file in bytes (optional). Files larger than
+        `ckanext.s3filestore.multipart_threshold` are uploaded in parts.
+    :type size: int
+    :param parts: the number of parts to upload the file in (optional),
+        forces a multipart upload. All parts but the last must be at least
+        5MB.
+    :type parts: int
+
+    For single uploads returns a dict with `method` set to `post`, and the
+    `url` and form `fields` to POST the file to. For multipart uploads
+    `method` is `multipart` and the dict contains the `upload_id`, the
+    `part_size` and a list of `parts`, each with a `part_number` and the
+    `url` to PUT that part to. Both contain the `key` and `filename` the
+    file will be stored as.
+    '''
+    toolkit.check_access('s3filestore_upload_init', context, data_dict)
+    resource, upload = _get_resource_uploader(data_dict)
+    filename = _get_filename(data_dict)
+    key = upload.get_path(resource.id, filename)
+    content_type = data_dict.get('content_type')
+    max_size = _get_max_size()
+
+    try:
+        size = toolkit.asint(data_dict.get('size') or 0)
+        parts = toolkit.asint(data_dict.get('parts') or 0)
+    except ValueError:
+        raise toolkit.ValidationError(
+            {'size': ['size and parts must be integers']})
+    if size > max_size:
+        raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+    upload.check_bucket()
+    client = upload.get_s3_client()
+    transfer_config = upload.get_transfer_config()
+    part_size = None
+    if not parts and size > transfer_config.multipart_threshold:
+        part_size = max(transfer_config.multipart_chunksize, MIN_PART_SIZE)
+        parts = int(math.ceil(size / float(part_size)))
+        while parts > MAX_PARTS:
+            part_size *= 2
+            parts = int(math.ceil(size / float(part_size)))
+    elif parts and size:
+        part_size = int(math.ceil(size / float(parts)))
+        # S3 only accepts a smaller part as the last one
+        if parts > 1 and part_size < MIN_PART_SIZE:
+            raise toolkit.ValidationError(
+                {'parts': ['Parts must be at least {0} bytes, use at most '
+                           '{1} parts'.format(
+                               MIN_PART_SIZE,
+                               max(1, size // MIN_PART_SIZE))]})
+
+    if parts > MAX_PARTS:
+        raise toolkit.ValidationError(
+            {'parts': ['At most {0} parts are allowed'.format(MAX_PARTS)]})
+
+    # The key may be queued for deletion, e.g. after a rejected upload
+    upload.dequeue_delete(key)
+    if not context.get('defer_commit'):
+        model.repo.commit()
+
+    acl = 'public-read' if upload.is_public(resource.id) else 'private'
+    if parts <= 1:
+        fields = {'acl': acl}
+        conditions = [{'acl': acl},
+                      ['content-length-range', 0, max_size]]
+        if content_type:
+            fields['Content-Type'] = content_type
+            conditions.append({'Content-Type': content_type})
+        post = client.generate_presigned_post(
+            Bucket=upload.bucket_name, Key=key, Fields=fields,
+            Conditions=conditions, ExpiresIn=_get_expiry())
+        return {
+            'method': 'post',
+            'key': key,
+            'filename': filename,
+            'url': post['url'],
+            'fields': post['fields'],
+        }
+
+    create_args = {'Bucket': upload.bucket_name, 'Key': key, 'ACL': acl}
+    if content_type:
+        create_args['ContentType'] = content_type
+    upload_id = client.create_multipart_upload(**create_args)['UploadId']
+    return {
+        'method': 'multipart',
+        'key': key,
+        'filename': filename,
+        'upload_id': upload_id,
+        'part_size': part_size,
+        'parts': [{
+            'part_number': part_number,
+            'url': client.generate_presigned_url(
+                ClientMethod='upload_part',
+                Params={'Bucket': upload.bucket_name, 'Key': key,
+                        'UploadId': upload_id, 'PartNumber': part_number},
+                ExpiresIn=_get_expiry()),
+        } for part_number in range(1, parts + 1)],
+    }
+
+
+def s3filestore_upload_finalize(context, data_dict):
+    '''Point a resource to a file uploaded with `s3filestore_upload_init`.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the filename used when starting the upload
+    :type filename: string
+    :param upload_id: the id of the multipart upload, if any
+    :type upload_id: string
+    :param parts: the uploaded parts for multipart uploads, a list of dicts
+        with the `part_number` and the `etag` returned by S3 for each part.
+    :type parts: list
+
+    Returns the updated resource.
+    '''
+    toolkit.check_access('s3filestore_upload_finalize', context, data_dict)
+    resource, upload = _get_resource_uploader(data_dict)
+    filename = _get_filename(data_dict)
+    key = upload.get_path(resource.id, filename)
+    client = upload.get_s3_client()
+
+    upload_id = data_dict.get('upload_id')
+    if upload_id:
+        try:
+            parts = sorted(
+                ({'PartNumber': toolkit.asint(part['part_number']),
+                  'ETag': part['etag']}
+                 for part in data_dict.get('parts') or []),
+                key=lambda part: part['PartNumber'])
+        except (KeyError, TypeError, ValueError):
+            raise toolkit.ValidationError(
+                {'parts': ['Each part needs a part_number and an etag']})
+        if not parts:
+            raise toolkit.ValidationError({'parts': ['Missing value']})
+        try:
+            client.complete_multipart_upload(
+                Bucket=upload.bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except botocore.exceptions.ClientError as e:
+            raise toolkit.ValidationError(
+                {'upload': ['Could not complete the upload: {0}'.format(
+                    e.response['Error']['Code'])]})
+
+    try:
+        head = client.head_object(Bucket=upload.bucket_name, Key=key)
+    except botocore.exceptions.ClientError:
+        raise toolkit.ValidationError(
+            {'upload': ['The file has not been uploaded']})
+
+    if head['ContentLength'] > _get_max_size():
+        upload.clear_key(key)
+        raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+    patch = {
+        'id': resource.id,
+        'url': filename,
+        'url_type': 'upload',
+        'size': head['ContentLength'],
+        'last_modified': datetime.datetime.utcnow().isoformat(),
+    }
+    content_type = head.get('ContentType')
+    if content_type and content_type != 'binary/octet-stream':
+        patch['mimetype'] = content_type
+    upload.dequeue_delete(key)
+    # The resource no longer uses its previous content addressed file
+    had_blob = upload.release_blob(resource.id)
+    old_filename = _get_upload_filename(
+        {'url_type': resource.url_type, 'url': resource.url})
+    resource_dict = toolkit.get_action('resource_patch')(context, patch)
+    if old_filename and old_filename != filename and not had_blob:
+        _clear_old_key(context, upload,
+                       upload.get_path(resource.id, old_filename))
+    return resource_dict
+
+
+def s3filestore_upload_abort(context, data_dict):
+    '''Abort a multipart upload started with `s3filestore_upload_init`,
+    removing any parts already uploaded.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the filename used when starting the upload
+    :type filename: string
+    :param upload_id: the id of the multipart upload
+    :type upload_id: string
+    '''
+    toolkit.check_access('s3filestore_upload_abort', context, data_dict)
+    resource, upload = _get_resource_uploader(data_dict)
+    key = upload.get_path(resource.id, _get_filename(data_dict))
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    try:
+        upload.get_s3_client().abort_multipart_upload(
+            Bucket=upload.bucket_name, Key=key, UploadId=upload_id)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+
+
+def _get_upload_filename(resource_dict):
+    if resource_dict.get('url_type') == 'upload' and resource_dict.get('url'):
+        return os.path.basename(resource_dict['url'])
+    return None
+
+
+# Keys from the *_show output that are not accepted when creating a copy
+_RESOURCE_READ_ONLY_KEYS = ('id', 'package_id', 'revision_id', 'created',
+                            'position', 'datastore_active',
+                            'tracking_summary')
+_PACKAGE_READ_ONLY_KEYS = ('id', 'name', 'revision_id', 'metadata_created',
+                           'metadata_modified', 'num_resources', 'num_tags',
+                           'organization', 'tracking_summary',
+                           'relationships_as_object',
+                           'relationships_as_subject')
+
+
+def _clone_resource_dict(resource_dict):
+    clone = dict((key, value) for key, value in resource_dict.items()
+                 if key not in _RESOURCE_READ_ONLY_KEYS)
+    filename = _get_upload_filename(resource_dict)
+    if filename:
+        # resource_show returns the full download url for uploads
+        clone['url'] = filename
+    return clone
+
+
+def _copy_resource_file(upload, source_dict, target_dict):
+    '''Copy the file of `source_dict` to `target_dict`.
+
+    Blob references are added to the session, and saved when the calling
+    action commits.
+    '''
+    filename = _get_upload_filename(source_dict)
+    if not filename:
+        return
+    blob_path = db.get_resource_blob(source_dict['id'])
+    if blob_path:
+        # Content addressed files are shared instead of copied
+        db.set_resource_blob(target_dict['id'], blob_path,
+                             source_dict.get('size'))
+    else:
+        upload.copy_key(upload.get_path(source_dict['id'], filename),
+                        upload.get_path(target_dict['id'], filename),
+                        make_public=upload.is_public(target_dict['id']))
+
+
+def s3filestore_resource_clone(context, data_dict):
+    '''Copy a resource, and its file if it was uploaded, to a dataset.
+
+    The file is copied within S3, without downloading it.
+
+    :param id: the id of the resource to copy
+    :type id: string
+    :param package_id: the id or name of the dataset to copy the resource to
+        (optional, defaults to the resource's own dataset)
+    :type package_id: string
+
+    Returns the new resource.
+    '''
+    toolkit.check_access('s3filestore_resource_clone', context, data_dict)
+    source = toolkit.get_action('resource_show')(
+        dict(context), {'id': toolkit.get_or_bust(data_dict, 'id')})
+
+    clone = _clone_resource_dict(source)
+    clone['package_id'] = data_dict.get('package_id') or source['package_id']
+    resource = toolkit.get_action('resource_create')(dict(context), clone)
+
+    try:
+        _copy_resource_file(S3ResourceUploader({}), source, resource)
+    except Exception:
+        model.Session.rollback()
+        toolkit.get_action('resource_delete')(dict(context),
+                                              {'id': resource['id']})
+        raise
+    model.repo.commit()
+    return resource
+
+
+def s3filestore_package_clone(context, data_dict):
+    '''Copy a dataset with all its resources and their files.
+
+    Files are copied within S3, without downloading them.
+
+    :param id: the id or name of the dataset to copy
+    :type id: string
+    :param name: the name of the new dataset
+    :type name: string
+
+    Any other dataset fields given (e.g. `title` or `owner_org`) replace
+    the ones of the original dataset. Returns the new dataset.
+    '''
+    toolkit.check_access('s3filestore_package_clone', context, data_dict)
+    source = toolkit.get_action('package_show')(
+        dict(context), {'id': toolkit.get_or_bust(data_dict, 'id')})
+    toolkit.get_or_bust(data_dict, 'name')
+
+    clone = dict((key, value) for key, value in source.items()
+                 if key not in _PACKAGE_READ_ONLY_KEYS)
+    clone['resources'] = [_clone_resource_dict(resource)
+                          for resource in source.get('resources', [])]
+    clone.update((key, value) for key, value in data_dict.items()
+                 if key != 'id')
+    package = toolkit.get_action('package_create')(dict(context), clone)
+
+    upload = S3ResourceUploader({})
+    try:
+        for source_resource, resource in zip(source.get('resources', []),
+                                             package.get('resources', [])):
+            _copy_resource_file(upload, source_resource, resource)
+    except Exception:
+        model.Session.rollback()
+        toolkit.get_action('package_delete')(dict(context),
+                                             {'id': package['id']})
+        raise
+    model.repo.commit()
+    return package
+
+
+def s3filestore_resource_rename(context, data_dict):
+    '''Rename the uploaded file of a resource.
+
+    The file is copied within S3, without downloading it, and the old file
+    is removed once the resource points to the new one.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the new filename
+    :type filename: string
+
+    Returns the updated resource.
+    '''
+    toolkit.check_access('s3filestore_resource_rename', context, data_dict)
+    resource, upload = _get_resource_uploader(data_dict)
+    filename = _get_filename(data_dict)
+    if resource.url_type != 'upload' or not resource.url:
+        raise toolkit.ValidationError(
+            {'id': ['The resource does not have an uploaded file']})
+
+    old_filename = os.path.basename(resource.url)
+    # Content addressed files are not stored under their filename
+    has_blob = db.get_resource_blob(resource.id) is not None
+    move = old_filename != filename and not has_blob
+    if move:
+        # The old file is only removed once the resource points to the copy
+        upload.copy_key(upload.get_path(resource.id, old_filename),
+                        upload.get_path(resource.id, filename),
+                        make_public=upload.is_public(resource.id))
+    resource_dict = toolkit.get_action('resource_patch')(
+        context, {'id': resource.id, 'url': filename})
+    if move:
+        _clear_old_key(context, upload,
+                       upload.get_path(resource.id, old_filename))
+    return resource_dict
+
+
+def _capture_private(context, data_dict):
+    '''Remember whether the dataset was private before it is updated, so
+    the plugin's `after_update` only changes the ACLs of its files when
+    the visibility changes.'''
+    package = model.Package.get(data_dict.get('id') or
+                                data_dict.get('name') or '')
+    if package is not None:
+        context['s3filestore_was_private'] = package.private
+
+
+def package_update(original_action, context, data_dict):
+    _capture_private(context, data_dict)
+    return original_action(context, data_dict)
+
+
+def package_patch(original_action, context, data_dict):
+    # package_patch calls package_update directly, not through the chain
+    _capture_private(context, data_dict)
+    return original_action(context, data_dict)
+
+
+def get_actions():
+    actions = {
+        's3filestore_upload_init': s3filestore_upload_init,
+        's3filestore_upload_finalize': s3filestore_upload_finalize,
+        's3filestore_upload_abort': s3filestore_upload_abort,
+        's3filestore_resource_clone': s3filestore_resource_clone,
+        's3filestore_package_clone': s3filestore_package_clone,
+        's3filestore_resource_rename': s3filestore_resource_rename,
+    }
+    # Chained actions are only available from CKAN 2.7
+    if toolkit.check_ckan_version(min_version='2.7.0'):
+        actions['package_update'] = toolkit.chained_action(package_update)
+        actions['package_patch'] = toolkit.chained_action(package_patch)
+    return actions
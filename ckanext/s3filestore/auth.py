@@ -0,0 +1,60 @@
+import ckantoolkit as toolkit
+
+
+def _resource_update(context, data_dict):
+    try:
+        toolkit.check_access('resource_update', context,
+                             {'id': data_dict.get('id')})
+        return {'success': True}
+    except toolkit.NotAuthorized:
+        return {'success': False,
+                'msg': toolkit._('Not authorized to update this resource')}
+
+
+def s3filestore_upload_init(context, data_dict):
+    return _resource_update(context, data_dict)
+
+
+def s3filestore_upload_finalize(context, data_dict):
+    return _resource_update(context, data_dict)
+
+
+def s3filestore_upload_abort(context, data_dict):
+    return _resource_update(context, data_dict)
+
+
+def s3filestore_resource_clone(context, data_dict):
+    # Creating the copy checks the user can add resources to the dataset
+    try:
+        toolkit.check_access('resource_show', context,
+                             {'id': data_dict.get('id')})
+        return {'success': True}
+    except toolkit.NotAuthorized:
+        return {'success': False,
+                'msg': toolkit._('Not authorized to read this resource')}
+
+
+def s3filestore_package_clone(context, data_dict):
+    # Creating the copy checks the user can create datasets
+    try:
+        toolkit.check_access('package_show', context,
+                             {'id': data_dict.get('id')})
+        return {'success': True}
+    except toolkit.NotAuthorized:
+        return {'success': False,
+                'msg': toolkit._('Not authorized to read this dataset')}
+
+
+def s3filestore_resource_rename(context, data_dict):
+    return _resource_update(context, data_dict)
+
+
+def get_auth_functions():
+    return {
+        's3filestore_upload_init': s3filestore_upload_init,
+        's3filestore_upload_finalize': s3filestore_upload_finalize,
+        's3filestore_upload_abort': s3filestore_upload_abort,
+        's3filestore_resource_clone': s3filestore_resource_clone,
+        's3filestore_package_clone': s3filestore_package_clone,
+        's3filestore_resource_rename': s3filestore_resource_rename,
+    }
@@ -0,0 +1,318 @@
+'''
+Bulk operations on the bucket, used by the paster commands.
+'''
+import os
+import logging
+
+import botocore
+from sqlalchemy import event
+
+import ckan.model as model
+
+from ckanext.s3filestore import db
+from ckanext.s3filestore.engine import MAX_DELETE_KEYS, TransferEngine
+from ckanext.s3filestore.uploader import BaseS3Uploader, S3ResourceUploader
+
+log = logging.getLogger(__name__)
+
+# Grantee of public-read objects
+ALL_USERS = 'http://acs.amazonaws.com/groups/global/AllUsers'
+
+# Session.info keys of the resources whose files are removed on commit
+_PENDING_REMOVALS = 's3filestore_pending_removals'
+_LISTENING = 's3filestore_listening'
+
+
+def delete_keys(client, bucket_name, keys):
+    '''Delete `keys` from the bucket with DeleteObjects requests of up to
+    1000 keys each.
+
+    Returns a dict with the error for each key that could not be deleted.
+    '''
+    errors = {}
+    keys = list(keys)
+    for start in range(0, len(keys), MAX_DELETE_KEYS):
+        batch = keys[start:start + MAX_DELETE_KEYS]
+        try:
+            result = client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True})
+        except botocore.exceptions.ClientError as e:
+            errors.update((key, str(e)) for key in batch)
+            continue
+        for error in result.get('Errors', []):
+            errors[error['Key']] = '{0}: {1}'.format(
+                error.get('Code'), error.get('Message'))
+    return errors
+
+
+def iter_keys(client, bucket_name, prefix, start_after=None):
+    '''Yield the keys under `prefix`, listing them a page at a time,
+    starting after the key `start_after` if given.'''
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
+def delete_prefix(client, bucket_name, prefix):
+    '''Delete every object under `prefix`.
+
+    Returns the number of objects deleted and a dict with the error for each
+    key that could not be deleted.
+    '''
+    deleted = 0
+    errors = {}
+    batch = []
+    for key in iter_keys(client, bucket_name, prefix):
+        batch.append(key)
+        if len(batch) == MAX_DELETE_KEYS:
+            batch_errors = delete_keys(client, bucket_name, batch)
+            deleted += len(batch) - len(batch_errors)
+            errors.update(batch_errors)
+            batch = []
+    if batch:
+        batch_errors = delete_keys(client, bucket_name, batch)
+        deleted += len(batch) - len(batch_errors)
+        errors.update(batch_errors)
+    return deleted, errors
+
+
+def delete_prefixes(engine, prefixes):
+    '''Delete every object under each of `prefixes`, listing and deleting
+    them concurrently with the TransferEngine `engine`.
+
+    Returns the total number of objects deleted and the errors as in
+    `delete_prefix`, with the prefixes that could not be listed as keys.
+    '''
+    deleted = 0
+    errors = {}
+
+    def iter_prefix_keys():
+        for result in engine.list_prefixes(prefixes):
+            if result.error is not None:
+                errors[result.item] = str(result.error)
+                continue
+            for key in result.value:
+                yield key
+
+    for result in engine.delete(iter_prefix_keys()):
+        if result.error:
+            errors[result.item] = result.error
+        else:
+            deleted += 1
+    return deleted, errors
+
+
+def get_resource_prefix(resource_id):
+    '''Return the prefix all the objects of a resource are stored under.'''
+    return os.path.join(S3ResourceUploader.get_storage_path(), resource_id,
+                        '')
+
+
+def get_upload_resource_ids(ids):
+    '''Return the ids of the uploaded resources among `ids`, which can be
+    resource or dataset ids or names.'''
+    resource_ids = set()
+    for id in ids:
+        package = model.Package.get(id)
+        if package:
+            resource_ids.update(resource.id
+                                for resource in package.resources_all
+                                if resource.url_type == 'upload')
+            continue
+        resource = model.Resource.get(id)
+        if resource and resource.url_type == 'upload':
+            resource_ids.add(resource.id)
+    return sorted(resource_ids)
+
+
+def get_deleted_resource_ids():
+    '''Return the ids of the uploaded resources that have been deleted, or
+    that belong to a deleted dataset.'''
+    query = model.Session.query(model.Resource.id) \
+        .join(model.Package, model.Package.id == model.Resource.package_id) \
+        .filter(model.Resource.url_type == 'upload') \
+        .filter((model.Resource.state == 'deleted') |
+                (model.Package.state == 'deleted'))
+    return [resource_id for (resource_id, ) in query]
+
+
+def remove_resource_files(resource_ids, workers=8, rate=None):
+    '''Remove all the objects stored for the given resources, with up to
+    `workers` requests at a time and at most `rate` requests per second.
+
+    If `ckanext.s3filestore.deferred_delete` is enabled the resource
+    prefixes are added to the delete queue instead. The references to
+    content addressed blobs are dropped and the blobs no other resource
+    uses are queued for deletion. Both are done in the current
+    session, which the caller commits. Returns the number of objects
+    deleted and the errors as in `delete_prefix`.
+    '''
+    upload = S3ResourceUploader({})
+    for id in resource_ids:
+        upload.release_blob(id)
+    if upload.settings.deferred_delete:
+        for id in resource_ids:
+            db.enqueue_delete(upload.bucket_name, get_resource_prefix(id))
+        return 0, {}
+    return _delete_resource_prefixes(upload, resource_ids, workers, rate)
+
+
+def _delete_resource_prefixes(upload, resource_ids, workers=8, rate=None):
+    engine = TransferEngine(concurrency=workers, rate=rate, uploader=upload)
+    return delete_prefixes(engine, [get_resource_prefix(id)
+                                    for id in resource_ids])
+
+
+def remove_resource_files_on_commit(resource_ids):
+    '''Remove all the objects stored for the given resources once the
+    current session commits, for the plugin hooks called in the middle of
+    the delete actions.
+
+    Blob references are released, and with deferred deletes the resource
+    prefixes are queued, in the current session. Otherwise the objects are
+    deleted after the commit, and kept if the session is rolled back.
+    '''
+    upload = S3ResourceUploader({})
+    for id in resource_ids:
+        upload.release_blob(id)
+    if upload.settings.deferred_delete:
+        for id in resource_ids:
+            db.enqueue_delete(upload.bucket_name, get_resource_prefix(id))
+        return
+    session = model.Session()
+    if not session.info.get(_LISTENING):
+        event.listen(session, 'after_commit', _remove_pending_files)
+        event.listen(session, 'after_rollback', _forget_pending_files)
+        session.info[_LISTENING] = True
+    session.info.setdefault(_PENDING_REMOVALS, []).extend(resource_ids)
+
+
+def _remove_pending_files(session):
+    resource_ids = session.info.pop(_PENDING_REMOVALS, None)
+    if not resource_ids:
+        return
+    try:
+        deleted, errors = _delete_resource_prefixes(
+            S3ResourceUploader({}), resource_ids)
+    except Exception as e:
+        # `paster s3 purge-deleted` can remove any files left behind
+        log.error('Could not remove the files of resources {0}: {1}'
+                  .format(', '.join(resource_ids), str(e)))
+        return
+    if errors:
+        log.error('Could not remove {0} files of resources {1}'.format(
+            len(errors), ', '.join(resource_ids)))
+
+
+def _forget_pending_files(session):
+    session.info.pop(_PENDING_REMOVALS, None)
+
+
+def _is_public_read(client, bucket_name, key):
+    grants = client.get_object_acl(Bucket=bucket_name, Key=key)['Grants']
+    return any(grant['Grantee'].get('URI') == ALL_USERS and
+               grant['Permission'] == 'READ' for grant in grants)
+
+
+def update_package_acls(package_id, changed=False):
+    '''Make the files of the uploaded resources of a dataset public-read or
+    private, to match the visibility of the dataset.
+
+    Only needed with the `auto` download strategy, when a dataset is made
+    public or private. Unless `changed` is set, meaning the visibility is
+    known to have changed, the ACLs of all the files are assumed to be set
+    together, so if the first one is already right nothing else is done.
+    Returns the number of files updated.
+    '''
+    upload = S3ResourceUploader({})
+    # Content addressed files are always private
+    if upload.get_download_strategy() != 'auto' or upload.content_addressed:
+        return 0
+    package = model.Package.get(package_id)
+    if package is None:
+        return 0
+    public = not package.private
+    keys = [upload.get_path(resource.id, os.path.basename(resource.url))
+            for resource in package.resources
+            if resource.url_type == 'upload' and resource.url]
+    client = upload.get_s3_client()
+    updated = 0
+    for key in keys:
+        try:
+            if not changed and not updated and \
+                    _is_public_read(client, upload.bucket_name, key) == public:
+                return 0
+            client.put_object_acl(
+                Bucket=upload.bucket_name, Key=key,
+                ACL='public-read' if public else 'private')
+            updated += 1
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+    return updated
+
+
+def process_delete_queue(batch_size=MAX_DELETE_KEYS, max_attempts=5):
+    '''Remove the keys in the delete queue from S3.
+
+    Queued keys ending with a slash are prefixes, and everything under them
+    is removed. Keys that fail are kept in the queue and retried on the next
+    run, up to `max_attempts` times. Blobs that are used by a resource again
+    are dropped from the queue. Returns the number of keys deleted and
+    failed.
+    '''
+    client = BaseS3Uploader().get_s3_client()
+    deleted = failed = 0
+    last_id = 0
+    while True:
+        rows = db.get_queued_deletes(batch_size, after_id=last_id,
+                                     max_attempts=max_attempts)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        by_bucket = {}
+        for id, bucket_name, key in rows:
+            if key.endswith('/'):
+                prefix_deleted, errors = delete_prefix(client, bucket_name,
+                                                       key)
+                deleted += prefix_deleted
+                if errors:
+                    failed += len(errors)
+                    db.record_failed_delete(
+                        id, '{0} keys could not be deleted'.format(
+                            len(errors)))
+                else:
+                    db.remove_queued_deletes([id])
+                continue
+            by_bucket.setdefault(bucket_name, []).append((id, key))
+
+        for bucket_name, queued in by_bucket.items():
+            # Blobs can be used again after being queued. Their rows stay
+            # locked until the commit, so they can't be in the meantime.
+            referenced = db.get_referenced_blobs([key for id, key in queued])
+            db.remove_queued_deletes([id for id, key in queued
+                                      if key in referenced])
+            queued = [(id, key) for id, key in queued
+                      if key not in referenced]
+            errors = delete_keys(client, bucket_name,
+                                 [key for id, key in queued])
+            done = [id for id, key in queued if key not in errors]
+            db.remove_queued_deletes(done)
+            db.remove_unreferenced_blobs([key for id, key in queued
+                                          if key not in errors])
+            for id, key in queued:
+                if key in errors:
+                    log.warning('Could not delete {0}: {1}'.format(
+                        key, errors[key]))
+                    db.record_failed_delete(id, errors[key])
+            deleted += len(done)
+            failed += len(queued) - len(done)
+        model.Session.commit()
+    return deleted, failed
@@ -0,0 +1,58 @@
+'''
+Small in-process caches shared by the uploaders and the controller.
+'''
+import time
+import threading
+import collections
+
+
+class LRUCache(object):
+    '''A thread safe mapping holding at most `maxsize` items.
+
+    The least recently used items are evicted first. If `ttl` is set, items
+    older than `ttl` seconds are treated as missing.
+    '''
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._data.pop(key)
+            except KeyError:
+                return default
+            if self.ttl and time.time() - stored > self.ttl:
+                return default
+            self._data[key] = (value, stored)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+
+_missing = object()
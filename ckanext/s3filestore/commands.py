@@ -1,5 +1,5 @@
 import sys
-import boto
+import itertools
 from ckantoolkit import config
 import ckantoolkit as toolkit
 
@@ -11,48 +11,247 @@ class TestConnection(toolkit.CkanCommand):
 
         paster s3 check-config
 
-            Checks if the configuration entered in the ini file is correct
+            Checks if the configuration entered in the ini file is correct,
+            and that objects can be written, read, signed and deleted with
+            the same client the uploaders use
+
+        paster s3 benchmark [--iterations=N] [--size=MB]
+                            [--part-sizes=MB,MB,...]
+                            [--concurrency=N,N,...]
+
+            Measures the latency of HeadBucket, PUT, GET, presign and DELETE
+            requests, printing their percentiles, and the multipart upload
+            throughput for each combination of part size and concurrency.
+            Set ckanext.s3filestore.host_name to a local moto server or
+            MinIO instance to try settings before using them for real.
+
+        paster s3 migrate [resources|uploads|all] [--workers=N]
+                          [--rate=N] [--checkpoint=FILE]
+
+            Uploads the resource files and/or the group, organization and
+            user images (uploads) in the local FileStore (set by
+            ckan.storage_path) to S3. Defaults to all. Files already on S3
+            are skipped. If a checkpoint file is given, the files done are
+            recorded there and an interrupted migration can be resumed by
+            running the command again with the same file.
+
+            --workers sets the number of S3 requests in flight (default
+            8) and --rate limits them to N per second. Requests S3 asks to
+            slow down (SlowDown, 503) are retried with backoff, and the
+            rate is lowered until they stop.
+
+        paster s3 init-db
+
+            Creates the database tables used by the extension
+
+        paster s3 process-deletes
+
+            Removes the keys queued for deletion from S3, in batches of up
+            to 1000 keys. Only needed if
+            ckanext.s3filestore.deferred_delete or
+            ckanext.s3filestore.content_addressed is enabled, usually run
+            from cron.
+
+        paster s3 purge <resource or dataset id> [...] [--workers=N]
+                        [--rate=N]
+
+            Removes all the files of the given resources, or of all the
+            resources of the given datasets, from S3
+
+        paster s3 purge-deleted [--workers=N] [--rate=N]
+
+            Removes the files of deleted resources, and of the resources
+            of deleted datasets, from S3
+
+        paster s3 scan [--workers=N]
+
+            Compares the resource files on S3 with the resource table and
+            reports uploaded resources with no file on S3 (missing), files
+            that don't belong to any uploaded resource (orphan) and
+            resources whose files on S3 don't match their url (mismatch)
 
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
     min_args = 1
 
+    def __init__(self, name):
+        super(TestConnection, self).__init__(name)
+        self.parser.add_option('--workers', dest='workers', type='int',
+                               default=8,
+                               help='Number of S3 operations run at a time')
+        self.parser.add_option('--rate', dest='rate', type='float',
+                               default=None,
+                               help='Most S3 requests per second')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               default=None,
+                               help='File to record the migration progress')
+        self.parser.add_option('--iterations', dest='iterations',
+                               type='int', default=20,
+                               help='Requests timed per operation')
+        self.parser.add_option('--size', dest='size', type='int',
+                               default=64,
+                               help='Size in MB of the throughput test file')
+        self.parser.add_option('--part-sizes', dest='part_sizes',
+                               default='5,8,16,64',
+                               help='Part sizes in MB to try')
+        self.parser.add_option('--concurrency', dest='concurrency',
+                               default='1,4,10',
+                               help='Numbers of concurrent parts to try')
+
     def command(self):
         self._load_config()
         if not self.args:
             print self.usage
         elif self.args[0] == 'check-config':
             self.check_config()
+        elif self.args[0] == 'benchmark':
+            self.benchmark()
+        elif self.args[0] == 'migrate':
+            self.migrate()
+        elif self.args[0] == 'init-db':
+            self.init_db()
+        elif self.args[0] == 'process-deletes':
+            self.process_deletes()
+        elif self.args[0] == 'purge':
+            self.purge(self.args[1:])
+        elif self.args[0] == 'purge-deleted':
+            self.purge()
+        elif self.args[0] == 'scan':
+            self.scan()
 
     def check_config(self):
-        exit = False
-        for key in ('ckanext.s3filestore.aws_access_key_id',
-                    'ckanext.s3filestore.aws_secret_access_key',
-                    'ckanext.s3filestore.aws_bucket_name'):
-            if not config.get(key):
-                print 'You must set the "{0}" option in your ini file'.format(
-                    key)
-                exit = True
-        if exit:
-            sys.exit(1)
-
-        print 'All configuration options defined'
-        bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
-        public_key = config.get('ckanext.s3filestore.aws_access_key_id')
-        secret_key = config.get('ckanext.s3filestore.aws_secret_access_key')
-
-        S3_conn = boto.connect_s3(public_key, secret_key)
-
-        # Check if bucket exists
-        bucket = S3_conn.lookup(bucket_name)
-        if bucket is None:
-            print 'Bucket {0} does not exist, trying to create it...'.format(
-                bucket_name)
-            try:
-                bucket = S3_conn.create_bucket(bucket_name)
-            except boto.exception.StandardError as e:
-                print 'An error was found while creating the bucket:'
-                print str(e)
-                sys.exit(1)
+        from ckanext.s3filestore import diagnostics
+
+        checks = diagnostics.check()
+        for check in checks:
+            print '{0:<10}{1:<6}{2}'.format(
+                check.name, 'OK' if check.ok else 'FAIL', check.message)
+        if not all(check.ok for check in checks):
+            sys.exit(1)
         print 'Configuration OK!'
+
+    def benchmark(self):
+        from ckanext.s3filestore import diagnostics
+        from ckanext.s3filestore.uploader import BaseS3Uploader, MB
+
+        try:
+            part_sizes = [int(size) * MB
+                          for size in self.options.part_sizes.split(',')]
+            concurrencies = [int(n)
+                             for n in self.options.concurrency.split(',')]
+        except ValueError:
+            print self.usage
+            sys.exit(1)
+        upload = BaseS3Uploader()
+
+        print 'Latency over {0} requests (ms):'.format(
+            self.options.iterations)
+        print '{0:<12}{1:>10}{2:>10}{3:>10}{4:>10}'.format(
+            'operation', 'p50', 'p90', 'p99', 'max')
+        timings = diagnostics.benchmark_latency(
+            upload, iterations=self.options.iterations)
+        for name, samples in timings.items():
+            points = diagnostics.percentiles(samples, (50, 90, 99, 100))
+            print '{0:<12}{1:>10.1f}{2:>10.1f}{3:>10.1f}{4:>10.1f}'.format(
+                name, *[points[point] * 1000 for point in (50, 90, 99, 100)])
+
+        print
+        print 'Upload throughput, {0}MB file:'.format(self.options.size)
+        print '{0:>10}{1:>13}{2:>10}{3:>10}'.format(
+            'part (MB)', 'concurrency', 'seconds', 'MB/s')
+        for result in diagnostics.benchmark_throughput(
+                upload, size=self.options.size * MB,
+                part_sizes=part_sizes, concurrencies=concurrencies):
+            print '{0:>10}{1:>13}{2:>10.2f}{3:>10.1f}'.format(
+                result.part_size / MB, result.concurrency, result.seconds,
+                result.mb_per_second or 0)
+
+    def migrate(self):
+        from ckanext.s3filestore import migration
+
+        target = self.args[1] if len(self.args) > 1 else 'all'
+        if target not in ('resources', 'uploads', 'all'):
+            print self.usage
+            sys.exit(1)
+
+        storage_path = config.get('ckan.storage_path')
+        if not storage_path:
+            print 'You must set the "ckan.storage_path" option in your ini file'
+            sys.exit(1)
+
+        items = []
+        if target in ('resources', 'all'):
+            items.append(migration.iter_resource_items(storage_path))
+        if target in ('uploads', 'all'):
+            items.append(migration.iter_upload_items(storage_path))
+
+        checkpoint = None
+        if self.options.checkpoint:
+            checkpoint = migration.Checkpoint(self.options.checkpoint)
+            if len(checkpoint):
+                print 'Resuming, {0} files already migrated'.format(
+                    len(checkpoint))
+
+        def progress(item, status):
+            print '{0}: {1} -> {2}'.format(status, item.path, item.key)
+
+        try:
+            stats = migration.Migration(
+                workers=self.options.workers, checkpoint=checkpoint,
+                progress=progress, rate=self.options.rate).run(itertools.chain(*items))
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+        print 'Done, {0} uploaded, {1} already on S3, {2} failed'.format(
+            stats['uploaded'], stats['skipped'] + stats['resumed'],
+            stats['failed'])
+        if stats['failed']:
+            sys.exit(1)
+
+    def init_db(self):
+        from ckanext.s3filestore import db
+        db.init_db()
+        print 'Database tables created'
+
+    def process_deletes(self):
+        from ckanext.s3filestore import bulk
+        deleted, failed = bulk.process_delete_queue()
+        print 'Deleted {0} keys, {1} failed'.format(deleted, failed)
+        if failed:
+            sys.exit(1)
+
+    def purge(self, ids=None):
+        import ckan.model as model
+        from ckanext.s3filestore import bulk
+
+        if ids is None:
+            resource_ids = bulk.get_deleted_resource_ids()
+        elif ids:
+            resource_ids = bulk.get_upload_resource_ids(ids)
+        else:
+            print self.usage
+            sys.exit(1)
+
+        print 'Removing the files of {0} resources'.format(len(resource_ids))
+        deleted, errors = bulk.remove_resource_files(
+            resource_ids, workers=self.options.workers,
+            rate=self.options.rate)
+        model.Session.commit()
+        for key, error in sorted(errors.items()):
+            print 'Could not delete {0}: {1}'.format(key, error)
+        print 'Deleted {0} files, {1} failed'.format(deleted, len(errors))
+        if errors:
+            sys.exit(1)
+
+    def scan(self):
+        from ckanext.s3filestore import scan
+
+        def report(issue):
+            print '{0}\t{1}\t{2}'.format(issue.type, issue.resource_id,
+                                         issue.key or '')
+
+        stats = scan.scan(report, workers=self.options.workers)
+        print 'Done, {0} missing, {1} orphan, {2} mismatch'.format(
+            stats[scan.MISSING], stats[scan.ORPHAN], stats[scan.MISMATCH])
@@ -0,0 +1,149 @@
+'''
+Process-wide registry of boto3 sessions and clients.
+
+Creating a ``boto3.session.Session`` resolves credentials and loads the
+service models, and every new client opens its own connection pool. The
+uploaders, the controller and the paster commands get their clients from
+here instead, so connections to the object store are kept alive and reused
+across requests and threads.
+'''
+import threading
+
+import boto3
+import botocore
+
+from ckanext.s3filestore import metrics, retry, settings
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_local = threading.local()
+_generation = 0
+
+
+def get_client_config(signature_version=None, max_pool_connections=None,
+                      retry_max_attempts=None):
+    '''Return the ``botocore`` client config built from the ini options.
+
+    `max_pool_connections` and `retry_max_attempts`, if given, override
+    the options of the same name.
+
+    Supported options (all optional):
+
+        ckanext.s3filestore.max_pool_connections (default 10)
+        ckanext.s3filestore.connect_timeout (seconds, default 60)
+        ckanext.s3filestore.read_timeout (seconds, default 60)
+        ckanext.s3filestore.tcp_keepalive (default false)
+        ckanext.s3filestore.retry_max_attempts (default 4)
+        ckanext.s3filestore.retry_mode (legacy, standard or adaptive, to
+            use botocore's retries instead of the ones in `retry`)
+        ckanext.s3filestore.url_style (path or virtual, default path)
+    '''
+    s3_settings = settings.get()
+    if max_pool_connections is None:
+        max_pool_connections = s3_settings.max_pool_connections
+    if retry_max_attempts is None:
+        retry_max_attempts = s3_settings.retry_max_attempts
+    retries = {'max_attempts': retry_max_attempts}
+    if s3_settings.retry_mode:
+        retries['mode'] = s3_settings.retry_mode
+
+    options = {
+        'signature_version': signature_version,
+        'max_pool_connections': max_pool_connections,
+        'connect_timeout': s3_settings.connect_timeout,
+        'read_timeout': s3_settings.read_timeout,
+        'retries': retries,
+    }
+    if s3_settings.url_style == 'virtual':
+        options['s3'] = {'addressing_style': 'virtual'}
+    # Only passed when enabled, older botocore releases don't know about it
+    if s3_settings.tcp_keepalive:
+        options['tcp_keepalive'] = True
+    return botocore.client.Config(**options)
+
+
+def get_session(access_key, secret_key, region):
+    '''Return the shared session for the given credentials and region.'''
+    key = (access_key, secret_key, region)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = boto3.session.Session(
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    region_name=region)
+                _sessions[key] = session
+    return session
+
+
+def get_client(access_key, secret_key, region, endpoint_url=None,
+               signature_version=None, max_pool_connections=None,
+               retry_max_attempts=None):
+    '''Return the shared S3 client for the given connection details.
+
+    Clients are thread safe, so a single one is kept per combination of
+    credentials, region, endpoint, signature version and the overrides
+    passed to `get_client_config`.
+    '''
+    key = (access_key, secret_key, region, endpoint_url, signature_version,
+           max_pool_connections, retry_max_attempts)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session(access_key, secret_key, region)
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(
+                    's3', endpoint_url=endpoint_url,
+                    config=get_client_config(
+                        signature_version,
+                        max_pool_connections=max_pool_connections,
+                        retry_max_attempts=retry_max_attempts))
+                metrics.register_client(client)
+                retry.register_client(client, retry_max_attempts)
+                _clients[key] = client
+    return client
+
+
+def get_resource(access_key, secret_key, region, endpoint_url=None,
+                 signature_version=None):
+    '''Return an S3 service resource for the given connection details.
+
+    boto3 resources are not thread safe, so these are kept per thread.
+    '''
+    key = (access_key, secret_key, region, endpoint_url, signature_version)
+    if getattr(_local, 'generation', None) != _generation:
+        _local.generation = _generation
+        _local.resources = {}
+    resources = _local.resources
+    resource = resources.get(key)
+    if resource is None:
+        session = get_session(access_key, secret_key, region)
+        # Sessions are not thread safe either
+        with _lock:
+            resource = session.resource(
+                's3', endpoint_url=endpoint_url,
+                config=get_client_config(signature_version))
+        metrics.register_client(resource.meta.client)
+        retry.register_client(resource.meta.client)
+        resources[key] = resource
+    return resource
+
+
+def reset():
+    '''Drop all the shared sessions and clients, the metrics emitter, and
+    the retry budgets and circuit breakers.
+
+    They will be created again with the current configuration the next time
+    they are requested.
+    '''
+    global _generation
+    metrics.reset()
+    retry.reset()
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        _generation += 1
@@ -1,7 +1,8 @@
 import os
+import calendar
+import email.utils
 import mimetypes
 import paste.fileapp
-from ckantoolkit import config
 
 import ckantoolkit as toolkit
 import ckan.logic as logic
@@ -9,10 +10,13 @@ import ckan.lib.base as base
 import ckan.model as model
 import ckan.lib.uploader as uploader
 from ckan.common import _, request, c, response
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
+from ckanext.s3filestore import metrics, retry, settings
 from ckanext.s3filestore.uploader import S3Uploader
-import webob
+from ckanext.s3filestore.cache import LRUCache
+from ckanext.s3filestore.filecache import get_file_cache
+import webob.exc
 
 import logging
 log = logging.getLogger(__name__)
@@ -23,6 +27,86 @@ get_action = logic.get_action
 abort = base.abort
 redirect = toolkit.redirect_to
 
+# Resources of public datasets that have recently been downloaded
+_download_resources = None
+
+
+def _get_download_resource_cache():
+    '''Return the cache of public resources, or None if it's disabled.
+
+    Enabled by setting `ckanext.s3filestore.download_auth_cache_ttl` to the
+    number of seconds entries are kept for.
+    '''
+    global _download_resources
+    s3_settings = settings.get()
+    ttl = s3_settings.download_auth_cache_ttl
+    if ttl <= 0:
+        return None
+    if _download_resources is None or _download_resources.ttl != ttl:
+        _download_resources = LRUCache(
+            maxsize=s3_settings.download_auth_cache_size, ttl=ttl)
+    return _download_resources
+
+
+def _get_download_resource(context, id, resource_id):
+    '''Return the resource details needed to serve a download.
+
+    Instead of calling `resource_show` and `package_show`, which dictize the
+    whole dataset, the resource is read from the model and only the
+    `resource_show` auth function is checked. Resources of public datasets
+    can be cached so anonymous downloads don't query the database.
+
+    Raises NotFound or NotAuthorized.
+    '''
+    cache = _get_download_resource_cache()
+    if cache is not None:
+        rsc = cache.get(resource_id)
+        if rsc and id in (rsc['package_id'], rsc['package_name']):
+            return rsc
+
+    resource = model.Resource.get(resource_id)
+    if not resource or resource.state == 'deleted':
+        raise NotFound
+    package = resource.package
+    if not package or id not in (package.id, package.name):
+        raise NotFound
+    toolkit.check_access('resource_show', context, {'id': resource.id})
+
+    rsc = {
+        'id': resource.id,
+        'url': resource.url,
+        'url_type': resource.url_type,
+        'package_id': package.id,
+        'package_name': package.name,
+        'private': package.private,
+    }
+    if cache is not None and not package.private \
+            and package.state == 'active':
+        cache.set(resource.id, rsc)
+    return rsc
+
+
+def _iter_chunks(stream, chunk_size=64 * 1024):
+    '''Yield the contents of a file or S3 body `chunk_size` bytes at a
+    time, closing it at the end.'''
+    try:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            yield chunk
+    finally:
+        stream.close()
+
+
+def _cached_redirect(url, max_age, private=False):
+    '''Redirect to `url`, letting clients cache the redirect for `max_age`
+    seconds.'''
+    if max_age > 0:
+        cache_control = '{0}, max-age={1}'.format(
+            'private' if private else 'public', max_age)
+    else:
+        cache_control = 'no-cache'
+    raise webob.exc.HTTPFound(location=url,
+                              headers=[('Cache-Control', cache_control)])
+
 
 class S3Controller(base.BaseController):
 
@@ -35,59 +119,158 @@ class S3Controller(base.BaseController):
                    'user': c.user or c.author, 'auth_user_obj': c.userobj}
 
         try:
-            rsc = get_action('resource_show')(context, {'id': resource_id})
-            get_action('package_show')(context, {'id': id})
+            rsc = _get_download_resource(context, id, resource_id)
         except NotFound:
             abort(404, _('Resource not found'))
         except NotAuthorized:
             abort(401, _('Unauthorized to read resource %s') % id)
 
         if rsc.get('url_type') == 'upload':
-            upload = uploader.get_resource_uploader(rsc)
-            bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
-            region = config.get('ckanext.s3filestore.region_name')
-            host_name = config.get('ckanext.s3filestore.host_name')
-            bucket = upload.get_s3_bucket(bucket_name)
+            upload = uploader.get_resource_uploader(dict(rsc))
+            bucket_name = upload.bucket_name
 
             if filename is None:
                 filename = os.path.basename(rsc['url'])
-            key_path = upload.get_path(rsc['id'], filename)
+            key_path = upload.get_file_path(rsc['id'], filename)
             key = filename
+            # Content addressed files are named after their digest
+            served_filename = None
+            if key_path != upload.get_path(rsc['id'], filename):
+                served_filename = filename
 
             if key is None:
                 log.warn('Key \'{0}\' not found in bucket \'{1}\''
                          .format(key_path, bucket_name))
 
             try:
+                # Presigning doesn't send any request, so check that the
+                # store is up before sending users to it
+                retry.check_circuit(upload.get_s3_client())
+
+                strategy = upload.get_download_strategy()
+                if strategy == 'proxy':
+                    with metrics.timer('download', mode='proxy'):
+                        return self._proxy_download(upload, key_path, rsc,
+                                                   served_filename)
+
+                # Files of public datasets are public-read, so their plain
+                # url is used, with no request to S3 or even presigning
+                if strategy == 'auto' and not rsc['private'] \
+                        and served_filename is None:
+                    with metrics.timer('download', mode='direct'):
+                        url = upload.get_public_url(key_path)
+                    _cached_redirect(url, upload.settings.signed_url_expiry)
+
                 # Small workaround to manage downloading of large files
                 # We are using redirect to minio's resource public URL
-                s3 = upload.get_s3_session()
-                client = s3.client(service_name='s3', endpoint_url=host_name)
-                url = client.generate_presigned_url(ClientMethod='get_object',
-                                                    Params={'Bucket': bucket.name,
-                                                            'Key': key_path},
-                                                    ExpiresIn=60)
-                redirect(url)
+                with metrics.timer('download', mode='redirect'):
+                    url, max_age = upload.get_signed_url(key_path,
+                                                         served_filename)
+                _cached_redirect(url, max_age, private=rsc['private'])
 
             except ClientError as ex:
                 if ex.response['Error']['Code'] == 'NoSuchKey':
-                    # attempt fallback
-                    if config.get(
-                            'ckanext.s3filestore.filesystem_download_fallback',
-                            False):
-                        log.info('Attempting filesystem fallback for resource {0}'
-                                 .format(resource_id))
-                        url = toolkit.url_for(
-                            controller='ckanext.s3filestore.controller:S3Controller',
-                            action='filesystem_resource_download',
-                            id=id,
-                            resource_id=resource_id,
-                            filename=filename)
-                        redirect(url)
-
+                    self._filesystem_fallback(upload, id, resource_id,
+                                              filename)
                     abort(404, _('Resource data not found'))
+                elif retry.classify_error(ex):
+                    self._store_unavailable(upload, id, resource_id,
+                                            filename, ex)
                 else:
                     raise ex
+            except (retry.CircuitOpenError, BotoCoreError) as ex:
+                if isinstance(ex, BotoCoreError) and \
+                        not retry.classify_error(ex):
+                    raise
+                self._store_unavailable(upload, id, resource_id, filename,
+                                        ex)
+        elif not rsc.get('url'):
+            abort(404, _('No download is available'))
+        redirect(str(rsc['url']))
+
+    def _filesystem_fallback(self, upload, id, resource_id, filename):
+        '''Redirect to the download from the local filesystem, if
+        `ckanext.s3filestore.filesystem_download_fallback` is enabled.'''
+        if not upload.settings.filesystem_download_fallback:
+            return
+        log.info('Attempting filesystem fallback for resource {0}'
+                 .format(resource_id))
+        url = toolkit.url_for(
+            controller='ckanext.s3filestore.controller:S3Controller',
+            action='filesystem_resource_download',
+            id=id,
+            resource_id=resource_id,
+            filename=filename)
+        redirect(url)
+
+    def _store_unavailable(self, upload, id, resource_id, filename, error):
+        '''Use the filesystem fallback if enabled, or fail with a 503 when
+        S3 can't be reached.'''
+        log.warning('Could not download resource {0}: {1}'.format(
+            resource_id, str(error)))
+        self._filesystem_fallback(upload, id, resource_id, filename)
+        abort(503, _('The file store is unavailable, please try again '
+                     'later'))
+
+    def _proxy_download(self, upload, key_path, rsc, filename=None):
+        '''Stream the file from S3 through this response.
+
+        Range and conditional request headers are forwarded to S3, so
+        partial (206) and not modified (304) responses work as they would
+        against S3 itself. If `filename` is given the file is served under
+        that name.
+        '''
+        get_args = {'Bucket': upload.bucket_name, 'Key': key_path}
+        if request.headers.get('Range'):
+            get_args['Range'] = request.headers['Range']
+        if request.headers.get('If-None-Match'):
+            get_args['IfNoneMatch'] = request.headers['If-None-Match']
+        if request.if_modified_since:
+            get_args['IfModifiedSince'] = request.if_modified_since
+        if rsc['private']:
+            response.headers['Cache-Control'] = 'private'
+
+        try:
+            obj = upload.get_s3_client().get_object(**get_args)
+        except ClientError as ex:
+            error_code = ex.response['Error']['Code']
+            s3_headers = ex.response.get('ResponseMetadata', {}) \
+                .get('HTTPHeaders', {})
+            if error_code in ('304', 'NotModified'):
+                for header in ('ETag', 'Last-Modified'):
+                    if s3_headers.get(header.lower()):
+                        response.headers[header] = \
+                            str(s3_headers[header.lower()])
+                response.status_int = 304
+                return ''
+            if error_code in ('412', 'PreconditionFailed'):
+                response.status_int = 412
+                return ''
+            if error_code == 'InvalidRange':
+                response.status_int = 416
+                return ''
+            raise
+
+        response.status_int = 206 if obj.get('ContentRange') else 200
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Length'] = str(obj['ContentLength'])
+        response.headers['Content-Type'] = str(
+            obj.get('ContentType') or 'application/octet-stream')
+        if filename:
+            response.headers['Content-Disposition'] = str(
+                'inline; filename="{0}"'.format(filename.replace('"', '')))
+            content_type = mimetypes.guess_type(filename, strict=False)[0]
+            if content_type:
+                response.headers['Content-Type'] = content_type
+        if obj.get('ContentRange'):
+            response.headers['Content-Range'] = str(obj['ContentRange'])
+        if obj.get('ETag'):
+            response.headers['ETag'] = str(obj['ETag'])
+        if obj.get('LastModified'):
+            response.headers['Last-Modified'] = email.utils.formatdate(
+                calendar.timegm(obj['LastModified'].utctimetuple()),
+                usegmt=True)
+        return _iter_chunks(obj['Body'], upload.settings.proxy_chunk_size)
 
     def filesystem_resource_download(self, id, resource_id, filename=None):
         """
@@ -129,19 +312,69 @@ class S3Controller(base.BaseController):
         redirect(str(rsc['url']))
 
     def uploaded_file_redirect(self, upload_to, filename):
-        '''Redirect static file requests to their location on S3.'''
-        host_name = config.get('ckanext.s3filestore.host_name')
-        # Remove last characted if it's a slash
-        if host_name[-1] == '/':
-            host_name = host_name[:-1]
-        storage_path = S3Uploader.get_storage_path(upload_to)
-        filepath = os.path.join(storage_path, filename)
-        #host = config.get('ckanext.s3.filestore.hostname')
-        # redirect_url = 'https://{bucket_name}.minio.omc.ckan.io/{filepath}' \
-        #     .format(bucket_name=config.get('ckanext.s3filestore.aws_bucket_name'),
-        #             filepath=filepath)
-        redirect_url = '{host_name}/{bucket_name}/{filepath}'\
-                          .format(bucket_name=config.get('ckanext.s3filestore.aws_bucket_name'),
-                          filepath=filepath,
-                          host_name=host_name)
-        redirect(redirect_url)
+        '''Redirect static file requests to their location on S3.
+
+        If the local file cache is enabled, small files are served from it
+        instead.
+        '''
+        upload = S3Uploader(upload_to)
+        filepath = os.path.join(upload.storage_path, filename)
+        file_cache = get_file_cache()
+        if file_cache is not None:
+            try:
+                entry = file_cache.get(upload.get_s3_client(),
+                                       upload.bucket_name, filepath)
+            except (ClientError, BotoCoreError,
+                    retry.CircuitOpenError) as ex:
+                log.warning('Could not cache {0}: {1}'.format(filepath,
+                                                              str(ex)))
+                entry = None
+            if entry:
+                try:
+                    return self._serve_cached_file(entry,
+                                                   file_cache.revalidate)
+                except IOError:
+                    # evicted in the meantime, let S3 serve it
+                    pass
+
+        redirect(upload.get_public_url(filepath))
+
+    def prometheus_metrics(self):
+        '''Serve the metrics in the Prometheus text format, if
+        `ckanext.s3filestore.metrics` is set to prometheus.'''
+        emitter = metrics.get_emitter()
+        if not isinstance(emitter, metrics.PrometheusEmitter):
+            abort(404, _('Not found'))
+        token = settings.get().metrics_token
+        if token and request.headers.get('Authorization') != \
+                'Bearer {0}'.format(token):
+            abort(403, _('Not authorized to see this page'))
+        response.headers['Content-Type'] = \
+            'text/plain; version=0.0.4; charset=utf-8'
+        return emitter.render()
+
+    def _serve_cached_file(self, entry, max_age):
+        '''Serve a file from the local file cache, answering conditional
+        requests with a 304.'''
+        f = open(entry['path'], 'rb')
+
+        response.headers['ETag'] = str(entry['etag'])
+        response.headers['Last-Modified'] = str(entry['last_modified'])
+        response.headers['Cache-Control'] = 'public, max-age={0}'.format(
+            max_age)
+
+        not_modified = False
+        if request.if_none_match:
+            not_modified = entry['etag'].strip('"') in request.if_none_match
+        elif request.if_modified_since:
+            not_modified = calendar.timegm(
+                request.if_modified_since.utctimetuple()) >= entry['modified']
+        if not_modified:
+            f.close()
+            response.status_int = 304
+            return ''
+
+        if entry['content_type']:
+            response.headers['Content-Type'] = str(entry['content_type'])
+        response.headers['Content-Length'] = str(entry['size'])
+        return _iter_chunks(f)
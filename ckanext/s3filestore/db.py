@@ -0,0 +1,186 @@
+'''
+Database tables used by the extension.
+
+Create them with `paster s3 init-db`.
+'''
+import datetime
+import logging
+
+from sqlalchemy import Table, Column, types, select
+
+import ckan.model as model
+from ckan.model import meta
+
+log = logging.getLogger(__name__)
+
+# Keys waiting to be removed from S3, see `ckanext.s3filestore.deferred_delete`
+delete_queue_table = Table(
+    's3filestore_delete_queue', meta.metadata,
+    Column('id', types.Integer, primary_key=True),
+    Column('bucket', types.UnicodeText, nullable=False),
+    Column('key', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    Column('attempts', types.Integer, nullable=False, default=0),
+    Column('last_error', types.UnicodeText),
+)
+
+# Files stored by their contents, see `ckanext.s3filestore.content_addressed`
+blob_table = Table(
+    's3filestore_blob', meta.metadata,
+    Column('key', types.UnicodeText, primary_key=True),
+    Column('size', types.BigInteger),
+    Column('refcount', types.Integer, nullable=False, default=0),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+# The blob each content addressed resource points to
+resource_blob_table = Table(
+    's3filestore_resource_blob', meta.metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('key', types.UnicodeText, nullable=False, index=True),
+)
+
+
+def init_db():
+    '''Create the extension tables if they don't exist yet.'''
+    for table in (delete_queue_table, blob_table, resource_blob_table):
+        table.create(meta.engine, checkfirst=True)
+
+
+def enqueue_delete(bucket_name, key):
+    '''Add `key` to the delete queue.
+
+    Uses the current session, so the key is only queued once the request
+    that removed the file is committed.
+    '''
+    model.Session.execute(delete_queue_table.insert().values(
+        bucket=bucket_name, key=key, created=datetime.datetime.utcnow(),
+        attempts=0))
+
+
+def dequeue_delete(bucket_name, key):
+    '''Remove `key` from the delete queue, as it has been written again.'''
+    model.Session.execute(delete_queue_table.delete()
+                          .where(delete_queue_table.c.bucket == bucket_name)
+                          .where(delete_queue_table.c.key == key))
+
+
+def get_queued_deletes(limit, after_id=0, max_attempts=None):
+    '''Return up to `limit` (id, bucket, key) rows of the delete queue with
+    ids larger than `after_id`.'''
+    query = select([delete_queue_table.c.id,
+                    delete_queue_table.c.bucket,
+                    delete_queue_table.c.key]) \
+        .where(delete_queue_table.c.id > after_id) \
+        .order_by(delete_queue_table.c.id) \
+        .limit(limit)
+    if max_attempts:
+        query = query.where(delete_queue_table.c.attempts < max_attempts)
+    return model.Session.execute(query).fetchall()
+
+
+def remove_queued_deletes(ids):
+    if ids:
+        model.Session.execute(delete_queue_table.delete().where(
+            delete_queue_table.c.id.in_(ids)))
+
+
+def record_failed_delete(id, error):
+    model.Session.execute(
+        delete_queue_table.update()
+        .where(delete_queue_table.c.id == id)
+        .values(attempts=delete_queue_table.c.attempts + 1,
+                last_error=error))
+
+
+def get_resource_blob(resource_id):
+    '''Return the key of the blob `resource_id` points to, or None.'''
+    return model.Session.execute(
+        select([resource_blob_table.c.key])
+        .where(resource_blob_table.c.resource_id == resource_id)).scalar()
+
+
+def get_referenced_blobs(keys):
+    '''Return the keys among `keys` that some resource points to.
+
+    The rows of the blobs are locked until the session commits, so no
+    resource can point to the blobs that are not referenced in the
+    meantime.
+    '''
+    if not keys:
+        return set()
+    return set(key for key, refcount in model.Session.execute(
+        select([blob_table.c.key, blob_table.c.refcount])
+        .where(blob_table.c.key.in_(keys))
+        .with_for_update())
+        if refcount > 0)
+
+
+def remove_unreferenced_blobs(keys):
+    '''Remove the rows of the blobs among `keys` no resource points to,
+    once they have been deleted from S3.'''
+    if not keys:
+        return
+    model.Session.execute(
+        blob_table.delete()
+        .where(blob_table.c.key.in_(keys))
+        .where(blob_table.c.refcount <= 0))
+
+
+def _add_blob_reference(key, size):
+    result = model.Session.execute(
+        blob_table.update()
+        .where(blob_table.c.key == key)
+        .values(refcount=blob_table.c.refcount + 1))
+    if not result.rowcount:
+        model.Session.execute(blob_table.insert().values(
+            key=key, size=size, refcount=1,
+            created=datetime.datetime.utcnow()))
+
+
+def _remove_blob_reference(key):
+    refcount = model.Session.execute(
+        blob_table.update()
+        .where(blob_table.c.key == key)
+        .values(refcount=blob_table.c.refcount - 1)
+        .returning(blob_table.c.refcount)).scalar()
+    if refcount is not None and refcount <= 0:
+        # The row is kept until the blob is deleted from S3, as the lock
+        # that keeps resources from pointing to it again meanwhile
+        return key
+    return None
+
+
+def set_resource_blob(resource_id, key, size=None):
+    '''Point `resource_id` to the blob at `key`, updating the reference
+    counts.
+
+    Returns the key of the blob the resource pointed to before if nothing
+    points to it any more, so it can be removed from S3.
+    '''
+    old_key = get_resource_blob(resource_id)
+    if old_key == key:
+        return None
+    _add_blob_reference(key, size)
+    if old_key is None:
+        model.Session.execute(resource_blob_table.insert().values(
+            resource_id=resource_id, key=key))
+        return None
+    model.Session.execute(
+        resource_blob_table.update()
+        .where(resource_blob_table.c.resource_id == resource_id)
+        .values(key=key))
+    return _remove_blob_reference(old_key)
+
+
+def remove_resource_blob(resource_id):
+    '''Remove the blob reference of `resource_id`, if any.
+
+    Returns the key of the blob if nothing points to it any more.
+    '''
+    old_key = get_resource_blob(resource_id)
+    if old_key is None:
+        return None
+    model.Session.execute(resource_blob_table.delete().where(
+        resource_blob_table.c.resource_id == resource_id))
+    return _remove_blob_reference(old_key)
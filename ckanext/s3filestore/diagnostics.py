@@ -0,0 +1,170 @@
+'''
+Connection checks and latency benchmarks, used by `paster s3 check-config`
+and `paster s3 benchmark`.
+
+Both use the same client factory and settings as the uploaders, so they
+test what CKAN actually does. Point `ckanext.s3filestore.host_name` to a
+local moto server or MinIO instance to try settings before using them
+against the real bucket.
+'''
+import os
+import io
+import math
+import time
+import uuid
+import collections
+
+import botocore
+from boto3.s3.transfer import TransferConfig
+
+from ckanext.s3filestore import retry, settings
+from ckanext.s3filestore.uploader import (BaseS3Uploader,
+                                          S3FileStoreException,
+                                          MB)
+
+REQUIRED_OPTIONS = ('aws_access_key_id', 'aws_secret_access_key',
+                    'aws_bucket_name')
+
+Check = collections.namedtuple('Check', ['name', 'ok', 'message'])
+
+Throughput = collections.namedtuple(
+    'Throughput', ['part_size', 'concurrency', 'seconds', 'mb_per_second'])
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    '''Return a dict with the nearest-rank percentile of `samples` for each
+    of `points`.'''
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        if not ordered:
+            result[point] = None
+            continue
+        rank = int(math.ceil(point / 100.0 * len(ordered)))
+        result[point] = ordered[min(max(rank, 1), len(ordered)) - 1]
+    return result
+
+
+def _get_probe_key(name):
+    path = settings.get().aws_storage_path
+    return os.path.join(path, 'diagnostics', uuid.uuid4().hex, name)
+
+
+def check():
+    '''Check the configuration and the access to the bucket.
+
+    Returns a list of Check tuples, one per step. The checks stop at the
+    first step that fails.
+    '''
+    checks = []
+    try:
+        s3_settings = settings.get()
+    except ValueError as e:
+        checks.append(Check('config', False, str(e)))
+        return checks
+    missing = ['ckanext.s3filestore.' + name for name in REQUIRED_OPTIONS
+               if not getattr(s3_settings, name)]
+    if missing:
+        checks.append(Check('config', False, 'Missing options: {0}'.format(
+            ', '.join(missing))))
+        return checks
+    checks.append(Check('config', True, 'All required options set'))
+
+    upload = BaseS3Uploader()
+    try:
+        upload.check_bucket()
+    except (S3FileStoreException, botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError, retry.CircuitOpenError) as e:
+        checks.append(Check('bucket', False, str(e)))
+        return checks
+    client = upload.get_s3_client()
+    checks.append(Check(
+        'client', True, 'Endpoint {0}, region {1}, signature {2}'.format(
+            client.meta.endpoint_url, client.meta.region_name,
+            client.meta.config.signature_version or 'default')))
+
+    key = _get_probe_key('check.txt')
+    steps = (
+        ('bucket', lambda: client.head_bucket(Bucket=upload.bucket_name)),
+        ('put', lambda: client.put_object(Bucket=upload.bucket_name,
+                                          Key=key, Body=b'check')),
+        ('get', lambda: client.get_object(Bucket=upload.bucket_name,
+                                          Key=key)['Body'].read()),
+        ('presign', lambda: upload.get_signed_url(key)),
+        ('delete', lambda: client.delete_object(Bucket=upload.bucket_name,
+                                                Key=key)),
+    )
+    for name, step in steps:
+        try:
+            step()
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+                retry.CircuitOpenError) as e:
+            checks.append(Check(name, False, str(e)))
+            return checks
+        checks.append(Check(name, True, 'OK'))
+    return checks
+
+
+def _time(function):
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def benchmark_latency(upload, iterations=20, size=1024):
+    '''Time `iterations` HeadBucket, PUT, GET, presign and DELETE requests
+    with objects of `size` bytes.
+
+    Returns a dict with the list of durations (in seconds) of each
+    operation.
+    '''
+    client = upload.get_s3_client()
+    bucket_name = upload.bucket_name
+    body = os.urandom(size)
+    timings = collections.OrderedDict(
+        (name, []) for name in ('head_bucket', 'put', 'get', 'presign',
+                                'delete'))
+    for i in range(iterations):
+        key = _get_probe_key('latency-{0}'.format(i))
+        timings['head_bucket'].append(
+            _time(lambda: client.head_bucket(Bucket=bucket_name)))
+        timings['put'].append(_time(lambda: client.put_object(
+            Bucket=bucket_name, Key=key, Body=body)))
+        timings['get'].append(_time(lambda: client.get_object(
+            Bucket=bucket_name, Key=key)['Body'].read()))
+        # Bypass the url cache, signing is what is being measured
+        timings['presign'].append(
+            _time(lambda: upload._generate_signed_url(key, 60)))
+        timings['delete'].append(_time(lambda: client.delete_object(
+            Bucket=bucket_name, Key=key)))
+    return timings
+
+
+def benchmark_throughput(upload, size=64 * MB, part_sizes=(8 * MB, ),
+                         concurrencies=(4, )):
+    '''Upload a `size` bytes object with every combination of part size
+    and concurrency, as the uploaders do.
+
+    Returns a list of Throughput tuples.
+    '''
+    client = upload.get_s3_client()
+    # Random data, so compressing proxies don't skew the results
+    body = os.urandom(size)
+    results = []
+    for part_size in part_sizes:
+        for concurrency in concurrencies:
+            transfer_config = TransferConfig(
+                multipart_threshold=part_size,
+                multipart_chunksize=part_size,
+                max_concurrency=concurrency,
+                use_threads=concurrency > 1)
+            key = _get_probe_key('throughput')
+            seconds = _time(lambda: client.upload_fileobj(
+                io.BytesIO(body), upload.bucket_name, key,
+                Config=transfer_config))
+            client.delete_object(Bucket=upload.bucket_name, Key=key)
+            results.append(Throughput(
+                part_size, concurrency, seconds,
+                size / float(MB) / seconds if seconds else None))
+    return results
@@ -0,0 +1,306 @@
+'''
+Run large numbers of S3 operations concurrently, for the bulk commands.
+
+Migrations, purges and scans spend most of their time waiting on the
+latency of each request, not on bandwidth. `TransferEngine` runs them
+from a pool of threads sharing a single client with:
+
+* bounded concurrency: at most `concurrency` requests in flight, and only
+  a few times that many operations queued, so any number of items can
+  be fed to it from a generator
+* an optional rate limit, in requests per second
+* adaptive backoff: when S3 answers SlowDown or 503 the operation is
+  retried after an exponential delay with jitter, and the request rate
+  is halved, growing back again as requests succeed
+* while the circuit breaker of the endpoint (see `retry`) is open,
+  operations wait for it to let requests through again instead of
+  failing, up to `max_circuit_waits` times each
+
+The engine uses the bucket, credentials and connection settings of
+`BaseS3Uploader`, so keys can be built with the uploaders' helpers (e.g.
+`S3ResourceUploader.get_storage_path()`). Setting
+`ckanext.s3filestore.host_name` to a local `moto_server` is enough to
+try it without touching a real bucket.
+'''
+import time
+import random
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import botocore
+
+from ckanext.s3filestore import connection, metrics, retry
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+log = logging.getLogger(__name__)
+
+# The most keys a single DeleteObjects request accepts
+MAX_DELETE_KEYS = 1000
+
+# The result of an operation on `item`: either the value returned or the
+# exception raised once all the attempts failed
+Result = collections.namedtuple('Result', ['item', 'value', 'error'])
+
+
+def _error_code(error):
+    if not isinstance(error, botocore.exceptions.ClientError):
+        return None
+    return error.response.get('Error', {}).get('Code')
+
+
+def is_throttled(error):
+    '''Return True if `error` is S3 asking for fewer requests.'''
+    return retry.classify_error(error) == retry.THROTTLED
+
+
+def is_transient(error):
+    '''Return True if `error` is worth retrying.'''
+    return retry.classify_error(error) is not None
+
+
+def upload_path(client, path, bucket_name, key, extra_args=None,
+                config=None):
+    '''Upload the file at `path` to `key`.
+
+    Unlike `client.upload_file`, which wraps them all in
+    S3UploadFailedError, the botocore errors are raised as they are, so
+    throttling and transient errors can be told apart and retried.
+    '''
+    with open(path, 'rb') as f:
+        client.upload_fileobj(f, bucket_name, key, ExtraArgs=extra_args,
+                              Config=config)
+
+
+class RateLimiter(object):
+    '''Spaces requests out to `rate` per second, adapting the rate to the
+    responses.
+
+    Each throttled request halves the rate, down to `min_rate`, and each
+    successful one adds `recovery` to it, so it grows by about
+    `recovery * 100`% per second, up to the configured rate. With no rate
+    requests are not limited until the first one is throttled, and the
+    rate measured over the last second is halved then.
+    '''
+
+    def __init__(self, rate=None, min_rate=1.0, recovery=0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self._lock = threading.Lock()
+        self._next = 0.0
+        self._window_start = time.time()
+        self._window_count = 0
+        self._measured = None
+
+    def acquire(self):
+        '''Wait until the next request can be sent.'''
+        with self._lock:
+            now = time.time()
+            self._window_count += 1
+            elapsed = now - self._window_start
+            if elapsed >= 1:
+                self._measured = self._window_count / elapsed
+                self._window_start = now
+                self._window_count = 0
+            if not self.rate:
+                return
+            delay = self._next - now
+            self._next = max(now, self._next) + 1.0 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self._lock:
+            rate = self.rate or self._measured or self.min_rate * 2
+            self.rate = max(self.min_rate, rate / 2.0)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate:
+                self.rate += self.recovery
+                if self.max_rate:
+                    self.rate = min(self.rate, self.max_rate)
+
+
+class TransferEngine(object):
+    '''Runs S3 operations with up to `concurrency` requests at a time.
+
+    `rate` limits the requests per second, and each operation is tried up
+    to `max_attempts` times if it fails with a transient error, waiting
+    between `base_delay` and `max_delay` seconds before trying again.
+    Operations refused by an open circuit breaker wait for it up to
+    `max_circuit_waits` times, without using up their attempts.
+    '''
+
+    def __init__(self, concurrency=64, rate=None, max_attempts=8,
+                 base_delay=0.1, max_delay=20, uploader=None,
+                 max_circuit_waits=10):
+        self.uploader = uploader or BaseS3Uploader()
+        self.bucket_name = self.uploader.bucket_name
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_circuit_waits = max_circuit_waits
+        self.limiter = RateLimiter(rate)
+        # The engine retries and backs off itself, so botocore doesn't
+        self.client = connection.get_client(
+            self.uploader.p_key, self.uploader.s_key, self.uploader.region,
+            endpoint_url=self.uploader.host_name,
+            signature_version=self.uploader.signature,
+            max_pool_connections=concurrency, retry_max_attempts=0)
+
+    def _delay(self, attempt):
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _wait_for_circuit(self):
+        breaker = retry.get_breaker(self.client.meta.endpoint_url)
+        # Only one request at a time is let through once the breaker
+        # resets, so the others wait at least a second before trying again
+        time.sleep(max(breaker.retry_after(), 1.0) * random.uniform(1, 1.5))
+
+    def call(self, function, item):
+        '''Return the Result of `function(client, item)`, retrying it on
+        transient errors.'''
+        attempt = 0
+        circuit_waits = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                value = function(self.client, item)
+            except retry.CircuitOpenError as e:
+                circuit_waits += 1
+                if circuit_waits > self.max_circuit_waits:
+                    return Result(item, None, e)
+                metrics.incr('engine_circuit_waits')
+                self._wait_for_circuit()
+            except Exception as e:
+                attempt += 1
+                if not is_transient(e) or attempt >= self.max_attempts:
+                    return Result(item, None, e)
+                if is_throttled(e):
+                    self.limiter.throttled()
+                    metrics.incr('engine_throttled')
+                metrics.incr('engine_retries')
+                log.debug('Retrying {0} after {1}'.format(item, str(e)))
+                time.sleep(self._delay(attempt))
+            else:
+                self.limiter.succeeded()
+                return Result(item, value, None)
+
+    def run(self, function, items):
+        '''Call `function(client, item)` for each of `items` and yield
+        their Results, in the order they complete.'''
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = set()
+        try:
+            for item in items:
+                pending.add(executor.submit(self.call, function, item))
+                # Don't read more items than needed to keep threads busy
+                if len(pending) >= self.concurrency * 4:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def head(self, keys):
+        '''Yield a Result for each of `keys` with its HeadObject response,
+        or None if it doesn't exist.'''
+        bucket_name = self.bucket_name
+
+        def head(client, key):
+            try:
+                return client.head_object(Bucket=bucket_name, Key=key)
+            except botocore.exceptions.ClientError as e:
+                if _error_code(e) in ('404', 'NoSuchKey'):
+                    return None
+                raise
+        return self.run(head, keys)
+
+    def put(self, files, extra_args=None):
+        '''Upload each (key, path) of `files`, yielding a Result for each
+        with the key as item.'''
+        bucket_name = self.bucket_name
+        transfer_config = self.uploader.get_transfer_config()
+
+        def put(client, item):
+            key, path = item
+            upload_path(client, path, bucket_name, key,
+                        extra_args=extra_args, config=transfer_config)
+            return key
+        for result in self.run(put, files):
+            yield result._replace(item=result.item[0])
+
+    def copy(self, pairs, extra_args=None):
+        '''Copy each (source key, key) of `pairs` within the bucket,
+        yielding a Result for each with the new key as item.'''
+        bucket_name = self.bucket_name
+        transfer_config = self.uploader.get_transfer_config()
+
+        def copy(client, item):
+            source, key = item
+            client.copy({'Bucket': bucket_name, 'Key': source},
+                        bucket_name, key, ExtraArgs=extra_args,
+                        Config=transfer_config)
+            return key
+        for result in self.run(copy, pairs):
+            yield result._replace(item=result.item[1])
+
+    def list_prefixes(self, prefixes):
+        '''Yield a Result for each of `prefixes` with the list of keys
+        under it.'''
+        bucket_name = self.bucket_name
+
+        def list_keys(client, prefix):
+            keys = []
+            paginator = client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name,
+                                           Prefix=prefix):
+                keys.extend(obj['Key'] for obj in page.get('Contents', []))
+            return keys
+        return self.run(list_keys, prefixes)
+
+    def delete(self, keys):
+        '''Delete `keys` with DeleteObjects requests of up to 1000 keys,
+        yielding a Result for each key, with the error as a string if it
+        could not be deleted.'''
+        bucket_name = self.bucket_name
+
+        def delete(client, batch):
+            response = client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True})
+            return dict((error['Key'], '{0}: {1}'.format(
+                error.get('Code'), error.get('Message')))
+                for error in response.get('Errors', []))
+
+        for result in self.run(delete, _batches(keys, MAX_DELETE_KEYS)):
+            for key in result.item:
+                if result.error is not None:
+                    yield Result(key, None, str(result.error))
+                else:
+                    yield Result(key, key, result.value.get(key))
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,221 @@
+'''
+A bounded cache of small S3 objects on the local disk.
+
+Used to serve uploaded files (e.g. group images and user avatars) directly
+instead of redirecting every request to S3. Objects are fetched on a miss,
+revalidated against their ETag once they get old, and the least recently
+used files are removed once the cache grows over its maximum size.
+
+Only the first bytes of an object are requested, so finding out that a
+file is too large to be cached doesn't download it, and keys that were
+too large are remembered until they need revalidating.
+'''
+import os
+import json
+import time
+import errno
+import hashlib
+import logging
+import calendar
+import tempfile
+import threading
+import email.utils
+
+import botocore
+
+from ckanext.s3filestore import settings
+
+log = logging.getLogger(__name__)
+
+_file_cache = None
+_file_cache_lock = threading.Lock()
+
+
+def get_file_cache():
+    '''Return the shared FileCache, or None if it isn't enabled.
+
+    Enabled by setting `ckanext.s3filestore.local_cache_dir`. Other options:
+
+        ckanext.s3filestore.local_cache_max_size (bytes, default 100MB)
+        ckanext.s3filestore.local_cache_max_file_size (bytes, default 1MB)
+        ckanext.s3filestore.local_cache_revalidate (seconds, default 300)
+    '''
+    global _file_cache
+    s3_settings = settings.get()
+    directory = s3_settings.local_cache_dir
+    if not directory:
+        return None
+    if _file_cache is None or _file_cache.directory != directory:
+        with _file_cache_lock:
+            if _file_cache is None or _file_cache.directory != directory:
+                _file_cache = FileCache(
+                    directory,
+                    max_size=s3_settings.local_cache_max_size,
+                    max_file_size=s3_settings.local_cache_max_file_size,
+                    revalidate=s3_settings.local_cache_revalidate)
+    return _file_cache
+
+
+def _get_total_size(obj):
+    '''Return the size of the whole object a ranged GetObject response is
+    part of.'''
+    content_range = obj.get('ContentRange')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+    return obj['ContentLength']
+
+
+class FileCache(object):
+
+    def __init__(self, directory, max_size, max_file_size, revalidate):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.revalidate = revalidate
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get_path(self, key):
+        '''Return the path of the cached copy of `key`.'''
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, client, bucket_name, key):
+        '''Return the metadata of the cached copy of `key`, fetching it from
+        S3 if needed.
+
+        The metadata is a dict with the `path` of the cached file, its
+        `etag`, `last_modified` (as an HTTP date), `modified` (as a
+        timestamp), `content_type` and `size`. Returns None if the object
+        doesn't exist or is too large to be cached.
+        '''
+        path = self.get_path(key)
+        entry = self._read_entry(path)
+        now = time.time()
+        if entry and now - entry['checked'] < self.revalidate:
+            if entry.get('too_large'):
+                return None
+            self._touch(path)
+            return entry
+
+        get_args = {'Bucket': bucket_name, 'Key': key,
+                    'Range': 'bytes=0-{0}'.format(self.max_file_size)}
+        if entry:
+            get_args['IfNoneMatch'] = entry['etag']
+        try:
+            obj = self._get_object(client, get_args)
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response['Error']['Code']
+            if entry and error_code in ('304', 'NotModified'):
+                entry['checked'] = now
+                self._write_entry(path, entry)
+                if entry.get('too_large'):
+                    return None
+                self._touch(path)
+                return entry
+            if error_code in ('404', 'NoSuchKey'):
+                self._remove(path)
+                return None
+            raise
+
+        if _get_total_size(obj) > self.max_file_size:
+            obj['Body'].close()
+            self._remove(path)
+            self._write_entry(path, {'key': key, 'etag': obj['ETag'],
+                                     'checked': now, 'too_large': True})
+            return None
+
+        last_modified = calendar.timegm(obj['LastModified'].utctimetuple())
+        entry = {
+            'key': key,
+            'path': path,
+            'etag': obj['ETag'],
+            'modified': last_modified,
+            'last_modified': email.utils.formatdate(last_modified,
+                                                    usegmt=True),
+            'content_type': obj.get('ContentType'),
+            'size': obj['ContentLength'],
+            'checked': now,
+        }
+        self._write_file(path, obj['Body'])
+        self._write_entry(path, entry)
+        self.evict()
+        return entry
+
+    def _get_object(self, client, get_args):
+        try:
+            return client.get_object(**get_args)
+        except botocore.exceptions.ClientError as e:
+            # Empty objects have no bytes to return a range of
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+        get_args = dict(get_args)
+        del get_args['Range']
+        return client.get_object(**get_args)
+
+    def evict(self):
+        '''Remove the least recently used files until the cache is under its
+        maximum size.'''
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') or name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        files.sort()
+        while files and total > self.max_size:
+            mtime, size, name = files.pop(0)
+            self._remove(os.path.join(self.directory, name))
+            total -= size
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _read_entry(self, path):
+        try:
+            with open(path + '.json') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not entry.get('too_large') and not os.path.exists(path):
+            return None
+        return entry
+
+    def _write_entry(self, path, entry):
+        self._write_atomic(path + '.json', [json.dumps(entry)])
+
+    def _write_file(self, path, body):
+        self._write_atomic(path, iter(lambda: body.read(64 * 1024), b''))
+
+    def _write_atomic(self, path, chunks):
+        # Write to a temporary file first so other threads and processes
+        # never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.rename(tmp_path, path)
+        except Exception:
+            self._remove(tmp_path)
+            raise
+
+    def _remove(self, path):
+        for p in (path, path + '.json'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
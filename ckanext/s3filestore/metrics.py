@@ -0,0 +1,317 @@
+'''
+Metrics for the S3 operations.
+
+Enabled by setting `ckanext.s3filestore.metrics` to one of:
+
+    statsd
+        Send them to StatsD, at `ckanext.s3filestore.statsd_host` (default
+        localhost) and `ckanext.s3filestore.statsd_port` (default 8125)
+    prometheus
+        Keep them in each process and serve them in the Prometheus text
+        format at /s3filestore/metrics. If
+        `ckanext.s3filestore.metrics_token` is set, requests need an
+        `Authorization: Bearer <token>` header.
+    <module>:<class>
+        Use a custom emitter, with the same methods as `Emitter`
+
+Metric names start with `ckanext.s3filestore.metrics_prefix` (default
+s3filestore). Every request made with the shared clients is counted and
+timed by S3 operation:
+
+    requests        requests by operation and HTTP status
+    request         request latency by operation, including retries
+    errors          errors by operation and code (e.g. NoSuchKey, 403,
+                    SlowDown or the exception name for connection errors)
+    retries         retry attempts by operation
+    bytes_sent      request body bytes by operation
+    bytes_received  response body bytes by operation
+    pool_full       connections discarded because the pool was full
+
+The uploaders and the download controller add the latency of presigning
+(`presign`), whole uploads (`upload`) and downloads (`download`, by mode).
+'''
+import re
+import time
+import socket
+import logging
+import threading
+import contextlib
+
+from ckanext.s3filestore import settings
+
+log = logging.getLogger(__name__)
+
+_emitter = None
+_lock = threading.Lock()
+
+
+class Emitter(object):
+    '''Base emitter, which discards everything.'''
+
+    def incr(self, name, value=1, **labels):
+        pass
+
+    def timing(self, name, seconds, **labels):
+        pass
+
+
+class StatsdEmitter(Emitter):
+    '''Sends the metrics to StatsD over UDP.
+
+    Label values are appended to the metric name, e.g.
+    s3filestore.errors.GetObject.NoSuchKey.
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='s3filestore'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        parts = [re.sub(r'[^\w-]', '_', part) for part in
+                 [name] + [str(labels[key]) for key in sorted(labels)]]
+        if self.prefix:
+            parts.insert(0, self.prefix)
+        return '.'.join(parts)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error as e:
+            log.debug('Could not send metric: {0}'.format(str(e)))
+
+    def incr(self, name, value=1, **labels):
+        self._send('{0}:{1}|c'.format(self._name(name, labels), value))
+
+    def timing(self, name, seconds, **labels):
+        self._send('{0}:{1:.3f}|ms'.format(self._name(name, labels),
+                                           seconds * 1000))
+
+
+class PrometheusEmitter(Emitter):
+    '''Keeps counters and latency histograms in memory and renders them in
+    the Prometheus text format.
+
+    Each process has its own values, so with several workers every one of
+    them has to be scraped, or a single worker used for the endpoint.
+    '''
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, 30.0, 60.0)
+
+    def __init__(self, prefix='s3filestore'):
+        self.prefix = re.sub(r'\W', '_', prefix)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def timing(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = \
+                    [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                               .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels) + '}'
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, ([count for count in value[0]], value[1], value[2]))
+                for key, value in self._histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = '{0}_{1}_total'.format(self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE {0} counter'.format(metric))
+            lines.append('{0}{1} {2}'.format(metric, self._labels(labels),
+                                             value))
+        for (name, labels), (buckets, total, count) in histograms:
+            metric = '{0}_{1}_seconds'.format(self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE {0} histogram'.format(metric))
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append('{0}_bucket{1} {2}'.format(
+                    metric, self._labels(labels, [('le', repr(bound))]),
+                    bucket_count))
+            lines.append('{0}_bucket{1} {2}'.format(
+                metric, self._labels(labels, [('le', '+Inf')]), count))
+            lines.append('{0}_sum{1} {2}'.format(
+                metric, self._labels(labels), repr(total)))
+            lines.append('{0}_count{1} {2}'.format(
+                metric, self._labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _create_emitter():
+    s3_settings = settings.get()
+    backend = s3_settings.metrics
+    prefix = s3_settings.metrics_prefix
+    if not backend:
+        return None
+    if backend == 'statsd':
+        return StatsdEmitter(host=s3_settings.statsd_host,
+                             port=s3_settings.statsd_port, prefix=prefix)
+    if backend == 'prometheus':
+        return PrometheusEmitter(prefix=prefix)
+    module_name, __, class_name = backend.partition(':')
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)()
+
+
+def get_emitter():
+    '''Return the configured emitter, or None if metrics are disabled.'''
+    global _emitter
+    if _emitter is None:
+        with _lock:
+            if _emitter is None:
+                _emitter = _create_emitter() or Emitter()
+    if type(_emitter) is Emitter:
+        return None
+    return _emitter
+
+
+def reset():
+    '''Drop the emitter, so it is created again from the current
+    configuration.'''
+    global _emitter
+    with _lock:
+        _emitter = None
+
+
+def incr(name, value=1, **labels):
+    emitter = get_emitter()
+    if emitter is not None:
+        emitter.incr(name, value, **labels)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    '''Time the block and report it as `name`, if metrics are enabled.'''
+    emitter = get_emitter()
+    start = time.time()
+    try:
+        yield
+    finally:
+        if emitter is not None:
+            emitter.timing(name, time.time() - start, **labels)
+
+
+def _get_body_size(body):
+    if body is None:
+        return 0
+    if hasattr(body, '__len__'):
+        return len(body)
+    try:
+        position = body.tell()
+        body.seek(0, 2)
+        size = body.tell() - position
+        body.seek(position)
+        return size
+    except (AttributeError, IOError, OSError):
+        return None
+
+
+def _before_call(model, params, context, **kwargs):
+    try:
+        context['s3filestore_metrics'] = {
+            'operation': model.name,
+            'start': time.time(),
+            'sent': _get_body_size(params.get('body')),
+        }
+    except Exception as e:
+        log.debug('Could not record the S3 request: {0}'.format(str(e)))
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    emitter = get_emitter()
+    call = context.get('s3filestore_metrics')
+    if emitter is None or call is None:
+        return
+    try:
+        operation = call['operation']
+        emitter.incr('requests', operation=operation,
+                     status=http_response.status_code)
+        emitter.timing('request', time.time() - call['start'],
+                       operation=operation)
+        error_code = (parsed.get('Error') or {}).get('Code')
+        if error_code:
+            emitter.incr('errors', operation=operation, code=error_code)
+        retries = (parsed.get('ResponseMetadata') or {}) \
+            .get('RetryAttempts')
+        if retries:
+            emitter.incr('retries', retries, operation=operation)
+        if call['sent']:
+            emitter.incr('bytes_sent', call['sent'], operation=operation)
+        if operation == 'GetObject' and parsed.get('ContentLength'):
+            emitter.incr('bytes_received', parsed['ContentLength'],
+                         operation=operation)
+    except Exception as e:
+        log.debug('Could not record the S3 request: {0}'.format(str(e)))
+
+
+def _after_call_error(exception, context, **kwargs):
+    emitter = get_emitter()
+    call = context.get('s3filestore_metrics')
+    if emitter is None or call is None:
+        return
+    emitter.incr('errors', operation=call['operation'],
+                 code=type(exception).__name__)
+    emitter.timing('request', time.time() - call['start'],
+                   operation=call['operation'])
+
+
+class _PoolFullHandler(logging.Handler):
+    '''Counts the connections urllib3 discards when its pool is full.'''
+
+    def emit(self, record):
+        if 'Connection pool is full' in record.getMessage():
+            incr('pool_full')
+
+
+_pool_full_handler = None
+
+
+def register_client(client):
+    '''Record the metrics of the requests made with `client`, if metrics
+    are enabled.'''
+    global _pool_full_handler
+    if get_emitter() is None:
+        return
+    events = client.meta.events
+    events.register('before-call.s3', _before_call,
+                    unique_id='s3filestore-metrics-before-call')
+    events.register('after-call.s3', _after_call,
+                    unique_id='s3filestore-metrics-after-call')
+    events.register('after-call-error.s3', _after_call_error,
+                    unique_id='s3filestore-metrics-after-call-error')
+    with _lock:
+        if _pool_full_handler is None:
+            _pool_full_handler = _PoolFullHandler(logging.WARNING)
+            for name in ('urllib3.connectionpool',
+                         'botocore.vendored.requests.packages.urllib3'
+                         '.connectionpool'):
+                logging.getLogger(name).addHandler(_pool_full_handler)
@@ -0,0 +1,240 @@
+'''
+Copy the files of a local CKAN FileStore to S3.
+
+Files are uploaded concurrently by a `TransferEngine`, with the same
+transfer settings as the uploaders. Files whose size and ETag already
+match the object on S3 are skipped, and the files that are done can be
+recorded in a checkpoint file so an interrupted migration carries on
+where it stopped.
+'''
+import os
+import hashlib
+import logging
+import mimetypes
+import threading
+import collections
+
+import botocore
+from s3transfer.utils import ChunksizeAdjuster
+
+import ckan.model as model
+
+from ckanext.s3filestore.engine import TransferEngine, upload_path
+from ckanext.s3filestore.uploader import (BaseS3Uploader,
+                                          S3Uploader,
+                                          S3ResourceUploader)
+
+log = logging.getLogger(__name__)
+
+MigrationItem = collections.namedtuple(
+    'MigrationItem', ['name', 'path', 'key', 'content_type', 'public'])
+
+
+class Checkpoint(object):
+    '''The names of the files already migrated, stored one per line in
+    `path`.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._done.update(line.strip() for line in f if line.strip())
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, name):
+        with self._lock:
+            self._done.add(name)
+            self._file.write(name + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def get_local_etag(path, size, transfer_config):
+    '''Return the ETag S3 would give to `path` if uploaded with
+    `transfer_config`.'''
+    block_size = 1024 * 1024
+    with open(path, 'rb') as f:
+        if size < transfer_config.multipart_threshold:
+            md5 = hashlib.md5()
+            for data in iter(lambda: f.read(block_size), b''):
+                md5.update(data)
+            return '"{0}"'.format(md5.hexdigest())
+
+        chunksize = ChunksizeAdjuster().adjust_chunksize(
+            transfer_config.multipart_chunksize, size)
+        digests = []
+        for data in iter(lambda: f.read(chunksize), b''):
+            digests.append(hashlib.md5(data).digest())
+    return '"{0}-{1}"'.format(hashlib.md5(b''.join(digests)).hexdigest(),
+                              len(digests))
+
+
+class Migration(object):
+    '''Upload `MigrationItem`s to S3 with up to `workers` requests at a
+    time, and at most `rate` requests per second if given.
+
+    `progress`, if given, is called with each item and its status
+    (`uploaded`, `skipped` or `failed`) once it has been processed.
+    '''
+
+    def __init__(self, workers=8, checkpoint=None, progress=None, rate=None):
+        self.uploader = BaseS3Uploader()
+        self.uploader.check_bucket()
+        self.engine = TransferEngine(concurrency=workers, rate=rate,
+                                     uploader=self.uploader)
+        self.transfer_config = self.uploader.get_transfer_config()
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.stats = collections.Counter()
+
+    def run(self, items):
+        '''Migrate all `items` and return a Counter of the statuses.'''
+        for result in self.engine.run(self.migrate, self._pending(items)):
+            item, status = result.item, result.value
+            if result.error is not None:
+                log.error('Could not migrate {0} to {1}: {2}'.format(
+                    item.path, item.key, str(result.error)))
+                status = 'failed'
+            self.stats[status] += 1
+            if status != 'failed' and self.checkpoint is not None:
+                self.checkpoint.add(item.name)
+            if self.progress:
+                self.progress(item, status)
+        return self.stats
+
+    def _pending(self, items):
+        for item in items:
+            if self.checkpoint is not None and item.name in self.checkpoint:
+                self.stats['resumed'] += 1
+                continue
+            yield item
+
+    def migrate(self, client, item):
+        '''Upload a single item, unless an identical object exists.'''
+        size = os.path.getsize(item.path)
+        if self.is_uploaded(client, item, size):
+            return 'skipped'
+        extra_args = {'ACL': 'public-read' if item.public else 'private'}
+        if item.content_type:
+            extra_args['ContentType'] = item.content_type
+        upload_path(client, item.path, self.uploader.bucket_name, item.key,
+                    extra_args=extra_args, config=self.transfer_config)
+        return 'uploaded'
+
+    def is_uploaded(self, client, item, size):
+        try:
+            head = client.head_object(Bucket=self.uploader.bucket_name,
+                                      Key=item.key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return (head['ContentLength'] == size and
+                head['ETag'] == get_local_etag(item.path, size,
+                                               self.transfer_config))
+
+
+def _walk_resource_files(storage_path):
+    '''Yield the (resource id, path) of every file in a local FileStore.
+
+    CKAN stores resource files as
+    <ckan.storage_path>/resources/<id[0:3]>/<id[3:6]>/<id[6:]>
+    '''
+    base = os.path.join(storage_path, 'resources')
+    for root, dirs, files in os.walk(base):
+        for name in files:
+            path = os.path.join(root, name)
+            resource_id = ''.join(os.path.relpath(path, base).split(os.sep))
+            yield resource_id, path
+
+
+def _get_resource_items(paths):
+    '''Look up the uploaded resources for a batch of {id: path} with a single
+    query.
+
+    Files get the same ACL the resource uploader would give them, so only
+    the files of public datasets are public-read, and only with the `auto`
+    download strategy.
+    '''
+    upload = S3ResourceUploader({})
+    storage_path = upload.get_storage_path()
+    may_be_public = (upload.get_download_strategy() == 'auto' and
+                     not upload.content_addressed)
+    query = model.Session.query(
+        model.Resource.id, model.Resource.url, model.Resource.mimetype,
+        model.Package.private) \
+        .join(model.Package, model.Package.id == model.Resource.package_id) \
+        .filter(model.Resource.id.in_(paths.keys())) \
+        .filter(model.Resource.url_type == 'upload')
+    for resource_id, url, mimetype, private in query:
+        if not url:
+            continue
+        filename = url.rsplit('/', 1)[-1]
+        yield MigrationItem(
+            name=resource_id,
+            path=paths[resource_id],
+            key=os.path.join(storage_path, resource_id, filename),
+            content_type=mimetype or mimetypes.guess_type(filename)[0],
+            public=may_be_public and not private)
+
+
+def iter_resource_items(storage_path, batch_size=1000):
+    '''Yield a MigrationItem for each file in the local FileStore at
+    `storage_path` that belongs to an uploaded resource.'''
+    batch = {}
+    for resource_id, path in _walk_resource_files(storage_path):
+        batch[resource_id] = path
+        if len(batch) >= batch_size:
+            for item in _get_resource_items(batch):
+                yield item
+            batch = {}
+    if batch:
+        for item in _get_resource_items(batch):
+            yield item
+
+
+def _get_image_urls():
+    '''Yield the (upload_to, filename) of the uploaded group, organization
+    and user images.'''
+    for upload_to, image_url in (('group', model.Group.image_url),
+                                 ('user', model.User.image_url)):
+        query = model.Session.query(image_url) \
+            .filter(image_url != None) \
+            .filter(image_url != '') \
+            .filter(~image_url.startswith('http')) \
+            .distinct()
+        for (filename, ) in query:
+            yield upload_to, filename
+
+
+def iter_upload_items(storage_path):
+    '''Yield a MigrationItem for each group, organization and user image
+    in the local FileStore at `storage_path`.
+
+    CKAN stores these as
+    <ckan.storage_path>/storage/uploads/<upload_to>/<filename>, where
+    upload_to is `group` for groups and organizations and `user` for users.
+    '''
+    for upload_to, filename in _get_image_urls():
+        path = os.path.join(storage_path, 'storage', 'uploads', upload_to,
+                            filename)
+        if not os.path.isfile(path):
+            continue
+        yield MigrationItem(
+            name=os.path.join(upload_to, filename),
+            path=path,
+            key=os.path.join(S3Uploader.get_storage_path(upload_to),
+                             filename),
+            content_type=mimetypes.guess_type(filename)[0],
+            public=True)
@@ -1,8 +1,18 @@
+import logging
+
 from routes.mapper import SubMapper
 import ckan.plugins as plugins
 import ckantoolkit as toolkit
 
+import ckanext.s3filestore.action
+import ckanext.s3filestore.auth
+import ckanext.s3filestore.bulk
+import ckanext.s3filestore.connection
+import ckanext.s3filestore.settings
 import ckanext.s3filestore.uploader
+import ckanext.s3filestore.urls
+
+log = logging.getLogger(__name__)
 
 
 class S3FileStorePlugin(plugins.SingletonPlugin):
@@ -10,6 +20,10 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IUploader)
     plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
 
     # IConfigurer
 
@@ -34,12 +48,26 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
             if not config.get(option, None):
                 raise RuntimeError(missing_config.format(option))
 
+        # Parse the options once, the rest of the extension uses these
+        try:
+            settings = ckanext.s3filestore.settings.load(config)
+        except ValueError as e:
+            raise RuntimeError(str(e))
+
+        # Drop any clients created with a previous configuration
+        ckanext.s3filestore.connection.reset()
+
+        # Read the CloudFront key now, so a wrong one fails at startup
+        ckanext.s3filestore.urls.reset()
+        try:
+            ckanext.s3filestore.urls.get_cloudfront_signer()
+        except (IOError, ValueError) as e:
+            raise RuntimeError('Could not load the CloudFront private key: '
+                               '{0}'.format(str(e)))
+
         # Check that options actually work, if not exceptions will be raised
-        if toolkit.asbool(
-                config.get('ckanext.s3filestore.check_access_on_startup',
-                           True)):
-            ckanext.s3filestore.uploader.BaseS3Uploader().get_s3_bucket(
-                config.get('ckanext.s3filestore.aws_bucket_name'))
+        if settings.check_access_on_startup:
+            ckanext.s3filestore.uploader.BaseS3Uploader().check_bucket()
 
     # IUploader
 
@@ -52,6 +80,69 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         return ckanext.s3filestore.uploader.S3Uploader(upload_to,
                                                        old_filename)
 
+    # IActions
+
+    def get_actions(self):
+        return ckanext.s3filestore.action.get_actions()
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return ckanext.s3filestore.auth.get_auth_functions()
+
+    # IResourceController
+
+    def before_delete(self, context, resource, resources):
+        if self._delete_files_enabled():
+            context.setdefault('s3filestore_deleted_resources', []).append(
+                resource['id'])
+
+    # IResourceController and IPackageController
+
+    def after_delete(self, context, data):
+        '''Remove the files of deleted resources and datasets from S3.
+
+        IResourceController calls this with the remaining resources of the
+        dataset, IPackageController with the dict of the deleted dataset.
+        '''
+        if not self._delete_files_enabled():
+            return
+        ids = context.pop('s3filestore_deleted_resources', [])
+        if isinstance(data, dict) and data.get('id'):
+            ids.append(data['id'])
+        resource_ids = ckanext.s3filestore.bulk.get_upload_resource_ids(ids)
+        if not resource_ids:
+            return
+        # Files are only removed once the delete is committed
+        ckanext.s3filestore.bulk.remove_resource_files_on_commit(
+            resource_ids)
+
+    # IPackageController
+
+    def after_update(self, context, data):
+        '''Keep the ACLs of the resource files in line with the visibility
+        of their dataset, with the `auto` download strategy.
+
+        Only done when the visibility changed, as recorded in the context
+        by the chained package_update action. Also called by
+        IResourceController with a resource dict, which is ignored.
+        '''
+        if not isinstance(data, dict) or 'private' not in data:
+            return
+        was_private = context.pop('s3filestore_was_private', None)
+        if was_private is not None and \
+                was_private == toolkit.asbool(data['private']):
+            return
+        try:
+            ckanext.s3filestore.bulk.update_package_acls(
+                data['id'], changed=was_private is not None)
+        except Exception as e:
+            log.error('Could not update the ACLs of the files of dataset '
+                      '{0}: {1}'.format(data.get('id'), str(e)))
+
+    def _delete_files_enabled(self):
+        return ckanext.s3filestore.settings.get().delete_files_on_delete
+
     # IRoutes
 
     def before_map(self, map):
@@ -73,4 +164,7 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
             m.connect('uploaded_file', '/uploads/{upload_to}/{filename}',
                       action='uploaded_file_redirect')
 
+            m.connect('s3filestore_metrics', '/s3filestore/metrics',
+                      action='prometheus_metrics')
+
         return map
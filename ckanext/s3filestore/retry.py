@@ -0,0 +1,344 @@
+'''
+Retries and a circuit breaker for the requests made to S3.
+
+Every client from `connection` has botocore's retry handler replaced by a
+`RetryPolicy`, unless `ckanext.s3filestore.retry_mode` is set, in which
+case botocore's own standard or adaptive retries are used:
+
+* errors are retried up to `ckanext.s3filestore.retry_max_attempts` times
+  (default 4), after a random delay of up to
+  `ckanext.s3filestore.retry_base_delay` seconds (default 0.1), doubled
+  on each attempt and capped at `ckanext.s3filestore.retry_max_delay`
+  (default 20)
+* S3 asking to slow down (SlowDown, 503) uses
+  `ckanext.s3filestore.retry_throttle_delay` (default 1) as the base
+  delay instead
+* retries take tokens from a budget of
+  `ckanext.s3filestore.retry_budget` (default 500) shared by the
+  requests to each endpoint, 5 per retry or 10 after a timeout, and
+  requests that succeed put one back. When a store is failing, the budget
+  runs out and requests fail straight away instead of multiplying the load
+
+The circuit breaker opens after
+`ckanext.s3filestore.circuit_breaker_threshold` (default 5, 0 to disable)
+requests in a row fail with a server or connection error. Throttled
+requests (SlowDown, 503) don't count, as the store is up and only asking
+for fewer requests. While open, the
+requests to that endpoint raise `CircuitOpenError` without being sent,
+so workers are not blocked on a store that is down, and the download
+controller can use the filesystem fallback. After
+`ckanext.s3filestore.circuit_breaker_reset` seconds (default 30) one
+request is let through, and the breaker closes again if it succeeds.
+'''
+import time
+import random
+import logging
+import threading
+
+import botocore
+
+from ckanext.s3filestore import metrics, settings
+
+log = logging.getLogger(__name__)
+
+# Error codes S3 (and compatible stores) use to ask clients to slow down
+THROTTLE_CODES = ('SlowDown', 'Throttling', 'ThrottlingException',
+                  'RequestLimitExceeded', 'TooManyRequests',
+                  'ServiceUnavailable', '503')
+
+# Other error codes worth retrying
+TRANSIENT_CODES = ('InternalError', 'RequestTimeout', '500')
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+TIMEOUT = 'timeout'
+
+# Tokens taken from the retry budget
+RETRY_COST = 5
+TIMEOUT_RETRY_COST = 10
+
+_lock = threading.Lock()
+_budgets = {}
+_breakers = {}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def _classify(code, status):
+    if code in THROTTLE_CODES or status in (429, 503):
+        return THROTTLED
+    if code in TRANSIENT_CODES or (status and status >= 500):
+        return TRANSIENT
+    return None
+
+
+def _classify_exception(exception):
+    if isinstance(exception, botocore.exceptions.ReadTimeoutError):
+        return TIMEOUT
+    if isinstance(exception, botocore.exceptions.ConnectionError):
+        return TRANSIENT
+    return None
+
+
+def classify_error(error):
+    '''Return THROTTLED, TRANSIENT or TIMEOUT for errors worth retrying,
+    and None for the rest.'''
+    if isinstance(error, botocore.exceptions.ClientError):
+        return _classify(
+            error.response.get('Error', {}).get('Code'),
+            error.response.get('ResponseMetadata', {}).get('HTTPStatusCode'))
+    return _classify_exception(error)
+
+
+def classify_response(response=None, caught_exception=None):
+    '''Like `classify_error`, for the arguments of botocore's needs-retry
+    event.'''
+    if caught_exception is not None:
+        return _classify_exception(caught_exception)
+    if response is None:
+        return None
+    http_response, parsed = response
+    return _classify((parsed or {}).get('Error', {}).get('Code'),
+                     http_response.status_code)
+
+
+class RetryBudget(object):
+    '''A token bucket of `capacity` tokens that retries are taken from.'''
+
+    def __init__(self, capacity=500):
+        self.capacity = capacity
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def acquire(self, cost):
+        '''Take `cost` tokens, returning False if there aren't enough.'''
+        with self._lock:
+            if self.tokens < cost:
+                return False
+            self.tokens -= cost
+            return True
+
+    def release(self, amount):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RetryPolicy(object):
+    '''Decides whether and when to retry a request, as a handler of
+    botocore's needs-retry event.
+
+    `max_attempts` counts the first attempt, so 1 means no retries.
+    '''
+
+    def __init__(self, budget, max_attempts=5, base_delay=0.1,
+                 throttle_delay=1.0, max_delay=20):
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay = max_delay
+
+    def delay(self, kind, attempts):
+        '''Return the seconds to wait after `attempts` attempts, with full
+        jitter.'''
+        base = self.throttle_delay if kind == THROTTLED else self.base_delay
+        return random.uniform(
+            0, min(self.max_delay, base * 2 ** (attempts - 1)))
+
+    def needs_retry(self, response=None, caught_exception=None,
+                    attempts=1, request_dict=None, operation=None,
+                    **kwargs):
+        '''Return the seconds to wait before retrying, or None to stop.'''
+        context = (request_dict or {}).get('context', {})
+        kind = classify_response(response, caught_exception)
+        if kind is None:
+            # Requests that needed retries give back what they took
+            self.budget.release(context.pop('s3filestore_retry_cost', 1))
+            return None
+        if attempts >= self.max_attempts:
+            return None
+        cost = TIMEOUT_RETRY_COST if kind == TIMEOUT else RETRY_COST
+        if not self.budget.acquire(cost):
+            log.warning('Retry budget exhausted, not retrying {0}'.format(
+                getattr(operation, 'name', 'request')))
+            metrics.incr('retry_budget_exhausted')
+            return None
+        context['s3filestore_retry_cost'] = \
+            context.get('s3filestore_retry_cost', 0) + cost
+        return self.delay(kind, attempts)
+
+
+class CircuitBreaker(object):
+    '''Stops sending requests to an endpoint after `threshold` failures in
+    a row, for `reset_timeout` seconds.'''
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened = None
+        self._probe = None
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        '''Return the seconds until a request will be let through again.'''
+        opened = self._opened
+        if opened is None:
+            return 0
+        return max(0, opened + self.reset_timeout - time.time())
+
+    def is_open(self):
+        '''Return whether requests are currently being refused.'''
+        opened = self._opened
+        return (opened is not None and
+                time.time() - opened < self.reset_timeout)
+
+    def allow(self):
+        '''Return whether a request can be sent now.
+
+        Once the reset timeout has passed a single request at a time is
+        let through, to find out if the endpoint has recovered.
+        '''
+        if self.threshold <= 0 or self._opened is None:
+            return True
+        with self._lock:
+            if self._opened is None:
+                return True
+            now = time.time()
+            if now - self._opened < self.reset_timeout:
+                return False
+            if self._probe is not None and \
+                    now - self._probe < self.reset_timeout:
+                return False
+            self._probe = now
+            return True
+
+    def success(self):
+        if self.failures or self._opened is not None:
+            with self._lock:
+                if self._opened is not None:
+                    log.info('{0} is available again'.format(self.name))
+                self.failures = 0
+                self._opened = None
+                self._probe = None
+
+    def failure(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self._probe is not None or (
+                    self._opened is None and
+                    self.failures >= self.threshold):
+                if self._opened is None:
+                    log.error('{0} failed {1} times in a row, not sending '
+                              'requests to it for {2} seconds'.format(
+                                  self.name, self.failures,
+                                  self.reset_timeout))
+                    metrics.incr('circuit_open')
+                self._opened = time.time()
+                self._probe = None
+
+
+def get_breaker(endpoint_url):
+    '''Return the circuit breaker of the endpoint at `endpoint_url`.'''
+    breaker = _breakers.get(endpoint_url)
+    if breaker is None:
+        s3_settings = settings.get()
+        with _lock:
+            breaker = _breakers.get(endpoint_url)
+            if breaker is None:
+                breaker = _breakers[endpoint_url] = CircuitBreaker(
+                    endpoint_url,
+                    threshold=s3_settings.circuit_breaker_threshold,
+                    reset_timeout=s3_settings.circuit_breaker_reset)
+    return breaker
+
+
+def _get_budget(endpoint_url):
+    budget = _budgets.get(endpoint_url)
+    if budget is None:
+        with _lock:
+            budget = _budgets.get(endpoint_url)
+            if budget is None:
+                budget = _budgets[endpoint_url] = RetryBudget(
+                    settings.get().retry_budget)
+    return budget
+
+
+def check_circuit(client):
+    '''Raise CircuitOpenError if requests to the endpoint of `client` are
+    being refused.'''
+    breaker = get_breaker(client.meta.endpoint_url)
+    if breaker.is_open():
+        raise CircuitOpenError('{0} is unavailable'.format(breaker.name))
+
+
+def _before_call(endpoint_url):
+    def handler(model=None, **kwargs):
+        breaker = get_breaker(endpoint_url)
+        if not breaker.allow():
+            metrics.incr('circuit_rejected')
+            raise CircuitOpenError('{0} is unavailable, not sending {1}'
+                                   .format(breaker.name,
+                                           getattr(model, 'name', '')))
+    return handler
+
+
+def _after_call(endpoint_url):
+    def handler(http_response=None, parsed=None, **kwargs):
+        breaker = get_breaker(endpoint_url)
+        if http_response is None or http_response.status_code < 500:
+            breaker.success()
+            return
+        code = (parsed or {}).get('Error', {}).get('Code')
+        if _classify(code, http_response.status_code) != THROTTLED:
+            breaker.failure()
+    return handler
+
+
+def _after_call_error(endpoint_url):
+    def handler(exception=None, **kwargs):
+        if _classify_exception(exception):
+            get_breaker(endpoint_url).failure()
+    return handler
+
+
+def register_client(client, max_attempts=None):
+    '''Install the retry policy and circuit breaker on `client`.
+
+    `max_attempts` is the number of retries, as in the
+    `ckanext.s3filestore.retry_max_attempts` option it defaults to.
+    '''
+    s3_settings = settings.get()
+    events = client.meta.events
+    endpoint_url = client.meta.endpoint_url
+
+    if not s3_settings.retry_mode:
+        if max_attempts is None:
+            max_attempts = s3_settings.retry_max_attempts
+        policy = RetryPolicy(
+            _get_budget(endpoint_url), max_attempts=max_attempts + 1,
+            base_delay=s3_settings.retry_base_delay,
+            throttle_delay=s3_settings.retry_throttle_delay,
+            max_delay=s3_settings.retry_max_delay)
+        events.unregister('needs-retry.s3', unique_id='retry-config-s3')
+        events.register('needs-retry.s3', policy.needs_retry,
+                        unique_id='s3filestore-retry')
+
+    events.register('before-call.s3', _before_call(endpoint_url),
+                    unique_id='s3filestore-circuit-before-call')
+    events.register('after-call.s3', _after_call(endpoint_url),
+                    unique_id='s3filestore-circuit-after-call')
+    events.register('after-call-error.s3', _after_call_error(endpoint_url),
+                    unique_id='s3filestore-circuit-after-call-error')
+
+
+def reset():
+    '''Forget the retry budgets and circuit breakers.'''
+    with _lock:
+        _budgets.clear()
+        _breakers.clear()
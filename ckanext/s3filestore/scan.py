@@ -0,0 +1,220 @@
+'''
+Compare the resource files on S3 with the resource table.
+
+The bucket listing under <aws_storage_path>/resources/ and the resource
+table are both read in order, a page at a time, and merged, so neither side
+is ever loaded fully into memory. The work is split into shards by the first
+character of the resource id, which are scanned concurrently, plus one shard
+for the ids that start with none of them.
+
+Resources stored as content addressed blobs are expected to have no files
+under their own prefix.
+'''
+import os
+import string
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_
+
+import ckan.model as model
+
+from ckanext.s3filestore import bulk, db
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+log = logging.getLogger(__name__)
+
+# Uploaded resource without a file on S3
+MISSING = 'missing'
+# File on S3 that doesn't belong to an uploaded resource
+ORPHAN = 'orphan'
+# Uploaded resource that has files on S3, but not the one in its url
+MISMATCH = 'mismatch'
+
+Issue = collections.namedtuple('Issue', ['type', 'resource_id', 'key'])
+
+# Resource ids are UUIDs by default
+DEFAULT_SHARDS = tuple(string.hexdigits[:16])
+
+# Sorts after every key starting with a given prefix, in practice
+_LAST_CHAR = u'\U0010ffff'
+
+
+def _iter_other_keys(client, bucket_name, storage_path, shards):
+    '''Yield the keys under `storage_path` whose resource id starts with
+    none of `shards`, in the order they are listed.
+
+    Only the ranges of keys between the shards are listed.
+    '''
+    prefix = storage_path + '/'
+    start_after = None
+    # S3 lists keys by their bytes
+    for shard in sorted(shards, key=_utf8) + [None]:
+        end = _utf8(prefix + shard) if shard is not None else None
+        for key in bulk.iter_keys(client, bucket_name, prefix, start_after):
+            if end is not None and _utf8(key) >= end:
+                break
+            if not key[len(prefix):].startswith(tuple(shards)):
+                yield key
+        if shard is not None:
+            start_after = prefix + shard + _LAST_CHAR
+
+
+def _iter_bucket_resources(client, bucket_name, storage_path, shard,
+                           other_shards=()):
+    '''Yield (resource id, keys) for the objects on S3 whose resource id
+    starts with `shard`, in the order they are listed.
+
+    If `shard` is None, the objects whose resource id starts with none of
+    `other_shards` are listed instead.
+    '''
+    if shard is None:
+        all_keys = _iter_other_keys(client, bucket_name, storage_path,
+                                    other_shards)
+    else:
+        all_keys = bulk.iter_keys(client, bucket_name,
+                                  os.path.join(storage_path, shard))
+    current_id = None
+    keys = []
+    for key in all_keys:
+        resource_id = key[len(storage_path) + 1:].split('/', 1)[0]
+        if resource_id != current_id:
+            if keys:
+                yield current_id, keys
+            current_id = resource_id
+            keys = []
+        keys.append(key)
+    if keys:
+        yield current_id, keys
+
+
+def _iter_db_resources(shard, page_size=1000, other_shards=()):
+    '''Yield (id, url, url_type, state, blob key) for the resources whose id
+    starts with `shard`, or with none of `other_shards` if `shard` is None,
+    in the same order as S3 lists their keys.'''
+    # S3 lists keys by their bytes, and the id is followed by a slash in
+    # the key, so sort on exactly that.
+    sort_key = (model.Resource.id + u'/').collate('C')
+    last = None
+    while True:
+        query = model.Session.query(
+            model.Resource.id, model.Resource.url,
+            model.Resource.url_type, model.Resource.state,
+            db.resource_blob_table.c.key) \
+            .outerjoin(
+                db.resource_blob_table,
+                db.resource_blob_table.c.resource_id == model.Resource.id) \
+            .order_by(sort_key) \
+            .limit(page_size)
+        if shard is None:
+            if other_shards:
+                query = query.filter(and_(*[
+                    ~model.Resource.id.like(other + u'%')
+                    for other in other_shards]))
+        else:
+            query = query.filter(model.Resource.id.like(shard + u'%'))
+        if last is not None:
+            query = query.filter(sort_key > last + u'/')
+        rows = query.all()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][0]
+
+
+def _compare(resource_id, row, keys):
+    '''Return the issues for one resource, given its database `row` and its
+    `keys` on S3 (either can be None).'''
+    expected = None
+    # Content addressed files are stored elsewhere
+    if row is not None and row[2] == 'upload' and row[3] == 'active' \
+            and row[1] and not row[4]:
+        expected = row[1].rsplit('/', 1)[-1]
+
+    if expected is None:
+        return [Issue(ORPHAN, resource_id, key) for key in keys or []]
+    if not keys:
+        return [Issue(MISSING, resource_id, None)]
+
+    filenames = dict((key.rsplit('/', 1)[-1], key) for key in keys)
+    if expected not in filenames:
+        return [Issue(MISMATCH, resource_id, key) for key in keys]
+    # Files left behind by earlier uploads
+    return [Issue(ORPHAN, resource_id, key) for filename, key
+            in sorted(filenames.items()) if filename != expected]
+
+
+def _utf8(value):
+    return value.encode('utf-8')
+
+
+def _sort_key(resource_id):
+    return _utf8(resource_id) + b'/'
+
+
+def scan_shard(client, bucket_name, storage_path, shard, report,
+               other_shards=()):
+    '''Merge the bucket listing and the resource table for one shard,
+    calling `report` with every Issue found.
+
+    A `shard` of None covers the resource ids that start with none of
+    `other_shards`.
+    '''
+    try:
+        bucket_resources = _iter_bucket_resources(
+            client, bucket_name, storage_path, shard, other_shards)
+        db_resources = _iter_db_resources(shard, other_shards=other_shards)
+        s3_item = next(bucket_resources, None)
+        db_row = next(db_resources, None)
+        while s3_item is not None or db_row is not None:
+            if db_row is None or (s3_item is not None and
+                                  _sort_key(s3_item[0]) <
+                                  _sort_key(db_row[0])):
+                issues = _compare(s3_item[0], None, s3_item[1])
+                s3_item = next(bucket_resources, None)
+            elif s3_item is None or _sort_key(db_row[0]) < \
+                    _sort_key(s3_item[0]):
+                issues = _compare(db_row[0], db_row, None)
+                db_row = next(db_resources, None)
+            else:
+                issues = _compare(db_row[0], db_row, s3_item[1])
+                s3_item = next(bucket_resources, None)
+                db_row = next(db_resources, None)
+            for issue in issues:
+                report(issue)
+    finally:
+        # Each thread has its own scoped session
+        model.Session.remove()
+
+
+def scan(report, shards=DEFAULT_SHARDS, workers=8):
+    '''Scan the bucket and the resource table for inconsistencies.
+
+    `report` is called with each Issue found. Returns a Counter with the
+    number of issues of each type.
+    '''
+    upload = S3ResourceUploader({})
+    client = upload.get_s3_client()
+    storage_path = S3ResourceUploader.get_storage_path()
+    stats = collections.Counter()
+    lock = threading.Lock()
+
+    def _report(issue):
+        with lock:
+            stats[issue.type] += 1
+            report(issue)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # None is the shard of the ids that start with none of the others
+        futures = [executor.submit(scan_shard, client, upload.bucket_name,
+                                   storage_path, shard, _report, shards)
+                   for shard in tuple(shards) + (None, )]
+        for future in futures:
+            future.result()
+    finally:
+        executor.shutdown()
+    return stats
@@ -0,0 +1,184 @@
+'''
+The extension settings, parsed once from the ini file.
+
+`load()` is called from the plugin's `configure()`. Everything else reads
+the settings with `get()`, which returns an immutable `Settings` tuple, so
+options are not looked up and converted again on every request.
+'''
+import hashlib
+import collections
+
+import ckantoolkit as toolkit
+
+MB = 1024 * 1024
+
+DOWNLOAD_STRATEGIES = ('presigned', 'auto', 'proxy')
+URL_STYLES = ('path', 'virtual')
+
+
+def _str(value):
+    return value
+
+
+def _stripped(value):
+    return value.strip()
+
+
+def _int(value):
+    return toolkit.asint(value)
+
+
+def _bool(value):
+    return toolkit.asbool(value)
+
+
+def _float(value):
+    return float(value)
+
+
+def _fraction(value):
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise ValueError('{0} is not between 0 (excluded) and 1'.format(
+            fraction))
+    return fraction
+
+
+def _download_strategy(value):
+    strategy = value.strip().lower()
+    if strategy not in DOWNLOAD_STRATEGIES:
+        raise ValueError('Unknown download strategy {0}, use one of {1}'
+                         .format(strategy, ', '.join(DOWNLOAD_STRATEGIES)))
+    return strategy
+
+
+def _url_style(value):
+    style = value.strip().lower()
+    if style not in URL_STYLES:
+        raise ValueError('Unknown url style {0}, use one of {1}'.format(
+            style, ', '.join(URL_STYLES)))
+    return style
+
+
+def _hash_algorithm(value):
+    algorithm = value.strip().lower()
+    if algorithm in ('', 'none'):
+        return None
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError('Unknown hash algorithm {0}'.format(algorithm))
+    return algorithm
+
+
+# (name, default, parser), read from ckanext.s3filestore.<name>
+OPTIONS = (
+    # Connection
+    ('aws_access_key_id', None, _str),
+    ('aws_secret_access_key', None, _str),
+    ('aws_bucket_name', None, _str),
+    ('aws_storage_path', '', _str),
+    ('region_name', None, _str),
+    ('signature_version', None, _str),
+    ('host_name', None, _str),
+    ('check_access_on_startup', True, _bool),
+    ('max_pool_connections', 10, _int),
+    ('connect_timeout', 60, _int),
+    ('read_timeout', 60, _int),
+    ('tcp_keepalive', False, _bool),
+    ('retry_max_attempts', 4, _int),
+    ('retry_mode', None, _str),
+    ('retry_base_delay', 0.1, _float),
+    ('retry_throttle_delay', 1.0, _float),
+    ('retry_max_delay', 20, _float),
+    ('retry_budget', 500, _int),
+    ('circuit_breaker_threshold', 5, _int),
+    ('circuit_breaker_reset', 30, _int),
+    ('bucket_check_ttl', 3600, _int),
+    # Uploads
+    ('multipart_threshold', 8 * MB, _int),
+    ('multipart_chunksize', 8 * MB, _int),
+    ('max_concurrency', 4, _int),
+    ('hash_algorithm', 'sha256', _hash_algorithm),
+    ('hash_metadata', False, _bool),
+    ('content_addressed', False, _bool),
+    ('direct_upload_expiry', 3600, _int),
+    # Downloads
+    ('signed_url_expiry', 60, _int),
+    ('signed_url_reuse_fraction', 0.5, _fraction),
+    ('signed_url_cache_size', 10000, _int),
+    ('download_strategy', None, _download_strategy),
+    ('download_mode', None, _str),
+    ('public_base_url', None, _stripped),
+    ('url_style', 'path', _url_style),
+    ('cloudfront_key_pair_id', None, _stripped),
+    ('cloudfront_private_key', None, _stripped),
+    ('filesystem_download_fallback', False, _bool),
+    ('download_auth_cache_ttl', 0, _int),
+    ('download_auth_cache_size', 10000, _int),
+    ('proxy_chunk_size', 64 * 1024, _int),
+    ('local_cache_dir', None, _str),
+    ('local_cache_max_size', 100 * MB, _int),
+    ('local_cache_max_file_size', MB, _int),
+    ('local_cache_revalidate', 300, _int),
+    # Deletes
+    ('deferred_delete', False, _bool),
+    ('delete_files_on_delete', False, _bool),
+    # Metrics
+    ('metrics', '', _stripped),
+    ('metrics_prefix', 's3filestore', _str),
+    ('metrics_token', None, _str),
+    ('statsd_host', 'localhost', _str),
+    ('statsd_port', 8125, _int),
+)
+
+# CKAN core options the extension also needs, in MB
+CKAN_OPTIONS = (
+    ('max_resource_size', 'ckan.max_resource_size', 10, _int),
+    ('max_image_size', 'ckan.max_image_size', 2, _int),
+)
+
+Settings = collections.namedtuple(
+    'Settings', [name for name, _, _ in OPTIONS] +
+    [name for name, _, _, _ in CKAN_OPTIONS])
+
+_settings = None
+
+
+def parse(config):
+    '''Return the Settings for the `config` dict.
+
+    Raises ValueError if an option has an invalid value.
+    '''
+    options = [(name, 'ckanext.s3filestore.' + name, default, parser)
+               for name, default, parser in OPTIONS] + list(CKAN_OPTIONS)
+    values = {}
+    for name, option, default, parser in options:
+        value = config.get(option, default)
+        try:
+            values[name] = parser(value) if value is not None else None
+        except ValueError as e:
+            raise ValueError('Invalid value for {0}: {1}'.format(option,
+                                                                 str(e)))
+    return Settings(**values)
+
+
+def load(config):
+    '''Parse and store the settings, called when the plugin is
+    configured.'''
+    global _settings
+    _settings = parse(config)
+    return _settings
+
+
+def get():
+    '''Return the current Settings.'''
+    settings = _settings
+    if settings is None:
+        settings = load(toolkit.config)
+    return settings
+
+
+def reset():
+    '''Forget the settings, so they are parsed again from the current
+    configuration the next time they are needed.'''
+    global _settings
+    _settings = None
@@ -0,0 +1,118 @@
+'''
+A minimal S3 stand-in for the benchmarks.
+
+It answers the requests the uploaders make (HeadBucket, PutObject, the
+multipart upload calls and DeleteObject) and throws the data away. Unlike
+moto it keeps nothing in memory, and it runs in its own process, so the
+memory used by large uploads is only the uploader's.
+'''
+import uuid
+import socket
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+
+INITIATE_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<InitiateMultipartUploadResult>
+<Bucket>bucket</Bucket><Key>key</Key><UploadId>{0}</UploadId>
+</InitiateMultipartUploadResult>'''
+
+COMPLETE_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<CompleteMultipartUploadResult>
+<Bucket>bucket</Bucket><Key>key</Key><ETag>"{0}"</ETag>
+</CompleteMultipartUploadResult>'''
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse_request(self):
+        if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+            return False
+        # botocore waits for this before sending large bodies
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+        return True
+
+    def _discard_body(self):
+        remaining = int(self.headers.get('Content-Length') or 0)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+    def _reply(self, status=200, body='', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._reply()
+
+    def do_GET(self):
+        self._reply()
+
+    def do_PUT(self):
+        self._discard_body()
+        self._reply(headers=[('ETag', '"{0}"'.format(uuid.uuid4().hex))])
+
+    def do_POST(self):
+        self._discard_body()
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query,
+                                  keep_blank_values=True)
+        if 'uploads' in query:
+            body = INITIATE_RESPONSE.format(uuid.uuid4().hex)
+        else:
+            body = COMPLETE_RESPONSE.format(uuid.uuid4().hex)
+        self._reply(body=body, headers=[('Content-Type', 'application/xml')])
+
+    def do_DELETE(self):
+        self._reply(status=204)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def _serve(port):
+    _Server(('127.0.0.1', port), _Handler).serve_forever()
+
+
+class StandIn(object):
+    '''Runs the stand-in on a free local port in a separate process.'''
+
+    def __init__(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.url = 'http://127.0.0.1:{0}'.format(self.port)
+        self._process = multiprocessing.Process(target=_serve,
+                                                args=(self.port, ))
+        self._process.daemon = True
+
+    def start(self):
+        self._process.start()
+        # Wait until it accepts connections
+        for i in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                self._process.join(0.05)
+        raise RuntimeError('The S3 stand-in did not start')
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
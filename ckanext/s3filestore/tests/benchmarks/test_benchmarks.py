@@ -0,0 +1,299 @@
+'''
+Benchmarks for the upload and download hot paths.
+
+They are skipped unless S3FILESTORE_BENCHMARK is set, and run offline
+against a local S3 stand-in that discards the data:
+
+    S3FILESTORE_BENCHMARK=1 nosetests --ckan --with-pylons=test.ini \
+        ckanext/s3filestore/tests/benchmarks
+
+Other environment variables:
+
+    S3FILESTORE_BENCHMARK_SIZES
+        Upload sizes, default 1KB,1MB,64MB,1GB (e.g. add 5GB)
+    S3FILESTORE_BENCHMARK_REQUESTS
+        Number of download requests timed, default 500
+    S3FILESTORE_BENCHMARK_BASELINE
+        JSON file with the results of a previous run. Results more than
+        S3FILESTORE_BENCHMARK_TOLERANCE (default 0.2, i.e. 20%) worse than
+        it fail the benchmark.
+    S3FILESTORE_BENCHMARK_SAVE
+        File to write the results to, to be used as the next baseline
+
+Each upload runs in a forked process, so its peak RSS is not affected by
+the previous ones.
+'''
+import os
+import re
+import gc
+import json
+import time
+import resource
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore import connection, settings, uploader
+from ckanext.s3filestore.uploader import S3ResourceUploader, MB
+from ckanext.s3filestore.tests.benchmarks.standin import StandIn
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': MB, 'MB': MB,
+         'G': 1024 * MB, 'GB': 1024 * MB}
+
+# Metrics where a higher value is better
+HIGHER_IS_BETTER = ('requests_per_second', 'mb_per_second')
+
+_results = {}
+
+
+def _env(name, default=None):
+    return os.environ.get('S3FILESTORE_BENCHMARK' + name, default)
+
+
+def parse_size(value):
+    '''Parse sizes like 512, 1KB or 5GB to a number of bytes.'''
+    match = re.match(r'^\s*(\d+)\s*([KMG]?B?)\s*$', value.upper())
+    if not match:
+        raise ValueError('Invalid size: {0}'.format(value))
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+class SyntheticStream(object):
+    '''A seekable file of `size` bytes, generated as it is read.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+        self._block = os.urandom(64 * 1024)
+
+    def read(self, amount=-1):
+        remaining = self.size - self.position
+        if amount is None or amount < 0 or amount > remaining:
+            amount = remaining
+        offset = self.position % len(self._block)
+        repeat = (offset + amount) // len(self._block) + 1
+        data = (self._block * repeat)[offset:offset + amount]
+        self.position += amount
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+
+    def tell(self):
+        return self.position
+
+
+def measure(function):
+    '''Call `function` and return its wall time, peak RSS and memory
+    allocations.
+
+    Allocations are the peak traced by tracemalloc where available, and the
+    minor page faults otherwise.
+    '''
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    function()
+    wall_time = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    result = {
+        'wall_time': wall_time,
+        'peak_rss_kb': after.ru_maxrss,
+        'page_faults': after.ru_minflt - before.ru_minflt,
+    }
+    if tracemalloc:
+        result['allocated_peak_kb'] = \
+            tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+
+def measure_in_child(function):
+    '''Run `measure(function)` in a forked process and return its
+    result.'''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            os.write(write_fd, json.dumps(measure(function)))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    __, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('The benchmark process failed')
+    return json.loads(''.join(chunks))
+
+
+def compare(results, baseline, tolerance):
+    '''Return a description of each result more than `tolerance` worse than
+    its baseline value.'''
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            base = baseline.get(name, {}).get(metric)
+            if not base or value is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = value < base * (1 - tolerance)
+            else:
+                worse = value > base * (1 + tolerance)
+            if worse:
+                regressions.append('{0} {1}: {2:.4g} (baseline {3:.4g})'
+                                   .format(name, metric, value, base))
+    return regressions
+
+
+def _report(name, metrics):
+    _results[name] = metrics
+    print '{0}: {1}'.format(name, ', '.join(
+        '{0}={1:.4g}'.format(metric, value)
+        for metric, value in sorted(metrics.items())))
+
+
+class TestBenchmarkHelpers(object):
+
+    def test_parse_size(self):
+        assert_equal([parse_size(size) for size in ('512', '1KB', '5GB')],
+                     [512, 1024, 5 * 1024 * MB])
+
+    def test_synthetic_stream(self):
+        stream = SyntheticStream(100 * 1024)
+
+        data = stream.read(70 * 1024) + stream.read(70 * 1024)
+        stream.seek(0)
+
+        assert_equal(len(data), 100 * 1024)
+        assert_equal(stream.read(1000), data[:1000])
+
+    def test_compare(self):
+        results = {'upload': {'wall_time': 1.5, 'peak_rss_kb': 100,
+                              'mb_per_second': 40},
+                   'download': {'requests_per_second': 70}}
+        baseline = {'upload': {'wall_time': 1.0, 'peak_rss_kb': 95,
+                               'mb_per_second': 60},
+                    'download': {'requests_per_second': 100}}
+
+        assert_equal(compare(results, baseline, 0.2), [
+            'download requests_per_second: 70 (baseline 100)',
+            'upload mb_per_second: 40 (baseline 60)',
+            'upload wall_time: 1.5 (baseline 1)'])
+
+
+class TestBenchmarks(helpers.FunctionalTestBase):
+
+    @classmethod
+    def setup_class(cls):
+        if not _env(''):
+            raise SkipTest('Set S3FILESTORE_BENCHMARK to run the benchmarks')
+        cls.standin = StandIn()
+        cls.standin.start()
+        super(TestBenchmarks, cls).setup_class()
+        settings.reset()
+        connection.reset()
+        uploader._bucket_checks.clear()
+
+    @classmethod
+    def teardown_class(cls):
+        super(TestBenchmarks, cls).teardown_class()
+        cls.standin.stop()
+        settings.reset()
+        connection.reset()
+        uploader._bucket_checks.clear()
+
+        path = _env('_SAVE')
+        if path and _results:
+            with open(path, 'w') as f:
+                json.dump(_results, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def _apply_config_changes(cls, cfg):
+        cfg['ckanext.s3filestore.host_name'] = cls.standin.url
+        cfg['ckanext.s3filestore.region_name'] = 'us-east-1'
+
+    def test_01_uploader_init(self):
+        '''S3ResourceUploader.__init__, with the bucket check cached'''
+        S3ResourceUploader({})
+        iterations = 10000
+        metrics = measure(lambda: [S3ResourceUploader({})
+                                   for i in range(iterations)])
+        _report('uploader_init', {
+            'us_per_call': metrics['wall_time'] / iterations * 1e6})
+
+    def test_02_get_s3_bucket(self):
+        '''BaseS3Uploader.get_s3_bucket, with the client cached'''
+        upload = S3ResourceUploader({})
+        iterations = 10000
+        metrics = measure(lambda: [upload.get_s3_bucket(upload.bucket_name)
+                                   for i in range(iterations)])
+        _report('get_s3_bucket', {
+            'us_per_call': metrics['wall_time'] / iterations * 1e6})
+
+    def test_03_upload_to_key(self):
+        '''Time, memory and throughput of uploads of each size'''
+        sizes = _env('_SIZES', '1KB,1MB,64MB,1GB').split(',')
+        for size in sizes:
+            stream = SyntheticStream(parse_size(size))
+
+            def upload_file():
+                # Don't share the parent's pooled connections
+                connection.reset()
+                upload = S3ResourceUploader({})
+                upload.upload_to_key('benchmark/{0}'.format(size), stream)
+
+            metrics = measure_in_child(upload_file)
+            metrics['mb_per_second'] = \
+                stream.size / float(MB) / metrics['wall_time']
+            _report('upload_to_key_{0}'.format(size.strip()), metrics)
+
+    def test_04_resource_download(self):
+        '''Requests per second for the download redirect'''
+        app = self._get_test_app()
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'],
+                                      url='data.csv', url_type='upload')
+        url = '/dataset/{0}/resource/{1}/download/data.csv'.format(
+            dataset['id'], resource['id'])
+        assert_equal(app.get(url).status_int, 302)
+
+        requests = int(_env('_REQUESTS', 500))
+        metrics = measure(lambda: [app.get(url) for i in range(requests)])
+        _report('resource_download', {
+            'requests_per_second': requests / metrics['wall_time'],
+            'ms_per_request': metrics['wall_time'] / requests * 1000})
+
+    def test_99_baseline(self):
+        '''Compare the results with the stored baseline'''
+        path = _env('_BASELINE')
+        if not path:
+            raise SkipTest('No S3FILESTORE_BENCHMARK_BASELINE set')
+        with open(path) as f:
+            baseline = json.load(f)
+        regressions = compare(_results, baseline,
+                              float(_env('_TOLERANCE', 0.2)))
+        assert not regressions, 'Regressions found:\n' + \
+            '\n'.join(regressions)
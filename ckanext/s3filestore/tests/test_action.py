@@ -0,0 +1,231 @@
+import os
+
+import ckanapi
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_raises)
+from moto import mock_s3
+
+from sqlalchemy import select
+
+import ckantoolkit as toolkit
+import ckan.model as model
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore import db
+from ckanext.s3filestore.tests.utils import change_config
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+
+class TestDirectUpload(helpers.FunctionalTestBase):
+
+    def _resource(self):
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'],
+                                      url='http://example')
+        return {'user': sysadmin['name']}, resource
+
+    @mock_s3
+    def test_upload_init_post(self):
+        '''Small uploads get a presigned POST'''
+        context, resource = self._resource()
+
+        result = helpers.call_action('s3filestore_upload_init',
+                                     context=context, id=resource['id'],
+                                     filename='Data File.csv',
+                                     content_type='text/csv')
+
+        assert_equal(result['method'], 'post')
+        assert_equal(result['filename'], 'data-file.csv')
+        assert_equal(result['key'], 'my-path/resources/{0}/data-file.csv'
+                     .format(resource['id']))
+        assert_equal(result['fields']['key'], result['key'])
+        assert_equal(result['fields']['Content-Type'], 'text/csv')
+
+    @mock_s3
+    def test_upload_init_multipart(self):
+        '''Uploads in parts get a presigned url per part'''
+        context, resource = self._resource()
+
+        result = helpers.call_action('s3filestore_upload_init',
+                                     context=context, id=resource['id'],
+                                     filename='data.csv', parts=3)
+
+        assert_equal(result['method'], 'multipart')
+        assert_true(result['upload_id'])
+        assert_equal([part['part_number'] for part in result['parts']],
+                     [1, 2, 3])
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.deferred_delete', 'true')
+    def test_upload_init_dequeues_key(self):
+        '''A key queued for deletion is not removed once uploaded again'''
+        context, resource = self._resource()
+        upload = S3ResourceUploader({})
+        upload.clear_key(upload.get_path(resource['id'], 'data.csv'))
+        model.repo.commit()
+
+        helpers.call_action('s3filestore_upload_init', context=context,
+                            id=resource['id'], filename='data.csv')
+
+        assert_equal(db.get_queued_deletes(10), [])
+
+    @mock_s3
+    def test_upload_init_parts_too_small(self):
+        '''Parts smaller than S3 accepts are refused'''
+        context, resource = self._resource()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      's3filestore_upload_init', context=context,
+                      id=resource['id'], filename='data.csv',
+                      size=8 * 1024 * 1024, parts=3)
+
+    @mock_s3
+    @change_config('ckan.max_resource_size', '1')
+    def test_upload_init_too_large(self):
+        '''Uploads larger than the max resource size are refused'''
+        context, resource = self._resource()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      's3filestore_upload_init', context=context,
+                      id=resource['id'], filename='data.csv',
+                      size=2 * 1024 * 1024)
+
+    @mock_s3
+    def test_upload_finalize(self):
+        '''Finalizing an upload points the resource to the file'''
+        context, resource = self._resource()
+        upload = S3ResourceUploader({})
+        upload.get_s3_client().put_object(
+            Bucket=upload.bucket_name,
+            Key=upload.get_path(resource['id'], 'data.csv'),
+            Body='date,price\n', ContentType='text/csv')
+
+        result = helpers.call_action('s3filestore_upload_finalize',
+                                     context=context, id=resource['id'],
+                                     filename='data.csv')
+
+        assert_equal(result['url_type'], 'upload')
+        assert_true(result['url'].endswith('/download/data.csv'))
+        assert_equal(result['size'], 11)
+        assert_equal(result['mimetype'], 'text/csv')
+
+    @mock_s3
+    def test_upload_finalize_removes_old_file(self):
+        '''The previous file is removed when the filename changes'''
+        context, resource = self._resource()
+        upload = S3ResourceUploader({})
+        client = upload.get_s3_client()
+        for filename in ('old.csv', 'new.csv'):
+            client.put_object(Bucket=upload.bucket_name,
+                              Key=upload.get_path(resource['id'], filename),
+                              Body='date,price\n')
+        helpers.call_action('s3filestore_upload_finalize', context=context,
+                            id=resource['id'], filename='old.csv')
+
+        helpers.call_action('s3filestore_upload_finalize', context=context,
+                            id=resource['id'], filename='new.csv')
+
+        keys = client.list_objects(Bucket=upload.bucket_name)['Contents']
+        assert_equal([key['Key'] for key in keys],
+                     [upload.get_path(resource['id'], 'new.csv')])
+
+    @mock_s3
+    def test_upload_finalize_missing_file(self):
+        '''Finalizing fails if nothing was uploaded'''
+        context, resource = self._resource()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      's3filestore_upload_finalize', context=context,
+                      id=resource['id'], filename='data.csv')
+
+    @mock_s3
+    def test_upload_init_not_authorized(self):
+        '''Only users that can update the resource can upload'''
+        _, resource = self._resource()
+        user = factories.User()
+
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+                      's3filestore_upload_init',
+                      context={'user': user['name'], 'ignore_auth': False},
+                      id=resource['id'], filename='data.csv')
+
+
+class TestClone(helpers.FunctionalTestBase):
+
+    def _upload_resource(self):
+        factories.Sysadmin(apikey='my-test-key')
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset(name='my-dataset')
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        resource = demo.action.resource_create(package_id=dataset['id'],
+                                               upload=open(file_path),
+                                               url='file.txt')
+        return demo, dataset, resource
+
+    def _get_object(self, resource_id, filename='data.csv'):
+        upload = S3ResourceUploader({})
+        return upload.get_s3_client().get_object(
+            Bucket=upload.bucket_name,
+            Key=upload.get_path(resource_id, filename))['Body'].read()
+
+    @mock_s3
+    def test_resource_clone(self):
+        '''Cloning a resource copies its file'''
+        demo, dataset, resource = self._upload_resource()
+        other = factories.Dataset()
+
+        clone = demo.action.s3filestore_resource_clone(id=resource['id'],
+                                                       package_id=other['id'])
+
+        assert_equal(clone['package_id'], other['id'])
+        assert_equal(clone['url_type'], 'upload')
+        assert_true(clone['url'].endswith('/download/data.csv'))
+        assert_equal(self._get_object(clone['id']),
+                     self._get_object(resource['id']))
+
+    @mock_s3
+    def test_package_clone(self):
+        '''Cloning a dataset copies the files of its resources'''
+        demo, dataset, resource = self._upload_resource()
+
+        clone = demo.action.s3filestore_package_clone(id=dataset['id'],
+                                                      name='my-copy')
+
+        assert_equal(clone['name'], 'my-copy')
+        assert_equal(len(clone['resources']), 1)
+        assert_true(clone['resources'][0]['id'] != resource['id'])
+        assert_equal(self._get_object(clone['resources'][0]['id']),
+                     self._get_object(resource['id']))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_resource_clone_shares_blob(self):
+        '''Clones of content addressed resources point to the same blob'''
+        demo, dataset, resource = self._upload_resource()
+
+        clone = demo.action.s3filestore_resource_clone(id=resource['id'])
+
+        key = db.get_resource_blob(resource['id'])
+        assert_equal(db.get_resource_blob(clone['id']), key)
+        size, refcount = model.Session.execute(
+            select([db.blob_table.c.size, db.blob_table.c.refcount])
+            .where(db.blob_table.c.key == key)).first()
+        assert_equal(size, resource['size'])
+        assert_equal(refcount, 2)
+
+    @mock_s3
+    def test_resource_rename(self):
+        '''Renaming moves the file to its new key'''
+        demo, dataset, resource = self._upload_resource()
+        content = self._get_object(resource['id'])
+
+        renamed = demo.action.s3filestore_resource_rename(id=resource['id'],
+                                                          filename='new.csv')
+
+        assert_true(renamed['url'].endswith('/download/new.csv'))
+        assert_equal(self._get_object(resource['id'], 'new.csv'), content)
+        assert_raises(Exception, self._get_object, resource['id'])
@@ -0,0 +1,161 @@
+import os
+from StringIO import StringIO
+
+import mock
+import boto
+import ckanapi
+from moto import mock_s3
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+from ckantoolkit import config
+
+import ckan.model as model
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore import bulk, db
+from ckanext.s3filestore.tests.utils import change_config
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+class TestDeleteKeys(object):
+
+    def test_batches_of_1000(self):
+        '''Keys are deleted with one request per 1000 keys'''
+        client = mock.Mock()
+        client.delete_objects.return_value = {}
+        keys = ['key-{0}'.format(i) for i in range(2500)]
+
+        errors = bulk.delete_keys(client, 'bucket', keys)
+
+        assert_equal(errors, {})
+        assert_equal(
+            [len(call[1]['Delete']['Objects'])
+             for call in client.delete_objects.call_args_list],
+            [1000, 1000, 500])
+
+    def test_errors_returned(self):
+        client = mock.Mock()
+        client.delete_objects.return_value = {'Errors': [
+            {'Key': 'b', 'Code': 'AccessDenied', 'Message': 'Denied'}]}
+
+        errors = bulk.delete_keys(client, 'bucket', ['a', 'b'])
+
+        assert_equal(errors, {'b': 'AccessDenied: Denied'})
+
+
+class TestDeferredDelete(helpers.FunctionalTestBase):
+
+    def _upload_then_clear(self):
+        factories.Sysadmin(apikey='my-test-key')
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset()
+
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        resource = demo.action.resource_create(package_id=dataset['id'],
+                                               upload=open(file_path),
+                                               url='file.txt')
+        demo.action.resource_update(id=resource['id'], url='http://example',
+                                    clear_upload=True)
+        return '{0}/resources/{1}/data.csv'.format(
+            config.get('ckanext.s3filestore.aws_storage_path'),
+            resource['id'])
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.deferred_delete', 'true')
+    def test_deferred_delete(self):
+        '''Cleared keys are queued and removed when the queue is processed'''
+        key = self._upload_then_clear()
+
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_true(bucket.lookup(key))
+        assert_equal([row[2] for row in db.get_queued_deletes(10)], [key])
+
+        assert_equal(bulk.process_delete_queue(), (1, 0))
+
+        assert_false(bucket.lookup(key))
+        assert_equal(db.get_queued_deletes(10), [])
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.deferred_delete', 'true')
+    def test_deferred_delete_key_written_again(self):
+        '''Keys written again after being queued are not removed'''
+        key = self._upload_then_clear()
+        upload = BaseS3Uploader()
+        upload.upload_to_key(key, StringIO('date,price\n1,2\n'))
+
+        assert_equal(db.get_queued_deletes(10), [])
+        assert_equal(bulk.process_delete_queue(), (0, 0))
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_equal(bucket.get_key(key).get_contents_as_string(),
+                     'date,price\n1,2\n')
+
+
+class TestRemoveResourceFiles(helpers.FunctionalTestBase):
+
+    def _upload_resource(self, demo, dataset):
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        resource = demo.action.resource_create(package_id=dataset['id'],
+                                               upload=open(file_path),
+                                               url='file.txt')
+        return '{0}/resources/{1}/data.csv'.format(
+            config.get('ckanext.s3filestore.aws_storage_path'),
+            resource['id'])
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.delete_files_on_delete',
+                   'true')
+    def test_dataset_delete_removes_files(self):
+        '''Deleting a dataset removes the files of its resources'''
+        factories.Sysadmin(apikey='my-test-key')
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset()
+        keys = [self._upload_resource(demo, dataset) for i in range(2)]
+
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_true(all(bucket.lookup(key) for key in keys))
+
+        demo.action.package_delete(id=dataset['id'])
+
+        assert_false(any(bucket.lookup(key) for key in keys))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.delete_files_on_delete',
+                   'true')
+    def test_rolled_back_delete_keeps_files(self):
+        '''Files are only removed once the delete is committed'''
+        factories.Sysadmin(apikey='my-test-key')
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset()
+        key = self._upload_resource(demo, dataset)
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+
+        bulk.remove_resource_files_on_commit([key.split('/')[-2]])
+        assert_true(bucket.lookup(key))
+        model.Session.rollback()
+        model.Session.commit()
+
+        assert_true(bucket.lookup(key))
+
+    @mock_s3
+    def test_purge_deleted(self):
+        '''Files of deleted resources are found and removed'''
+        factories.Sysadmin(apikey='my-test-key')
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset()
+        kept = self._upload_resource(demo, dataset)
+        removed = self._upload_resource(demo, dataset)
+        demo.action.resource_delete(id=removed.split('/')[-2])
+
+        resource_ids = bulk.get_deleted_resource_ids()
+        assert_equal(resource_ids, [removed.split('/')[-2]])
+        bulk.remove_resource_files(resource_ids)
+
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_true(bucket.lookup(kept))
+        assert_false(bucket.lookup(removed))
@@ -0,0 +1,37 @@
+import time
+
+import mock
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+
+from ckanext.s3filestore.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_set(self):
+        cache = LRUCache(maxsize=10)
+        cache.set('a', 1)
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b', 'default'), 'default')
+
+    def test_least_recently_used_evicted(self):
+        '''The least recently used item goes first when full'''
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert_true('a' in cache)
+        assert_false('b' in cache)
+        assert_true('c' in cache)
+        assert_equal(len(cache), 2)
+
+    def test_ttl(self):
+        '''Items older than the TTL are treated as missing'''
+        cache = LRUCache(maxsize=2, ttl=5)
+        cache.set('a', 1)
+        with mock.patch('ckanext.s3filestore.cache.time') as mock_time:
+            mock_time.time.return_value = time.time() + 10
+            assert_equal(cache.get('a'), None)
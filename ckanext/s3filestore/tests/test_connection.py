@@ -0,0 +1,39 @@
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+
+from ckanext.s3filestore import connection
+from ckanext.s3filestore.tests.utils import change_config
+
+
+class TestConnectionRegistry(object):
+
+    def setup(self):
+        connection.reset()
+
+    def test_client_is_shared(self):
+        '''The same client is returned for the same connection details'''
+        client = connection.get_client('key', 'secret', 'us-east-1')
+        assert_true(connection.get_client('key', 'secret', 'us-east-1')
+                    is client)
+
+    def test_client_per_endpoint(self):
+        '''Different endpoints get different clients'''
+        client = connection.get_client('key', 'secret', 'us-east-1')
+        other = connection.get_client('key', 'secret', 'us-east-1',
+                                      'http://localhost:9000')
+        assert_false(client is other)
+
+    def test_reset_drops_clients(self):
+        '''Clients are created again after a reset'''
+        client = connection.get_client('key', 'secret', 'us-east-1')
+        connection.reset()
+        assert_false(connection.get_client('key', 'secret', 'us-east-1')
+                     is client)
+
+    @change_config('ckanext.s3filestore.max_pool_connections', '32')
+    def test_client_config(self):
+        '''Pool size is read from the config'''
+        client_config = connection.get_client_config('s3v4')
+        assert_equal(client_config.max_pool_connections, 32)
+        assert_equal(client_config.signature_version, 's3v4')
@@ -1,7 +1,12 @@
 import os
+import shutil
+import tempfile
 
+import mock
+from botocore.exceptions import EndpointConnectionError
 from nose.tools import (assert_equal,
-                        assert_true)
+                        assert_true,
+                        assert_false)
 from ckantoolkit import config
 
 import ckan.tests.helpers as helpers
@@ -11,12 +16,19 @@ import ckanapi
 import boto
 from moto import mock_s3
 
+from ckanext.s3filestore import retry
+from ckanext.s3filestore.uploader import BaseS3Uploader
+from ckanext.s3filestore.tests.utils import change_config
+
 import logging
 log = logging.getLogger(__name__)
 
 
 class TestS3ControllerResourceDownload(helpers.FunctionalTestBase):
 
+    def teardown(self):
+        retry.reset()
+
     def _upload_resource(self):
         factories.Sysadmin(apikey="my-test-key")
 
@@ -96,3 +108,144 @@ class TestS3ControllerResourceDownload(helpers.FunctionalTestBase):
         # attempt redirect to linked url
         r = app.get(resource_file_url, status=[302, 301])
         assert_equal(r.location, 'http://example')
+
+    def _open_circuit(self):
+        upload = BaseS3Uploader()
+        breaker = retry.get_breaker(upload.get_s3_client().meta.endpoint_url)
+        for i in range(breaker.threshold):
+            breaker.failure()
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.filesystem_download_fallback',
+                   'false')
+    def test_resource_download_circuit_open(self):
+        '''Downloads fail fast while the store is unavailable'''
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+
+        self._open_circuit()
+        app.get(resource_file_url, status=[503])
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.filesystem_download_fallback',
+                   'true')
+    def test_resource_download_circuit_open_fallback(self):
+        '''The filesystem is used while the store is unavailable'''
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download/data.csv' \
+            .format(resource['package_id'], resource['id'])
+
+        self._open_circuit()
+        r = app.get(resource_file_url, status=[302])
+        assert_true('/fs_download/data.csv' in r.location)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.signed_url_expiry', '600')
+    def test_resource_download_cache_control(self):
+        '''The redirect to S3 can be cached while the url is reused.'''
+
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+
+        first = app.get(resource_file_url, status=[302])
+        second = app.get(resource_file_url, status=[302])
+
+        assert_equal(first.location, second.location)
+        assert_true(first.headers['Cache-Control'].startswith(
+            'public, max-age='))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_auth_cache_ttl',
+                   '60')
+    def test_resource_download_public_cached(self):
+        '''Public resources are not looked up again while cached.'''
+
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+
+        app.get(resource_file_url, status=[302])
+        with mock.patch('ckan.model.Resource.get') as resource_get:
+            app.get(resource_file_url, status=[302])
+        assert_false(resource_get.called)
+
+    @mock_s3
+    def test_resource_download_wrong_dataset(self):
+        '''A resource can't be downloaded through another dataset.'''
+
+        resource, demo, app = self._upload_resource()
+        other = factories.Dataset()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(other['id'], resource['id'])
+
+        app.get(resource_file_url, status=404)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_mode', 'proxy')
+    def test_resource_download_proxy(self):
+        '''In proxy mode the file is streamed through CKAN.'''
+
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+
+        file_response = app.get(resource_file_url, status=200)
+
+        assert_equal(file_response.content_type, 'text/csv')
+        assert_equal(file_response.headers['Accept-Ranges'], 'bytes')
+        assert_true('date,price' in file_response.body)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_mode', 'proxy')
+    def test_resource_download_proxy_range(self):
+        '''Range requests get a partial response.'''
+
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+
+        file_response = app.get(resource_file_url,
+                                headers={'Range': 'bytes=0-3'}, status=206)
+
+        assert_equal(file_response.body, 'date')
+        assert_true(file_response.headers['Content-Range']
+                    .startswith('bytes 0-3/'))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_mode', 'proxy')
+    def test_resource_download_proxy_not_modified(self):
+        '''Conditional requests for an unchanged file get a 304.'''
+
+        resource, demo, app = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+
+        etag = app.get(resource_file_url).headers['ETag']
+        app.get(resource_file_url, headers={'If-None-Match': etag},
+                status=304)
+
+
+class TestS3ControllerUploadedFile(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestS3ControllerUploadedFile, self).setup()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    @mock_s3
+    def test_uploaded_file_cache_unavailable(self):
+        '''Network errors from the file cache fall back to the redirect'''
+        @change_config('ckanext.s3filestore.local_cache_dir', self.cache_dir)
+        def test():
+            app = self._get_test_app()
+            with mock.patch('ckanext.s3filestore.filecache.FileCache.get',
+                            side_effect=EndpointConnectionError(
+                                endpoint_url='http://s3')):
+                r = app.get('/uploads/group/logo.png', status=[302])
+            assert_true(r.location.endswith(
+                '/storage/uploads/group/logo.png'))
+        test()
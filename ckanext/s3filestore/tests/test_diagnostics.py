@@ -0,0 +1,77 @@
+from nose.tools import assert_equal, assert_true, assert_false
+from moto import mock_s3
+
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import diagnostics, retry
+from ckanext.s3filestore.uploader import BaseS3Uploader, MB
+from ckanext.s3filestore.tests.utils import change_config
+
+
+class TestPercentiles(object):
+
+    def test_nearest_rank(self):
+        points = diagnostics.percentiles(range(1, 101), (50, 90, 99, 100))
+
+        assert_equal(points, {50: 50, 90: 90, 99: 99, 100: 100})
+
+    def test_no_samples(self):
+        assert_equal(diagnostics.percentiles([], (50, )), {50: None})
+
+
+class TestCheck(helpers.FunctionalTestBase):
+
+    @mock_s3
+    def test_check(self):
+        '''All the steps pass against a working bucket'''
+        checks = diagnostics.check()
+
+        assert_equal([check.name for check in checks],
+                     ['config', 'client', 'bucket', 'put', 'get', 'presign',
+                      'delete'])
+        assert_true(all(check.ok for check in checks))
+
+    @mock_s3
+    def test_check_circuit_open(self):
+        '''An open circuit is reported as a failed step'''
+        upload = BaseS3Uploader()
+        breaker = retry.get_breaker(upload.get_s3_client().meta.endpoint_url)
+        try:
+            for i in range(breaker.threshold):
+                breaker.failure()
+
+            checks = diagnostics.check()
+        finally:
+            retry.reset()
+
+        assert_false(checks[-1].ok)
+        assert_true('unavailable' in checks[-1].message)
+
+    @change_config('ckanext.s3filestore.aws_bucket_name', '')
+    def test_check_missing_option(self):
+        checks = diagnostics.check()
+
+        assert_equal(len(checks), 1)
+        assert_false(checks[0].ok)
+        assert_true('aws_bucket_name' in checks[0].message)
+
+
+class TestBenchmark(helpers.FunctionalTestBase):
+
+    @mock_s3
+    def test_benchmark(self):
+        upload = BaseS3Uploader()
+
+        timings = diagnostics.benchmark_latency(upload, iterations=3)
+        results = diagnostics.benchmark_throughput(
+            upload, size=6 * MB, part_sizes=(5 * MB, ),
+            concurrencies=(1, 2))
+
+        assert_equal(timings.keys(),
+                     ['head_bucket', 'put', 'get', 'presign', 'delete'])
+        assert_true(all(len(samples) == 3 for samples in timings.values()))
+        assert_equal([(r.part_size, r.concurrency) for r in results],
+                     [(5 * MB, 1), (5 * MB, 2)])
+        # Nothing is left behind
+        assert_false(upload.get_s3_client().list_objects_v2(
+            Bucket=upload.bucket_name).get('Contents'))
@@ -0,0 +1,205 @@
+import os
+import time
+import threading
+
+import botocore
+import mock
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+from moto import mock_s3
+
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import engine, retry
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+def _client_error(code, status):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code},
+         'ResponseMetadata': {'HTTPStatusCode': status}}, 'PutObject')
+
+
+class TestRateLimiter(object):
+
+    def test_throttled_halves_rate(self):
+        limiter = engine.RateLimiter(rate=100)
+        limiter.throttled()
+        assert_equal(limiter.rate, 50)
+        limiter.throttled()
+        assert_equal(limiter.rate, 25)
+
+    def test_rate_recovers_up_to_limit(self):
+        limiter = engine.RateLimiter(rate=100, recovery=10)
+        limiter.throttled()
+        for i in range(10):
+            limiter.succeeded()
+        assert_equal(limiter.rate, 100)
+
+    def test_unlimited_until_throttled(self):
+        limiter = engine.RateLimiter(min_rate=4)
+        limiter.succeeded()
+        assert_equal(limiter.rate, None)
+        limiter.throttled()
+        assert_equal(limiter.rate, 4)
+
+    def test_is_throttled(self):
+        assert_true(engine.is_throttled(_client_error('SlowDown', 503)))
+        assert_true(engine.is_throttled(_client_error('Unknown', 503)))
+        assert_false(engine.is_throttled(_client_error('AccessDenied', 403)))
+        assert_true(engine.is_transient(_client_error('InternalError', 500)))
+        assert_false(engine.is_transient(ValueError()))
+
+
+class TestTransferEngine(helpers.FunctionalTestBase):
+
+    def _engine(self, **kwargs):
+        kwargs.setdefault('base_delay', 0)
+        upload = BaseS3Uploader()
+        upload.check_bucket()
+        return engine.TransferEngine(uploader=upload, **kwargs)
+
+    @mock_s3
+    def test_throttled_operations_retried(self):
+        '''SlowDown errors are retried and lower the rate'''
+        transfer = self._engine(rate=1000)
+        calls = []
+
+        def operation(client, item):
+            calls.append(item)
+            if len(calls) < 3:
+                raise _client_error('SlowDown', 503)
+            return item * 2
+
+        result = transfer.call(operation, 21)
+
+        assert_equal(result, engine.Result(21, 42, None))
+        assert_equal(len(calls), 3)
+        assert_true(transfer.limiter.rate < 1000)
+
+    @mock_s3
+    def test_errors_not_retried(self):
+        '''Other errors are returned straight away'''
+        transfer = self._engine()
+        calls = []
+
+        def operation(client, item):
+            calls.append(item)
+            raise _client_error('AccessDenied', 403)
+
+        result = transfer.call(operation, 'key')
+
+        assert_equal(len(calls), 1)
+        assert_true(isinstance(result.error, botocore.exceptions.ClientError))
+
+    @mock_s3
+    def test_attempts_limited(self):
+        transfer = self._engine(max_attempts=3)
+        calls = []
+
+        def operation(client, item):
+            calls.append(item)
+            raise _client_error('SlowDown', 503)
+
+        result = transfer.call(operation, 'key')
+
+        assert_equal(len(calls), 3)
+        assert_true(result.error is not None)
+
+    @mock_s3
+    def test_throttled_upload_retried(self):
+        '''Uploads that S3 asks to slow down are retried'''
+        transfer = self._engine(rate=1000)
+        path = os.path.join(os.path.dirname(__file__), 'data.csv')
+
+        with mock.patch.object(
+                transfer.client, 'upload_fileobj',
+                side_effect=[_client_error('SlowDown', 503), None]) as put:
+            results = list(transfer.put([('engine/data.csv', path)]))
+
+        assert_equal(results, [engine.Result('engine/data.csv',
+                                             'engine/data.csv', None)])
+        assert_equal(put.call_count, 2)
+        assert_true(transfer.limiter.rate < 1000)
+
+    @mock_s3
+    def test_open_circuit_waited_for(self):
+        '''Operations refused by an open circuit wait instead of failing'''
+        transfer = self._engine(max_attempts=1, max_circuit_waits=3)
+        calls = []
+
+        def operation(client, item):
+            calls.append(item)
+            if len(calls) < 3:
+                raise retry.CircuitOpenError('store is unavailable')
+            return item
+
+        with mock.patch.object(transfer, '_wait_for_circuit') as wait:
+            result = transfer.call(operation, 'key')
+
+        assert_equal(result, engine.Result('key', 'key', None))
+        assert_equal(wait.call_count, 2)
+
+    @mock_s3
+    def test_open_circuit_waits_limited(self):
+        transfer = self._engine(max_circuit_waits=2)
+
+        def operation(client, item):
+            raise retry.CircuitOpenError('store is unavailable')
+
+        with mock.patch.object(transfer, '_wait_for_circuit') as wait:
+            result = transfer.call(operation, 'key')
+
+        assert_true(isinstance(result.error, retry.CircuitOpenError))
+        assert_equal(wait.call_count, 2)
+
+    @mock_s3
+    def test_concurrency_bounded(self):
+        '''No more than `concurrency` operations run at a time'''
+        transfer = self._engine(concurrency=4)
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def operation(client, item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return item
+
+        results = list(transfer.run(operation, xrange(100)))
+
+        assert_equal(sorted(result.value for result in results), range(100))
+        assert_true(peak[0] <= 4)
+
+    @mock_s3
+    def test_operations(self):
+        '''Files are uploaded, checked, copied, listed and deleted'''
+        transfer = self._engine(concurrency=8)
+        path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        keys = ['engine/{0}.csv'.format(i) for i in range(20)]
+
+        put = list(transfer.put([(key, path) for key in keys]))
+        assert_equal(sorted(result.item for result in put), sorted(keys))
+        assert_true(all(result.error is None for result in put))
+
+        heads = dict((result.item, result.value) for result in
+                     transfer.head(keys + ['engine/missing.csv']))
+        assert_equal(heads['engine/0.csv']['ContentLength'],
+                     os.path.getsize(path))
+        assert_equal(heads['engine/missing.csv'], None)
+
+        copied = list(transfer.copy([(keys[0], 'engine/copy/0.csv')]))
+        assert_equal(copied[0].item, 'engine/copy/0.csv')
+
+        listed = list(transfer.list_prefixes(['engine/copy/']))
+        assert_equal(listed[0].value, ['engine/copy/0.csv'])
+
+        deleted = list(transfer.delete(keys + ['engine/copy/0.csv']))
+        assert_equal(len(deleted), 21)
+        assert_true(all(result.error is None for result in deleted))
+        assert_equal(list(transfer.list_prefixes(['engine/']))[0].value, [])
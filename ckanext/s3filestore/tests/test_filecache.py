@@ -0,0 +1,110 @@
+import datetime
+import io
+import shutil
+import tempfile
+import time
+
+import mock
+from botocore.exceptions import ClientError
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+
+from ckanext.s3filestore.filecache import FileCache
+
+
+def _object(body, etag='"abc"', total_size=None):
+    obj = {
+        'Body': io.BytesIO(body),
+        'ETag': etag,
+        'ContentLength': len(body),
+        'ContentType': 'image/png',
+        'LastModified': datetime.datetime(2017, 1, 1),
+    }
+    if total_size is not None:
+        obj['ContentRange'] = 'bytes 0-{0}/{1}'.format(len(body) - 1,
+                                                       total_size)
+    return obj
+
+
+def _client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': ''}}, 'GetObject')
+
+
+class TestFileCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.directory, max_size=10,
+                               max_file_size=5, revalidate=60)
+        self.client = mock.Mock()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miss_fetches_object(self):
+        self.client.get_object.return_value = _object(b'abc')
+
+        entry = self.cache.get(self.client, 'bucket', 'key')
+
+        assert_equal(open(entry['path'], 'rb').read(), b'abc')
+        assert_equal(entry['etag'], '"abc"')
+        assert_equal(entry['last_modified'], 'Sun, 01 Jan 2017 00:00:00 GMT')
+
+    def test_hit_does_not_fetch(self):
+        self.client.get_object.return_value = _object(b'abc')
+        self.cache.get(self.client, 'bucket', 'key')
+        self.cache.get(self.client, 'bucket', 'key')
+        assert_equal(self.client.get_object.call_count, 1)
+
+    def test_revalidate_with_etag(self):
+        '''Old entries are revalidated and kept if not modified'''
+        self.client.get_object.return_value = _object(b'abc')
+        self.cache.get(self.client, 'bucket', 'key')
+
+        self.client.get_object.side_effect = _client_error('304')
+        with mock.patch('ckanext.s3filestore.filecache.time') as mock_time:
+            mock_time.time.return_value = time.time() + 120
+            entry = self.cache.get(self.client, 'bucket', 'key')
+
+        self.client.get_object.assert_called_with(
+            Bucket='bucket', Key='key', Range='bytes=0-5',
+            IfNoneMatch='"abc"')
+        assert_equal(open(entry['path'], 'rb').read(), b'abc')
+
+    def test_large_files_not_cached(self):
+        self.client.get_object.return_value = _object(b'abcdefgh')
+        assert_equal(self.cache.get(self.client, 'bucket', 'key'), None)
+
+    def test_large_files_not_downloaded(self):
+        '''Only the first bytes of large files are requested, once'''
+        self.client.get_object.return_value = _object(b'abcdef',
+                                                      total_size=10 ** 9)
+
+        assert_equal(self.cache.get(self.client, 'bucket', 'key'), None)
+        assert_equal(self.cache.get(self.client, 'bucket', 'key'), None)
+
+        self.client.get_object.assert_called_once_with(
+            Bucket='bucket', Key='key', Range='bytes=0-5')
+
+    def test_empty_object(self):
+        self.client.get_object.side_effect = [_client_error('InvalidRange'),
+                                              _object(b'')]
+
+        entry = self.cache.get(self.client, 'bucket', 'key')
+
+        assert_equal(open(entry['path'], 'rb').read(), b'')
+        self.client.get_object.assert_called_with(Bucket='bucket', Key='key')
+
+    def test_missing_object(self):
+        self.client.get_object.side_effect = _client_error('NoSuchKey')
+        assert_equal(self.cache.get(self.client, 'bucket', 'key'), None)
+
+    def test_least_recently_used_evicted(self):
+        '''Old files are removed once the cache is over its size'''
+        for key in ('a', 'b', 'c', 'd'):
+            self.client.get_object.return_value = _object(b'abcd')
+            self.cache.get(self.client, 'bucket', key)
+
+        assert_false(self.cache._read_entry(self.cache.get_path('a')))
+        assert_true(self.cache._read_entry(self.cache.get_path('d')))
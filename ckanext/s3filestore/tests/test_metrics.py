@@ -0,0 +1,78 @@
+import os
+
+import mock
+import ckanapi
+from nose.tools import assert_equal, assert_true
+from moto import mock_s3
+
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore import connection, metrics
+from ckanext.s3filestore.tests.utils import change_config
+
+
+class TestPrometheusEmitter(object):
+
+    def test_render(self):
+        emitter = metrics.PrometheusEmitter()
+        emitter.incr('requests', operation='PutObject', status=200)
+        emitter.incr('requests', operation='PutObject', status=200)
+        emitter.timing('request', 0.02, operation='PutObject')
+
+        lines = emitter.render().splitlines()
+
+        assert_true('# TYPE s3filestore_requests_total counter' in lines)
+        assert_true('s3filestore_requests_total'
+                    '{operation="PutObject",status="200"} 2' in lines)
+        assert_true('s3filestore_request_seconds_bucket'
+                    '{operation="PutObject",le="0.01"} 0' in lines)
+        assert_true('s3filestore_request_seconds_bucket'
+                    '{operation="PutObject",le="0.025"} 1' in lines)
+        assert_true('s3filestore_request_seconds_count'
+                    '{operation="PutObject"} 1' in lines)
+
+
+class TestStatsdEmitter(object):
+
+    def test_names(self):
+        emitter = metrics.StatsdEmitter(prefix='ckan.s3')
+        emitter._socket = mock.Mock()
+
+        emitter.incr('errors', operation='GetObject', code='NoSuchKey')
+        emitter.timing('presign', 0.0015)
+
+        sent = [call[0][0] for call in emitter._socket.sendto.call_args_list]
+        assert_equal(sent, [b'ckan.s3.errors.NoSuchKey.GetObject:1|c',
+                            b'ckan.s3.presign:1.500|ms'])
+
+
+class TestMetricsEndpoint(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestMetricsEndpoint, self).setup()
+        connection.reset()
+
+    def teardown(self):
+        connection.reset()
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.metrics', 'prometheus')
+    def test_requests_recorded(self):
+        '''S3 requests made by the uploader show up in the endpoint'''
+        factories.Sysadmin(apikey='my-test-key')
+        app = self._get_test_app()
+        demo = ckanapi.TestAppCKAN(app, apikey='my-test-key')
+        dataset = factories.Dataset()
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        demo.action.resource_create(package_id=dataset['id'],
+                                    upload=open(file_path), url='file.txt')
+
+        body = app.get('/s3filestore/metrics').body
+
+        assert_true('s3filestore_requests_total{operation="PutObject",'
+                    'status="200"} 1' in body)
+        assert_true('s3filestore_upload_seconds_count 1' in body)
+
+    def test_disabled(self):
+        self._get_test_app().get('/s3filestore/metrics', status=404)
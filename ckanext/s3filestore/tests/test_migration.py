@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+
+import botocore
+import mock
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+from moto import mock_s3
+
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore import migration
+from ckanext.s3filestore.bulk import ALL_USERS
+from ckanext.s3filestore.tests.utils import change_config
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+class TestMigration(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestMigration, self).setup()
+        self.storage_path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _local_resource(self, content='date,price\n', private=False):
+        if private:
+            dataset = factories.Dataset(
+                owner_org=factories.Organization()['id'], private=True)
+        else:
+            dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'],
+                                      url='data.csv', url_type='upload')
+        resource_id = resource['id']
+        directory = os.path.join(self.storage_path, 'resources',
+                                 resource_id[0:3], resource_id[3:6])
+        os.makedirs(directory)
+        with open(os.path.join(directory, resource_id[6:]), 'w') as f:
+            f.write(content)
+        return resource
+
+    def _get_object(self, key):
+        upload = BaseS3Uploader()
+        return upload.get_s3_client().get_object(
+            Bucket=upload.bucket_name, Key=key)['Body'].read()
+
+    @mock_s3
+    def test_resource_items(self):
+        '''Local files are matched to uploaded resources'''
+        resource = self._local_resource()
+        factories.Resource(url='http://example')
+
+        items = list(migration.iter_resource_items(self.storage_path))
+
+        assert_equal(len(items), 1)
+        assert_equal(items[0].name, resource['id'])
+        assert_equal(items[0].key,
+                     'my-path/resources/{0}/data.csv'.format(resource['id']))
+
+    @mock_s3
+    def test_migrate(self):
+        '''Files are uploaded, then skipped once on S3'''
+        resource = self._local_resource()
+        items = list(migration.iter_resource_items(self.storage_path))
+
+        stats = migration.Migration(workers=2).run(items)
+        assert_equal(stats['uploaded'], 1)
+        assert_equal(
+            self._get_object(
+                'my-path/resources/{0}/data.csv'.format(resource['id'])),
+            'date,price\n')
+
+        stats = migration.Migration(workers=2).run(items)
+        assert_equal(stats['uploaded'], 0)
+        assert_equal(stats['skipped'], 1)
+
+    def _grantees(self, key):
+        upload = BaseS3Uploader()
+        acl = upload.get_s3_client().get_object_acl(
+            Bucket=upload.bucket_name, Key=key)
+        return [grant['Grantee'].get('URI') for grant in acl['Grants']]
+
+    @mock_s3
+    def test_migrate_private_by_default(self):
+        '''Resource files are private unless the uploaders would make them
+        public'''
+        resource = self._local_resource()
+        items = list(migration.iter_resource_items(self.storage_path))
+        assert_false(items[0].public)
+
+        migration.Migration(workers=2).run(items)
+        assert_false(
+            ALL_USERS in self._grantees(
+                'my-path/resources/{0}/data.csv'.format(resource['id'])))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_strategy', 'auto')
+    def test_migrate_acl_follows_dataset(self):
+        '''With the auto strategy only files of public datasets are
+        public-read'''
+        public = self._local_resource()
+        private = self._local_resource(private=True)
+
+        items = dict((item.name, item) for item in
+                     migration.iter_resource_items(self.storage_path))
+
+        assert_true(items[public['id']].public)
+        assert_false(items[private['id']].public)
+
+    @mock_s3
+    def test_migrate_throttled_retried(self):
+        '''Uploads S3 asks to slow down are retried, not failed'''
+        self._local_resource()
+        items = list(migration.iter_resource_items(self.storage_path))
+        migrate = migration.Migration(workers=2)
+        slow_down = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'SlowDown', 'Message': 'SlowDown'},
+             'ResponseMetadata': {'HTTPStatusCode': 503}}, 'PutObject')
+
+        with mock.patch.object(migrate.engine.client, 'upload_fileobj',
+                               side_effect=[slow_down, None]) as put:
+            stats = migrate.run(items)
+
+        assert_equal(stats['uploaded'], 1)
+        assert_equal(stats['failed'], 0)
+        assert_equal(put.call_count, 2)
+
+    @mock_s3
+    def test_migrate_resume(self):
+        '''Files recorded in the checkpoint are not looked at again'''
+        self._local_resource()
+        items = list(migration.iter_resource_items(self.storage_path))
+        checkpoint_path = os.path.join(self.storage_path, 'checkpoint')
+
+        checkpoint = migration.Checkpoint(checkpoint_path)
+        migration.Migration(checkpoint=checkpoint).run(items)
+        checkpoint.close()
+
+        checkpoint = migration.Checkpoint(checkpoint_path)
+        stats = migration.Migration(checkpoint=checkpoint).run(items)
+        checkpoint.close()
+        assert_equal(stats['resumed'], 1)
+        assert_true(items[0].name in checkpoint)
+
+    @mock_s3
+    def test_upload_items(self):
+        '''Group and user images are uploaded under storage/uploads'''
+        factories.Group(image_url='logo.png')
+        factories.Organization(image_url='http://example.com/logo.png')
+        factories.User(image_url='avatar.png')
+        for upload_to, filename in (('group', 'logo.png'),
+                                    ('user', 'avatar.png')):
+            directory = os.path.join(self.storage_path, 'storage', 'uploads',
+                                     upload_to)
+            os.makedirs(directory)
+            with open(os.path.join(directory, filename), 'w') as f:
+                f.write(filename)
+
+        items = sorted(migration.iter_upload_items(self.storage_path))
+        assert_equal([item.key for item in items],
+                     ['my-path/storage/uploads/group/logo.png',
+                      'my-path/storage/uploads/user/avatar.png'])
+        assert_true(all(item.public for item in items))
+
+        stats = migration.Migration(workers=2).run(items)
+        assert_equal(stats['uploaded'], 2)
+        assert_equal(
+            self._get_object('my-path/storage/uploads/user/avatar.png'),
+            'avatar.png')
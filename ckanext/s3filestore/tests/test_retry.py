@@ -0,0 +1,151 @@
+import time
+
+import botocore
+from nose.tools import (assert_equal,
+                        assert_true,
+                        assert_false)
+
+from ckanext.s3filestore import retry
+
+
+class _Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def _error_response(code, status):
+    return (_Response(status), {'Error': {'Code': code, 'Message': code}})
+
+
+class TestClassify(object):
+
+    def test_classify_response(self):
+        assert_equal(retry.classify_response(_error_response('SlowDown',
+                                                             503)),
+                     retry.THROTTLED)
+        assert_equal(retry.classify_response(_error_response('InternalError',
+                                                             500)),
+                     retry.TRANSIENT)
+        assert_equal(retry.classify_response(_error_response('NoSuchKey',
+                                                             404)), None)
+        assert_equal(retry.classify_response((_Response(200), {})), None)
+
+    def test_classify_exception(self):
+        error = botocore.exceptions.EndpointConnectionError(
+            endpoint_url='http://localhost')
+        assert_equal(retry.classify_response(caught_exception=error),
+                     retry.TRANSIENT)
+        assert_equal(retry.classify_error(ValueError()), None)
+
+
+class TestRetryPolicy(object):
+
+    def _policy(self, capacity=500, **kwargs):
+        return retry.RetryPolicy(retry.RetryBudget(capacity), **kwargs)
+
+    def test_throttled_retried_with_backoff(self):
+        policy = self._policy(throttle_delay=1.0, max_delay=3)
+        delays = [policy.needs_retry(response=_error_response('SlowDown',
+                                                              503),
+                                     attempts=attempts, request_dict={})
+                  for attempts in (1, 2, 3, 4)]
+        assert_true(all(0 <= delay <= 3 for delay in delays))
+        assert_equal(policy.budget.tokens, 500 - 4 * retry.RETRY_COST)
+
+    def test_not_retried(self):
+        policy = self._policy(max_attempts=3)
+        assert_equal(policy.needs_retry(response=_error_response('NoSuchKey',
+                                                                 404),
+                                        attempts=1, request_dict={}), None)
+        assert_equal(policy.needs_retry(response=_error_response('SlowDown',
+                                                                 503),
+                                        attempts=3, request_dict={}), None)
+
+    def test_budget(self):
+        '''Retries stop once the budget is used up, and successful requests
+        give the tokens back'''
+        policy = self._policy(capacity=retry.RETRY_COST)
+        request_dict = {'context': {}}
+        assert_true(policy.needs_retry(
+            response=_error_response('InternalError', 500), attempts=1,
+            request_dict=request_dict) is not None)
+        assert_equal(policy.needs_retry(
+            response=_error_response('InternalError', 500), attempts=1,
+            request_dict={}), None)
+
+        policy.needs_retry(response=(_Response(200), {}), attempts=2,
+                           request_dict=request_dict)
+        assert_equal(policy.budget.tokens, retry.RETRY_COST)
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_after_threshold(self):
+        breaker = retry.CircuitBreaker('store', threshold=3)
+        breaker.failure()
+        breaker.failure()
+        assert_true(breaker.allow())
+        breaker.failure()
+        assert_true(breaker.is_open())
+        assert_false(breaker.allow())
+
+    def test_success_resets_failures(self):
+        breaker = retry.CircuitBreaker('store', threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        assert_false(breaker.is_open())
+
+    def test_half_open(self):
+        '''After the timeout one request is let through, and closes the
+        breaker if it succeeds'''
+        breaker = retry.CircuitBreaker('store', threshold=1,
+                                       reset_timeout=10)
+        breaker.failure()
+        breaker._opened = time.time() - 11
+
+        assert_true(breaker.allow())
+        assert_false(breaker.allow())
+        breaker.success()
+        assert_true(breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        breaker = retry.CircuitBreaker('store', threshold=1,
+                                       reset_timeout=10)
+        breaker.failure()
+        breaker._opened = time.time() - 11
+
+        assert_true(breaker.allow())
+        breaker.failure()
+        assert_false(breaker.allow())
+
+    def test_disabled(self):
+        breaker = retry.CircuitBreaker('store', threshold=0)
+        for i in range(10):
+            breaker.failure()
+        assert_true(breaker.allow())
+
+    def test_throttling_not_counted(self):
+        '''SlowDown responses don't open the breaker'''
+        handler = retry._after_call('http://store')
+        breaker = retry.get_breaker('http://store')
+        try:
+            for i in range(breaker.threshold + 1):
+                response, parsed = _error_response('SlowDown', 503)
+                handler(http_response=response, parsed=parsed)
+            assert_false(breaker.is_open())
+
+            for i in range(breaker.threshold):
+                response, parsed = _error_response('InternalError', 500)
+                handler(http_response=response, parsed=parsed)
+            assert_true(breaker.is_open())
+        finally:
+            retry.reset()
+
+    def test_retry_after(self):
+        breaker = retry.CircuitBreaker('store', threshold=1,
+                                       reset_timeout=10)
+        assert_equal(breaker.retry_after(), 0)
+        breaker.failure()
+        assert_true(9 < breaker.retry_after() <= 10)
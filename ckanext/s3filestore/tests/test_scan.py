@@ -0,0 +1,72 @@
+from nose.tools import assert_equal
+from moto import mock_s3
+
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore import scan
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+class TestScan(helpers.FunctionalTestBase):
+
+    def _put(self, key):
+        upload = BaseS3Uploader()
+        upload.get_s3_client().put_object(Bucket=upload.bucket_name,
+                                          Key=key, Body='data')
+
+    @mock_s3
+    def test_scan(self):
+        '''Missing, orphaned and mismatched files are reported'''
+        dataset = factories.Dataset()
+        ok = factories.Resource(package_id=dataset['id'], url='ok.csv',
+                                url_type='upload')
+        missing = factories.Resource(package_id=dataset['id'],
+                                     url='missing.csv', url_type='upload')
+        mismatch = factories.Resource(package_id=dataset['id'],
+                                      url='new.csv', url_type='upload')
+        link = factories.Resource(package_id=dataset['id'],
+                                  url='http://example.com/link.csv')
+
+        self._put('my-path/resources/{0}/ok.csv'.format(ok['id']))
+        self._put('my-path/resources/{0}/old.csv'.format(ok['id']))
+        self._put('my-path/resources/{0}/old.csv'.format(mismatch['id']))
+        self._put('my-path/resources/{0}/link.csv'.format(link['id']))
+        self._put('my-path/resources/'
+                  '00000000-0000-0000-0000-000000000000/gone.csv')
+
+        issues = []
+        stats = scan.scan(issues.append, workers=4)
+
+        assert_equal(sorted(issues), sorted([
+            scan.Issue(scan.ORPHAN, ok['id'],
+                       'my-path/resources/{0}/old.csv'.format(ok['id'])),
+            scan.Issue(scan.MISSING, missing['id'], None),
+            scan.Issue(scan.MISMATCH, mismatch['id'],
+                       'my-path/resources/{0}/old.csv'.format(
+                           mismatch['id'])),
+            scan.Issue(scan.ORPHAN, link['id'],
+                       'my-path/resources/{0}/link.csv'.format(link['id'])),
+            scan.Issue(scan.ORPHAN, '00000000-0000-0000-0000-000000000000',
+                       'my-path/resources/'
+                       '00000000-0000-0000-0000-000000000000/gone.csv'),
+        ]))
+        assert_equal(stats[scan.ORPHAN], 3)
+
+    @mock_s3
+    def test_scan_ids_outside_shards(self):
+        '''Resources whose id is not hex are scanned too'''
+        dataset = factories.Dataset()
+        missing = factories.Resource(id='my-resource', url='data.csv',
+                                     package_id=dataset['id'],
+                                     url_type='upload')
+        self._put('my-path/resources/Other-Id/data.csv')
+
+        issues = []
+        scan.scan(issues.append, workers=4)
+
+        assert_equal(sorted(issues), sorted([
+            scan.Issue(scan.MISSING, missing['id'], None),
+            scan.Issue(scan.ORPHAN, 'Other-Id',
+                       'my-path/resources/Other-Id/data.csv'),
+        ]))
@@ -0,0 +1,56 @@
+from nose.tools import assert_equal, assert_true, assert_raises
+
+from ckanext.s3filestore import settings
+
+
+class TestSettings(object):
+
+    def teardown(self):
+        settings.reset()
+
+    def test_defaults(self):
+        s3_settings = settings.parse({})
+        assert_equal(s3_settings.aws_storage_path, '')
+        assert_equal(s3_settings.bucket_check_ttl, 3600)
+        assert_equal(s3_settings.hash_algorithm, 'sha256')
+        assert_equal(s3_settings.deferred_delete, False)
+        assert_equal(s3_settings.max_resource_size, 10)
+        assert_equal(s3_settings.max_image_size, 2)
+
+    def test_values_converted(self):
+        s3_settings = settings.parse({
+            'ckanext.s3filestore.aws_bucket_name': 'my-bucket',
+            'ckanext.s3filestore.max_pool_connections': '32',
+            'ckanext.s3filestore.deferred_delete': 'true',
+            'ckanext.s3filestore.signed_url_reuse_fraction': '0.25',
+            'ckanext.s3filestore.hash_algorithm': 'None',
+            'ckan.max_resource_size': '100',
+        })
+        assert_equal(s3_settings.aws_bucket_name, 'my-bucket')
+        assert_equal(s3_settings.max_pool_connections, 32)
+        assert_equal(s3_settings.deferred_delete, True)
+        assert_equal(s3_settings.signed_url_reuse_fraction, 0.25)
+        assert_equal(s3_settings.hash_algorithm, None)
+        assert_equal(s3_settings.max_resource_size, 100)
+
+    def test_invalid_value(self):
+        assert_raises(ValueError, settings.parse,
+                      {'ckanext.s3filestore.hash_algorithm': 'nope'})
+        assert_raises(ValueError, settings.parse,
+                      {'ckanext.s3filestore.connect_timeout': 'soon'})
+
+    def test_invalid_reuse_fraction(self):
+        for value in ('0', '-0.5', '1.5'):
+            assert_raises(ValueError, settings.parse, {
+                'ckanext.s3filestore.signed_url_reuse_fraction': value})
+        s3_settings = settings.parse(
+            {'ckanext.s3filestore.signed_url_reuse_fraction': '1'})
+        assert_equal(s3_settings.signed_url_reuse_fraction, 1)
+
+    def test_load(self):
+        loaded = settings.load({'ckanext.s3filestore.aws_bucket_name': 'a'})
+        assert_true(settings.get() is loaded)
+
+    def test_invalid_download_strategy(self):
+        assert_raises(ValueError, settings.parse,
+                      {'ckanext.s3filestore.download_strategy': 'magic'})
@@ -1,10 +1,15 @@
+import cgi
 import datetime
+import hashlib
 import os
+import time
+from StringIO import StringIO
 
 import mock
 from nose.tools import (assert_equal,
                         assert_true,
-                        assert_false)
+                        assert_false,
+                        assert_raises)
 
 import ckanapi
 from ckantoolkit import config
@@ -16,8 +21,12 @@ import ckantoolkit as toolkit
 import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 
-from ckanext.s3filestore.uploader import (S3Uploader,
+from ckanext.s3filestore import bulk, db, settings, uploader
+from ckanext.s3filestore.uploader import (MB,
+                                          BaseS3Uploader,
+                                          S3Uploader,
                                           S3ResourceUploader)
+from ckanext.s3filestore.tests.utils import change_config
 
 
 class Uploader(Upload):
@@ -203,3 +212,445 @@ class TestS3ResourceUploader(helpers.FunctionalTestBase):
                        'id': '', # Emtpy id from the form
                        'url': 'http://asdf', 'save': 'save'},
                  extra_environ=env)
+
+
+class TestS3BucketCheck(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestS3BucketCheck, self).setup()
+        uploader._bucket_checks.clear()
+
+    def test_constructor_does_not_check_bucket(self):
+        '''Constructing uploaders makes no requests to S3'''
+        with mock.patch.object(BaseS3Uploader, '_check_s3_bucket',
+                               return_value=True) as check:
+            S3Uploader('group')
+            S3ResourceUploader({})
+        assert_equal(check.call_count, 0)
+
+    @mock_s3
+    def test_bucket_checked_once(self):
+        '''The bucket is only checked the first time it is needed'''
+        with mock.patch.object(BaseS3Uploader, '_check_s3_bucket',
+                               return_value=True) as check:
+            S3Uploader('group').check_bucket()
+            upload = S3Uploader('user')
+            upload.get_s3_bucket(upload.bucket_name)
+        assert_equal(check.call_count, 1)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.bucket_check_ttl', '1')
+    def test_bucket_checked_again_after_ttl(self):
+        '''The bucket is checked again once the TTL has expired'''
+        with mock.patch.object(BaseS3Uploader, '_check_s3_bucket',
+                               return_value=True) as check:
+            S3Uploader('group').check_bucket()
+            with mock.patch('ckanext.s3filestore.uploader.time') as mock_time:
+                mock_time.time.return_value = time.time() + 10
+                S3Uploader('group').check_bucket()
+        assert_equal(check.call_count, 2)
+
+
+class TestS3TransferConfig(helpers.FunctionalTestBase):
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.multipart_threshold',
+                   '16777216')
+    @change_config('ckanext.s3filestore.multipart_chunksize',
+                   '5242880')
+    @change_config('ckanext.s3filestore.max_concurrency', '2')
+    def test_transfer_config(self):
+        '''Multipart settings are read from the config'''
+        transfer_config = S3Uploader('group').get_transfer_config()
+        assert_equal(transfer_config.multipart_threshold, 16777216)
+        assert_equal(transfer_config.multipart_chunksize, 5242880)
+        assert_equal(transfer_config.max_concurrency, 2)
+        # memory use is bounded by part size x concurrency
+        assert_equal(transfer_config.max_in_memory_upload_chunks, 2)
+
+
+class TestS3SignedUrls(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestS3SignedUrls, self).setup()
+        uploader._get_signed_url_cache().clear()
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.signed_url_expiry', '3600')
+    def test_signed_url_reused(self):
+        '''The same signed url is returned within the reuse period'''
+        s3_uploader = S3Uploader('group')
+        url, max_age = s3_uploader.get_signed_url('my-path/some-key')
+        assert_equal(s3_uploader.get_signed_url('my-path/some-key')[0], url)
+        assert_true(0 < max_age <= 1800)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.signed_url_reuse_fraction',
+                   '0')
+    def test_signed_url_not_cached(self):
+        '''Signed urls are not cached when reuse is disabled'''
+        url, max_age = S3Uploader('group').get_signed_url('my-path/some-key')
+        assert_equal(max_age, 0)
+        assert_equal(len(uploader._get_signed_url_cache()), 0)
+
+
+class TestHashingReader(object):
+
+    def test_size_and_digest(self):
+        reader = uploader.HashingReader(StringIO('date,price\n'), 'md5')
+
+        while reader.read(4):
+            pass
+
+        assert_equal(reader.size, 11)
+        assert_equal(reader.hexdigest(),
+                     hashlib.md5('date,price\n').hexdigest())
+
+    def test_not_seekable(self):
+        reader = uploader.HashingReader(StringIO('data'))
+
+        assert_false(hasattr(reader, 'seek'))
+        assert_equal(reader.hexdigest(), None)
+
+    def test_max_size(self):
+        reader = uploader.HashingReader(StringIO('date,price\n'),
+                                        max_size=11)
+        assert_equal(reader.read(), 'date,price\n')
+
+        reader = uploader.HashingReader(StringIO('date,price\n'),
+                                        max_size=6)
+        assert_equal(reader.read(4), 'date')
+        assert_raises(uploader.FileTooLargeError, reader.read)
+        assert_equal(reader.size, 7)
+
+
+class Stream(StringIO):
+
+    '''A file whose size can't be known without reading it.'''
+
+    def seek(self, pos, mode=0):
+        if mode != 0:
+            raise IOError('Illegal seek')
+        StringIO.seek(self, pos, mode)
+
+
+class FieldStorage(cgi.FieldStorage):
+
+    '''An uploaded file, without a request to parse.'''
+
+    def __init__(self, fileobj, filename):
+        self.name = 'upload'
+        self.file = fileobj
+        self.filename = filename
+        self.list = None
+
+
+class TestS3UploadSize(helpers.FunctionalTestBase):
+
+    @mock_s3
+    def test_known_size_refused_before_upload(self):
+        upload = BaseS3Uploader()
+        with mock.patch.object(upload, 'check_bucket') as check_bucket:
+            assert_raises(toolkit.ValidationError, upload.upload_to_key,
+                          'size/data.csv', StringIO('date,price\n'),
+                          max_size=4)
+        assert_false(check_bucket.called)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.multipart_threshold',
+                   str(5 * 1024 * 1024))
+    @change_config('ckanext.s3filestore.multipart_chunksize',
+                   str(5 * 1024 * 1024))
+    def test_stream_stopped_at_limit(self):
+        '''Streams are aborted once they go over the limit'''
+        upload = BaseS3Uploader()
+        stream = Stream('x' * 12 * 1024 * 1024)
+
+        assert_raises(toolkit.ValidationError, upload.upload_to_key,
+                      'size/large.bin', stream, max_size=6 * 1024 * 1024)
+
+        assert_false(upload.key_exists('size/large.bin'))
+        assert_true(stream.tell() < 12 * 1024 * 1024)
+
+    def _resource_uploader(self, fileobj):
+        resource = factories.Resource(url='http://example')
+        upload = S3ResourceUploader(
+            {'upload': FieldStorage(fileobj, 'data.bin')})
+        return resource['id'], upload
+
+    @mock_s3
+    @change_config('ckan.max_resource_size', '1')
+    def test_resource_upload_too_large(self):
+        '''Resource uploads default to ckan.max_resource_size'''
+        assert_equal(uploader.settings.get().max_resource_size, 1)
+        resource_id, upload = self._resource_uploader(
+            Stream('x' * (MB + 1)))
+
+        with mock.patch.object(uploader, 'HashingReader',
+                               wraps=uploader.HashingReader) as reader:
+            assert_raises(toolkit.ValidationError, upload.upload,
+                          resource_id)
+        # The size was only found out while streaming
+        assert_equal(reader.call_args[0][2], MB)
+        assert_false(upload.key_exists(
+            upload.get_path(resource_id, 'data.bin')))
+
+    @mock_s3
+    @change_config('ckan.max_resource_size', '1')
+    def test_resource_upload_known_size_too_large(self):
+        resource_id, upload = self._resource_uploader(
+            StringIO('x' * (MB + 1)))
+
+        with mock.patch.object(uploader, 'HashingReader') as reader:
+            assert_raises(toolkit.ValidationError, upload.upload,
+                          resource_id)
+        assert_false(reader.called)
+
+    @mock_s3
+    @change_config('ckan.max_resource_size', '1')
+    def test_resource_upload_max_size(self):
+        '''An explicit max_size replaces the setting'''
+        resource_id, upload = self._resource_uploader(
+            Stream('x' * (MB + 1)))
+
+        upload.upload(resource_id, max_size=2)
+
+        assert_true(upload.key_exists(
+            upload.get_path(resource_id, 'data.bin')))
+
+
+class TestS3ResourceHash(helpers.FunctionalTestBase):
+
+    def _upload(self):
+        factories.Sysadmin(apikey="my-test-key")
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        factories.Dataset(name="my-dataset")
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        resource = demo.action.resource_create(package_id='my-dataset',
+                                               upload=open(file_path),
+                                               url='file.txt')
+        return demo.action.resource_show(id=resource['id']), \
+            open(file_path).read()
+
+    @mock_s3
+    def test_size_and_hash_stored(self):
+        '''The size and digest of uploaded files are set on the resource'''
+        resource, content = self._upload()
+
+        assert_equal(resource['size'], len(content))
+        assert_equal(resource['hash'], hashlib.sha256(content).hexdigest())
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.hash_algorithm', 'md5')
+    @change_config('ckanext.s3filestore.hash_metadata', 'true')
+    def test_hash_metadata(self):
+        '''The digest can also be stored in the object metadata, without
+        copying the object'''
+        with mock.patch.object(S3ResourceUploader, 'copy_key') as copy_key:
+            resource, content = self._upload()
+        assert_false(copy_key.called)
+        key = '{1}/resources/{0}/data.csv' \
+            .format(resource['id'],
+                    config.get('ckanext.s3filestore.aws_storage_path'))
+
+        assert_equal(resource['hash'], hashlib.md5(content).hexdigest())
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_equal(bucket.get_key(key).get_metadata('md5'),
+                     resource['hash'])
+
+
+class TestS3ContentAddressed(helpers.FunctionalTestBase):
+
+    def _upload(self, demo, dataset):
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        return demo.action.resource_create(package_id=dataset['id'],
+                                           upload=open(file_path),
+                                           url='file.txt')
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_identical_uploads_share_a_blob(self):
+        '''The same file uploaded twice is only stored once'''
+        factories.Sysadmin(apikey="my-test-key")
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset()
+        first = self._upload(demo, dataset)
+        second = self._upload(demo, dataset)
+
+        content = open(os.path.join(os.path.dirname(__file__),
+                                    'data.csv')).read()
+        digest = hashlib.sha256(content).hexdigest()
+        key = '{0}/blobs/sha256/{1}/{2}'.format(
+            config.get('ckanext.s3filestore.aws_storage_path'),
+            digest[:2], digest)
+        assert_equal(db.get_resource_blob(first['id']), key)
+        assert_equal(db.get_resource_blob(second['id']), key)
+
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_equal([k.name for k in bucket.list()], [key])
+
+        # The blob is kept until no resource uses it
+        demo.action.resource_update(id=first['id'], url='http://example',
+                                    clear_upload=True)
+        assert_true(bucket.lookup(key))
+        demo.action.resource_update(id=second['id'], url='http://example',
+                                    clear_upload=True)
+        # Unused blobs are only removed by the delete queue
+        assert_true(bucket.lookup(key))
+        assert_equal(bulk.process_delete_queue(), (1, 0))
+        assert_false(bucket.lookup(key))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_queued_blob_used_again(self):
+        '''A queued blob is kept if a resource points to it again'''
+        factories.Sysadmin(apikey="my-test-key")
+        demo = ckanapi.TestAppCKAN(self._get_test_app(),
+                                   apikey='my-test-key')
+        dataset = factories.Dataset()
+        first = self._upload(demo, dataset)
+        demo.action.resource_update(id=first['id'], url='http://example',
+                                    clear_upload=True)
+        second = self._upload(demo, dataset)
+
+        assert_equal(bulk.process_delete_queue(), (0, 0))
+        bucket = boto.connect_s3().get_bucket('my-bucket')
+        assert_true(bucket.lookup(db.get_resource_blob(second['id'])))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_download_resolves_blob(self):
+        '''Downloads are redirected to the blob, under the resource filename'''
+        factories.Sysadmin(apikey="my-test-key")
+        app = self._get_test_app()
+        demo = ckanapi.TestAppCKAN(app, apikey='my-test-key')
+        dataset = factories.Dataset()
+        resource = self._upload(demo, dataset)
+
+        response = app.get('/dataset/{0}/resource/{1}/download/data.csv'
+                           .format(dataset['id'], resource['id']))
+
+        location = response.headers['Location']
+        assert_true('/blobs/sha256/' in location)
+        assert_true('filename%3D%22data.csv%22' in location)
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_blob_kept_when_disabled(self):
+        '''Resources keep pointing to their blob once content addressed
+        storage is turned off'''
+        factories.Sysadmin(apikey="my-test-key")
+        app = self._get_test_app()
+        demo = ckanapi.TestAppCKAN(app, apikey='my-test-key')
+        dataset = factories.Dataset()
+        resource = self._upload(demo, dataset)
+
+        config['ckanext.s3filestore.content_addressed'] = 'false'
+        settings.reset()
+        response = app.get('/dataset/{0}/resource/{1}/download/data.csv'
+                           .format(dataset['id'], resource['id']))
+
+        assert_true('/blobs/sha256/' in response.headers['Location'])
+
+
+class TestS3DownloadStrategy(helpers.FunctionalTestBase):
+
+    def _upload(self, private=False):
+        factories.Sysadmin(apikey="my-test-key")
+        app = self._get_test_app()
+        demo = ckanapi.TestAppCKAN(app, apikey='my-test-key')
+        organization = factories.Organization()
+        dataset = factories.Dataset(owner_org=organization['id'],
+                                    private=private)
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        resource = demo.action.resource_create(package_id=dataset['id'],
+                                               upload=open(file_path),
+                                               url='file.txt')
+        return dataset, resource, demo, app
+
+    def _is_public_read(self, resource):
+        upload = BaseS3Uploader()
+        grants = upload.get_s3_client().get_object_acl(
+            Bucket=upload.bucket_name,
+            Key='my-path/resources/{0}/data.csv'.format(resource['id']))
+        return any(grant['Grantee'].get('URI', '').endswith('AllUsers')
+                   for grant in grants['Grants'])
+
+    def test_default_download_strategy(self):
+        assert_equal(BaseS3Uploader().get_download_strategy(), 'presigned')
+
+    @change_config('ckanext.s3filestore.download_mode', 'proxy')
+    def test_legacy_download_mode(self):
+        '''download_mode = proxy still works'''
+        assert_equal(BaseS3Uploader().get_download_strategy(), 'proxy')
+
+    @change_config('ckanext.s3filestore.public_base_url',
+                   'https://cdn.example.com/files/')
+    def test_public_url(self):
+        upload = BaseS3Uploader()
+        assert_equal(upload.get_public_url('my-path/a file.csv'),
+                     'https://cdn.example.com/files/my-path/a%20file.csv')
+
+    @mock_s3
+    def test_presigned_files_private(self):
+        '''By default files are private, and downloaded with presigned
+        urls'''
+        dataset, resource, demo, app = self._upload()
+
+        assert_false(self._is_public_read(resource))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_strategy', 'auto')
+    def test_auto_public_dataset(self):
+        '''Files of public datasets are public-read and downloaded from
+        their plain url'''
+        dataset, resource, demo, app = self._upload()
+
+        response = app.get('/dataset/{0}/resource/{1}/download/data.csv'
+                           .format(dataset['id'], resource['id']),
+                           status=[302])
+
+        assert_true(self._is_public_read(resource))
+        assert_equal(response.headers['Location'],
+                     BaseS3Uploader().get_public_url(
+                         'my-path/resources/{0}/data.csv'.format(
+                             resource['id'])))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_strategy', 'auto')
+    def test_auto_private_dataset(self):
+        '''Files of private datasets are private and presigned'''
+        dataset, resource, demo, app = self._upload(private=True)
+
+        response = app.get('/dataset/{0}/resource/{1}/download/data.csv'
+                           .format(dataset['id'], resource['id']),
+                           status=[302])
+
+        assert_false(self._is_public_read(resource))
+        assert_true('Expires=' in response.headers['Location'])
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_strategy', 'auto')
+    def test_auto_visibility_change(self):
+        '''The ACL of the files follows the visibility of the dataset'''
+        dataset, resource, demo, app = self._upload()
+
+        demo.action.package_patch(id=dataset['id'], private=True)
+        assert_false(self._is_public_read(resource))
+
+        demo.action.package_patch(id=dataset['id'], private=False)
+        assert_true(self._is_public_read(resource))
+
+    @mock_s3
+    @change_config('ckanext.s3filestore.download_strategy', 'auto')
+    def test_auto_visibility_unchanged(self):
+        '''Updates that keep the visibility don't touch the ACLs'''
+        dataset, resource, demo, app = self._upload()
+
+        with mock.patch.object(bulk, 'update_package_acls') as update:
+            demo.action.package_patch(id=dataset['id'], title='New title')
+            assert_false(update.called)
+            demo.action.package_patch(id=dataset['id'], private=True)
+            update.assert_called_once_with(dataset['id'], changed=True)
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import urlparse
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal, assert_true, assert_raises
+from moto import mock_s3
+
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import settings, urls
+from ckanext.s3filestore.tests.utils import change_config
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+def _private_key_pem():
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        raise SkipTest('cryptography is not installed')
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                   backend=default_backend())
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption())
+
+
+class TestUrls(object):
+
+    def test_path_style(self):
+        assert_equal(urls.get_base_url('http://localhost:5000/', 'bucket'),
+                     'http://localhost:5000/bucket')
+
+    def test_virtual_style(self):
+        assert_equal(urls.get_base_url('https://s3.eu-west-1.amazonaws.com',
+                                       'bucket', 'virtual'),
+                     'https://bucket.s3.eu-west-1.amazonaws.com')
+
+    def test_build_url_quotes_key(self):
+        assert_equal(urls.build_url('https://cdn.example.com/',
+                                    u'resources/1/caf\xe9 menu.csv'),
+                     'https://cdn.example.com/resources/1/caf%C3%A9%20menu.csv')
+
+    def test_invalid_url_style(self):
+        assert_raises(ValueError, settings.parse,
+                      {'ckanext.s3filestore.url_style': 'dns'})
+
+
+class TestCloudFrontUrls(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestCloudFrontUrls, self).setup()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.key_path = os.path.join(self.tmp_dir, 'cloudfront.pem')
+        with open(self.key_path, 'wb') as f:
+            f.write(_private_key_pem())
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+        urls.reset()
+
+    def test_not_enabled(self):
+        assert_equal(urls.get_cloudfront_signer(), None)
+
+    def test_sign_url(self):
+        signer = urls.create_signer('APKAEXAMPLE',
+                                    open(self.key_path, 'rb').read())
+
+        url = urls.sign_url(signer, 'https://cdn.example.com/a.csv',
+                            1500000000)
+
+        parts = urlparse.urlsplit(url)
+        params = urlparse.parse_qs(parts.query)
+        assert_equal(parts.path, '/a.csv')
+        assert_equal(params['Expires'], ['1500000000'])
+        assert_equal(params['Key-Pair-Id'], ['APKAEXAMPLE'])
+        assert_true(params['Signature'][0])
+
+    @mock_s3
+    def test_signed_download_urls(self):
+        '''Downloads are signed for the CDN instead of presigned for S3'''
+        @change_config('ckanext.s3filestore.public_base_url',
+                       'https://cdn.example.com')
+        @change_config('ckanext.s3filestore.cloudfront_key_pair_id',
+                       'APKAEXAMPLE')
+        @change_config('ckanext.s3filestore.cloudfront_private_key',
+                       self.key_path)
+        def test():
+            upload = BaseS3Uploader()
+            url, max_age = upload.get_signed_url('cdn/data.csv')
+            assert_true(url.startswith('https://cdn.example.com/cdn/data.csv?'))
+            assert_true('Key-Pair-Id=APKAEXAMPLE' in url)
+
+            # Content-Disposition needs S3 presigned urls
+            url, max_age = upload.get_signed_url('cdn/data.csv',
+                                                 filename='data.csv')
+            assert_true('cdn.example.com' not in url)
+        test()
@@ -0,0 +1,24 @@
+import functools
+
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import connection, settings, urls
+
+
+def change_config(key, value):
+    '''Like ckan.tests.helpers.change_config, but also parses the extension
+    settings again, before and after the test.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            settings.reset()
+            connection.reset()
+            urls.reset()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                settings.reset()
+                connection.reset()
+                urls.reset()
+        return helpers.change_config(key, value)(wrapper)
+    return decorator
@@ -1,17 +1,24 @@
 import os
 import cgi
 import logging
+import time
+import hashlib
 import datetime
 import mimetypes
+import threading
 
-import boto3
 import botocore
 import ckantoolkit as toolkit
+from boto3.s3.transfer import TransferConfig
 
 
 import ckan.model as model
 import ckan.lib.munge as munge
 
+from ckanext.s3filestore import (connection, db, metrics, retry, settings,
+                                 urls)
+from ckanext.s3filestore.cache import LRUCache
+
 if toolkit.check_ckan_version(min_version='2.7.0'):
     from werkzeug.datastructures import FileStorage as FlaskFileStorage
     ALLOWED_UPLOAD_TYPES = (cgi.FieldStorage, FlaskFileStorage)
@@ -22,8 +29,30 @@ config = toolkit.config
 log = logging.getLogger(__name__)
 
 _storage_path = None
-_max_resource_size = None
-_max_image_size = None
+
+MB = 1024 * 1024
+
+# Digest used for the keys of content addressed files, and stored as the
+# resource hash for them whatever `ckanext.s3filestore.hash_algorithm` is
+BLOB_ALGORITHM = 'sha256'
+
+# Time of the last successful check for each (host, bucket)
+_bucket_checks = {}
+_bucket_checks_lock = threading.Lock()
+
+# Presigned urls, keyed by (bucket, key, filename, reuse window)
+_signed_urls = None
+_signed_urls_lock = threading.Lock()
+
+
+def _get_signed_url_cache():
+    global _signed_urls
+    if _signed_urls is None:
+        with _signed_urls_lock:
+            if _signed_urls is None:
+                _signed_urls = LRUCache(
+                    maxsize=settings.get().signed_url_cache_size)
+    return _signed_urls
 
 
 def _get_underlying_file(wrapper):
@@ -36,102 +65,403 @@ class S3FileStoreException(Exception):
     pass
 
 
+class FileTooLargeError(S3FileStoreException):
+    pass
+
+
+def _raise_too_large():
+    raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+
+def _check_size(fileobj, max_size):
+    '''Raise a ValidationError if the size of `fileobj` is known and over
+    `max_size` bytes.'''
+    if max_size is None:
+        return
+    try:
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+    except (AttributeError, IOError, ValueError):
+        return
+    if size > max_size:
+        metrics.incr('upload_too_large')
+        _raise_too_large()
+
+
+class HashingReader(object):
+    '''Wraps a file object, keeping count of the size and digest of the data
+    read from it.
+
+    The wrapper can't seek, so the transfer manager reads the file exactly
+    once and in order, and the digest is ready when the upload finishes.
+
+    If `max_size` is given, FileTooLargeError is raised as soon as more
+    than `max_size` bytes have been read, which makes the transfer manager
+    stop and abort the upload.
+    '''
+
+    def __init__(self, fileobj, algorithm=None, max_size=None):
+        self._fileobj = fileobj
+        self.algorithm = algorithm
+        self.max_size = max_size
+        self.size = 0
+        self._hash = hashlib.new(algorithm) if algorithm else None
+
+    def read(self, size=-1):
+        if self.max_size is not None:
+            # Never read more than one byte past the limit
+            remaining = self.max_size - self.size + 1
+            if size is None or size < 0 or size > remaining:
+                size = remaining
+        data = self._fileobj.read(size)
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise FileTooLargeError(
+                'File is larger than {0} bytes'.format(self.max_size))
+        if self._hash is not None:
+            self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        if self._hash is None:
+            return None
+        return self._hash.hexdigest()
+
+
 class BaseS3Uploader(object):
 
+    '''
+    Base class for the uploaders.
+
+    Constructing an uploader is cheap: it only reads the parsed settings.
+    Clients are created, and the bucket checked, the first time a request
+    to S3 is actually needed.
+    '''
+
     def __init__(self):
-        self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
-        self.p_key = config.get('ckanext.s3filestore.aws_access_key_id')
-        self.s_key = config.get('ckanext.s3filestore.aws_secret_access_key')
-        self.region = config.get('ckanext.s3filestore.region_name')
-        self.signature = config.get('ckanext.s3filestore.signature_version')
-        self.host_name = config.get('ckanext.s3filestore.host_name')
-        self.bucket = self.get_s3_bucket(self.bucket_name)
+        self.settings = settings.get()
+        self.bucket_name = self.settings.aws_bucket_name
+        self.p_key = self.settings.aws_access_key_id
+        self.s_key = self.settings.aws_secret_access_key
+        self.region = self.settings.region_name
+        self.signature = self.settings.signature_version
+        self.host_name = self.settings.host_name
+
+    @property
+    def bucket(self):
+        return self.get_s3_bucket(self.bucket_name)
 
     def get_directory(self, id, storage_path):
         directory = os.path.join(storage_path, id)
         return directory
 
     def get_s3_session(self):
-        return boto3.session.Session(aws_access_key_id=self.p_key,
-                                     aws_secret_access_key=self.s_key,
-                                     region_name=self.region)
+        return connection.get_session(self.p_key, self.s_key, self.region)
+
+    def get_s3_client(self):
+        '''Return the shared boto3 client for the configured connection.'''
+        return connection.get_client(self.p_key, self.s_key, self.region,
+                                     self.host_name, self.signature)
+
+    def get_s3_resource(self):
+        '''Return a boto3 S3 resource for the configured connection.'''
+        return connection.get_resource(self.p_key, self.s_key, self.region,
+                                       self.host_name, self.signature)
 
     def get_s3_bucket(self, bucket_name):
         '''Return a boto bucket, creating it if it doesn't exist.'''
+        self.check_bucket(bucket_name)
+        return self.get_s3_resource().Bucket(bucket_name)
 
-        # make s3 connection using boto3
+    def check_bucket(self, bucket_name=None):
+        '''Make sure the bucket exists, creating it if it doesn't.
 
-        s3 = self.get_s3_session().resource('s3', endpoint_url=self.host_name,
-                                            config=botocore.client.Config(
-                                             signature_version=self.signature))
-        bucket = s3.Bucket(bucket_name)
+        The bucket is only checked against S3 the first time it is needed,
+        and then again once `ckanext.s3filestore.bucket_check_ttl` seconds
+        (default 3600, 0 to never check again) have passed.
+        '''
+        bucket_name = bucket_name or self.bucket_name
+        check_key = (self.host_name, bucket_name)
+        ttl = self.settings.bucket_check_ttl
+        checked = _bucket_checks.get(check_key)
+        if checked is None or (ttl and time.time() - checked > ttl):
+            with _bucket_checks_lock:
+                checked = _bucket_checks.get(check_key)
+                if checked is None or (ttl and time.time() - checked > ttl):
+                    if self._check_s3_bucket(bucket_name):
+                        _bucket_checks[check_key] = time.time()
+
+    def _check_s3_bucket(self, bucket_name):
+        '''Check that the bucket exists with a HeadBucket request, creating
+        it if it doesn't. Returns whether the bucket is available.'''
+        client = self.get_s3_client()
         try:
-            if s3.Bucket(bucket.name) in s3.buckets.all():
-                log.info('Bucket {0} found!'.format(bucket_name))
-
-            else:
-                log.warning(
-                    'Bucket {0} could not be found,\
-                    attempting to create it...'.format(bucket_name))
-                try:
-                    bucket = s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={
-                        'LocationConstraint': 'us-east-1'})
-                    log.info(
-                        'Bucket {0} succesfully created'.format(bucket_name))
-                except botocore.exceptions.ClientError as e:
-                    log.warning('Could not create bucket {0}: {1}'.format(
-                        bucket_name, str(e)))
+            client.head_bucket(Bucket=bucket_name)
+            log.info('Bucket {0} found!'.format(bucket_name))
+            return True
         except botocore.exceptions.ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                log.warning('Bucket {0} could not be found, ' +
+            error_code = e.response['Error']['Code']
+            if error_code in ('404', 'NoSuchBucket'):
+                log.warning('Bucket {0} could not be found, '
                             'attempting to create it...'.format(bucket_name))
+                create_args = {'Bucket': bucket_name}
+                if self.region and self.region != 'us-east-1':
+                    create_args['CreateBucketConfiguration'] = {
+                        'LocationConstraint': self.region}
                 try:
-                    bucket = s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={
-                        'LocationConstraint': self.region})
+                    client.create_bucket(**create_args)
                     log.info(
                         'Bucket {0} succesfully created'.format(bucket_name))
+                    return True
                 except botocore.exceptions.ClientError as e:
                     log.warning('Could not create bucket {0}: {1}'.format(
                         bucket_name, str(e)))
-            elif error_code == 403:
+                    return False
+            elif error_code == '403':
                 raise S3FileStoreException(
                     'Access to bucket {0} denied'.format(bucket_name))
             else:
                 raise S3FileStoreException(
                     'Something went wrong for bucket {0}'.format(bucket_name))
 
-        return bucket
+    def get_transfer_config(self):
+        '''Return the settings used for managed (multipart) transfers.
 
-    def upload_to_key(self, filepath, upload_file, make_public=False):
-        '''Uploads the `upload_file` to `filepath` on `self.bucket`.'''
-        upload_file.seek(0)
+        Files larger than `ckanext.s3filestore.multipart_threshold` bytes
+        (default 8MB) are sent in parts of
+        `ckanext.s3filestore.multipart_chunksize` bytes (default 8MB), using
+        up to `ckanext.s3filestore.max_concurrency` threads (default 4).
+        '''
+        max_concurrency = self.settings.max_concurrency
+        transfer_config = TransferConfig(
+            multipart_threshold=self.settings.multipart_threshold,
+            multipart_chunksize=self.settings.multipart_chunksize,
+            max_concurrency=max_concurrency,
+            use_threads=max_concurrency > 1)
+        # Parts are read into memory before being sent, so only keep as
+        # many of them around as can be uploaded at the same time.
+        transfer_config.max_in_memory_upload_chunks = max_concurrency
+        return transfer_config
+
+    def get_download_strategy(self):
+        '''Return how resource files are downloaded, set with
+        `ckanext.s3filestore.download_strategy`:
+
+            presigned (default)
+                Files are private and downloads are redirected to
+                presigned urls
+            auto
+                Files of public datasets are public-read and downloads are
+                redirected to their plain url (see `get_public_url`), the
+                ones of private datasets are private and presigned
+            proxy
+                Files are private and streamed through CKAN
+
+        The older `ckanext.s3filestore.download_mode = proxy` is the same
+        as the proxy strategy.
+        '''
+        strategy = self.settings.download_strategy
+        if strategy is None:
+            if self.settings.download_mode == 'proxy':
+                return 'proxy'
+            return 'presigned'
+        return strategy
 
-        session = boto3.session.Session(aws_access_key_id=self.p_key,
-                                        aws_secret_access_key=self.s_key,
-                                        region_name=self.region)
-        s3 = session.resource('s3', endpoint_url=self.host_name,
-                              config=botocore.client.Config(signature_version=self.signature))
+    def get_public_url(self, filepath):
+        '''Return the plain url of a public-read file, see `urls`.
+
+        No request is made to S3.
+        '''
+        base_url = self.settings.public_base_url
+        if not base_url:
+            endpoint_url = self.host_name or \
+                self.get_s3_client().meta.endpoint_url
+            base_url = urls.get_base_url(endpoint_url, self.bucket_name,
+                                         self.settings.url_style)
+        return urls.build_url(base_url, filepath)
+
+    def get_signed_url(self, filepath, filename=None):
+        '''Return a presigned GET url for `filepath` and the number of
+        seconds the url can be cached for.
+
+        If `filename` is given, S3 is asked to serve the file under that
+        name, with a content type guessed from it.
+
+        Urls are valid for `ckanext.s3filestore.signed_url_expiry` seconds
+        (default 60). The same url is handed out during the first
+        `ckanext.s3filestore.signed_url_reuse_fraction` (default 0.5) of
+        that time, so browsers and caches get a stable url for a while and
+        it is never used after it has expired.
+
+        If CloudFront signed urls are enabled (see `urls`) they are used
+        instead of S3 presigned urls, except when a `filename` is given.
+        '''
+        expiry = self.settings.signed_url_expiry
+        reuse_period = int(expiry * self.settings.signed_url_reuse_fraction)
+
+        if reuse_period <= 0:
+            return self._generate_signed_url(filepath, expiry, filename), 0
+
+        now = time.time()
+        window = int(now // reuse_period)
+        cache_key = (self.bucket_name, filepath, filename, window)
+        signed_urls = _get_signed_url_cache()
+        url = signed_urls.get(cache_key)
+        if url is None:
+            url = self._generate_signed_url(filepath, expiry, filename)
+            signed_urls.set(cache_key, url)
+        return url, int((window + 1) * reuse_period - now)
+
+    def _generate_signed_url(self, filepath, expiry, filename=None):
+        signer = urls.get_cloudfront_signer()
+        if signer is not None and not filename:
+            with metrics.timer('presign'):
+                return urls.sign_url(
+                    signer,
+                    urls.build_url(self.settings.public_base_url, filepath),
+                    time.time() + expiry)
+
+        params = {'Bucket': self.bucket_name, 'Key': filepath}
+        if filename:
+            params['ResponseContentDisposition'] = \
+                'inline; filename="{0}"'.format(filename.replace('"', ''))
+            content_type = mimetypes.guess_type(filename, strict=False)[0]
+            if content_type:
+                params['ResponseContentType'] = content_type
+        with metrics.timer('presign'):
+            return self.get_s3_client().generate_presigned_url(
+                ClientMethod='get_object', Params=params, ExpiresIn=expiry)
+
+    def key_exists(self, filepath):
+        '''Return whether there is an object at `filepath`, with a HEAD
+        request.'''
+        try:
+            self.get_s3_client().head_object(Bucket=self.bucket_name,
+                                             Key=filepath)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey',
+                                               'NotFound'):
+                return False
+            raise
+
+    def get_hash_algorithm(self):
+        '''Return the digest computed for uploaded files, set with
+        `ckanext.s3filestore.hash_algorithm` (default sha256, "none" to
+        disable it).
+
+        Content addressed uploads always store their sha256 digest, which
+        their key is built from. With `ckanext.s3filestore.hash_metadata`
+        the digest is also set in the object metadata, hashing the local
+        file before it is uploaded.'''
+        return self.settings.hash_algorithm
+
+    def upload_to_key(self, filepath, upload_file, make_public=False,
+                      max_size=None, metadata=None):
+        '''Uploads the `upload_file` to `filepath` on `self.bucket`, as a
+        public-read object if `make_public` is set and a private one
+        otherwise, with the user `metadata` dict if given.
+
+        The file is streamed to S3, using a multipart upload for large files.
+        A failed multipart upload is aborted so no parts are left behind.
+        Returns the HashingReader the file was read through, with the size
+        and digest of the data sent.
+
+        Files over `max_size` bytes raise a ValidationError, before any
+        request if their size is known and otherwise as soon as the limit
+        is reached while streaming.
+        '''
+        _check_size(upload_file, max_size)
+        self.check_bucket()
+        self.dequeue_delete(filepath)
+        upload_file.seek(0)
+        reader = HashingReader(upload_file, self.get_hash_algorithm(),
+                               max_size)
+
+        extra_args = {'ACL': 'public-read' if make_public else 'private'}
+        if metadata:
+            extra_args['Metadata'] = metadata
+        mimetype = getattr(self, 'mimetype', None)
+        if mimetype:
+            extra_args['ContentType'] = mimetype
         try:
-            s3.Object(self.bucket_name, filepath).put(
-                Body=upload_file.read(), ACL='public-read',
-                ContentType=getattr(self, 'mimetype', None))
-            log.info("Succesfully uploaded {0} to S3!".format(filepath))
-        except Exception as e:
-            log.error('Something went very very wrong for {0}'.format(str(e)))
-            raise e
+            with metrics.timer('upload'):
+                self.get_s3_client().upload_fileobj(
+                    reader, self.bucket_name, filepath,
+                    ExtraArgs=extra_args, Config=self.get_transfer_config())
+        except FileTooLargeError as e:
+            log.warning('Not uploading {0} to S3: {1}'.format(filepath,
+                                                              str(e)))
+            metrics.incr('upload_too_large')
+            _raise_too_large()
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+                retry.CircuitOpenError) as e:
+            log.error('Could not upload {0} to S3: {1}'.format(filepath,
+                                                              str(e)))
+            raise
+        log.info("Succesfully uploaded {0} to S3!".format(filepath))
+        return reader
+
+    def copy_key(self, source_filepath, filepath, source_bucket_name=None,
+                 metadata=None, make_public=False):
+        '''Copies the key at `source_filepath` to `filepath` on
+        `self.bucket`, without the data leaving S3. The copy is public-read
+        if `make_public` is set and private otherwise.
+
+        Objects over the multipart threshold are copied in parts with
+        UploadPartCopy, which is required for objects over 5GB. The content
+        type and metadata of the source are kept, `metadata` is added to
+        the latter.
+        '''
+        self.check_bucket()
+        self.dequeue_delete(filepath)
+        client = self.get_s3_client()
+        source = {'Bucket': source_bucket_name or self.bucket_name,
+                  'Key': source_filepath}
+        # Multipart copies don't carry over the object metadata, so always
+        # set it explicitly
+        head = client.head_object(**source)
+        extra_args = {
+            'ACL': 'public-read' if make_public else 'private',
+            'MetadataDirective': 'REPLACE',
+            'Metadata': dict(head.get('Metadata') or {}, **(metadata or {})),
+        }
+        if head.get('ContentType'):
+            extra_args['ContentType'] = head['ContentType']
+        client.copy(source, self.bucket_name, filepath,
+                    ExtraArgs=extra_args, Config=self.get_transfer_config())
+        log.info("Succesfully copied {0} to {1}".format(source_filepath,
+                                                        filepath))
+
+    def dequeue_delete(self, filepath):
+        '''Take `filepath` out of the delete queue before it is written
+        again, so `paster s3 process-deletes` doesn't remove the new file.
+
+        Only the current session is changed, as with `clear_key`.
+        '''
+        if self.settings.deferred_delete or self.settings.content_addressed:
+            db.dequeue_delete(self.bucket_name, filepath)
 
     def clear_key(self, filepath):
-        '''Deletes the contents of the key at `filepath` on `self.bucket`.'''
-        session = boto3.session.Session(aws_access_key_id=self.p_key,
-                                    aws_secret_access_key=self.s_key,
-                                    region_name=self.region)
-        s3 = session.resource('s3', endpoint_url=self.host_name, config=botocore.client.Config(
-                             signature_version=self.signature))
+        '''Deletes the contents of the key at `filepath` on `self.bucket`.
+
+        If `ckanext.s3filestore.deferred_delete` is enabled the key is added
+        to the delete queue instead, and removed later by
+        `paster s3 process-deletes`.
+        '''
+        if self.settings.deferred_delete:
+            db.enqueue_delete(self.bucket_name, filepath)
+            return
         try:
-            s3.Object(self.bucket_name, filepath).delete()
-        except Exception as e:
-            raise e
+            self.get_s3_client().delete_object(Bucket=self.bucket_name,
+                                               Key=filepath)
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+                retry.CircuitOpenError) as e:
+            log.error('Could not delete {0} from S3: {1}'.format(filepath,
+                                                                str(e)))
+            raise
 
 
 class S3Uploader(BaseS3Uploader):
@@ -162,7 +492,7 @@ class S3Uploader(BaseS3Uploader):
 
     @classmethod
     def get_storage_path(cls, upload_to):
-        path = config.get('ckanext.s3filestore.aws_storage_path', '')
+        path = settings.get().aws_storage_path
         return os.path.join(path, 'storage', 'uploads', upload_to)
 
     def update_data_dict(self, data_dict, url_field, file_field, clear_field):
@@ -199,19 +529,21 @@ class S3Uploader(BaseS3Uploader):
             if self.clear and self.url == self.old_filename:
                 data_dict[url_field] = ''
 
-    def upload(self, max_size=2):
+    def upload(self, max_size=None):
         '''Actually upload the file.
 
         This should happen just before a commit but after the data has been
         validated and flushed to the db. This is so we do not store anything
         unless the request is actually good. max_size is size in MB maximum of
-        the file'''
+        the file, `ckan.max_image_size` if None'''
+        if max_size is None:
+            max_size = self.settings.max_image_size
 
         # If a filename has been provided (a file is being uploaded) write the
         # file to the appropriate key in the AWS bucket.
         if self.filename:
             self.upload_to_key(self.filepath, self.upload_file,
-                               make_public=True)
+                               make_public=True, max_size=max_size * MB)
             self.clear = True
 
         if (self.clear and self.old_filename
@@ -236,8 +568,8 @@ class S3ResourceUploader(BaseS3Uploader):
 
         super(S3ResourceUploader, self).__init__()
 
-        path = config.get('ckanext.s3filestore.aws_storage_path', '')
-        self.storage_path = os.path.join(path, 'resources')
+        self.storage_path = self.get_storage_path()
+        self.content_addressed = self.settings.content_addressed
         self.filename = None
         self.old_filename = None
 
@@ -265,6 +597,16 @@ class S3ResourceUploader(BaseS3Uploader):
             self.old_filename = old_resource.url
             resource['url_type'] = ''
 
+    @classmethod
+    def get_storage_path(cls):
+        path = settings.get().aws_storage_path
+        return os.path.join(path, 'resources')
+
+    @classmethod
+    def get_blob_storage_path(cls):
+        path = settings.get().aws_storage_path
+        return os.path.join(path, 'blobs')
+
     def get_path(self, id, filename):
         '''Return the key used for this resource in S3.
 
@@ -278,14 +620,60 @@ class S3ResourceUploader(BaseS3Uploader):
         filepath = os.path.join(directory, filename)
         return filepath
 
-    def upload(self, id, max_size=10):
-        '''Upload the file to S3.'''
+    def get_blob_path(self, digest):
+        '''Return the key of the content addressed file with the given
+        sha256 `digest`.
+
+        Keys are in the form:
+        <ckanext.s3filestore.aws_storage_path>/blobs/sha256/<digest[:2]>/<digest>
+        '''
+        return os.path.join(self.get_blob_storage_path(), BLOB_ALGORITHM,
+                            digest[:2], digest)
+
+    def get_file_path(self, id, filename):
+        '''Return the key the file of this resource is actually stored at,
+        which is its blob if it has one.
+
+        Resources uploaded while content addressed storage was enabled keep
+        pointing to their blob after it is turned off.
+        '''
+        blob_path = db.get_resource_blob(id)
+        if blob_path:
+            return blob_path
+        return self.get_path(id, filename)
+
+    def upload(self, id, max_size=None):
+        '''Upload the file to S3.
+
+        max_size is the maximum size of the file in MB,
+        `ckan.max_resource_size` if None.
+        '''
+        if max_size is None:
+            max_size = self.settings.max_resource_size
 
         # If a filename has been provided (a file is being uploaded) write the
         # file to the appropriate key in the AWS bucket.
         if self.filename:
-            filepath = self.get_path(id, self.filename)
-            self.upload_to_key(filepath, self.upload_file)
+            if self.content_addressed:
+                self.upload_blob(id, max_size * MB)
+            else:
+                # The resource may have been uploaded while content
+                # addressed storage was enabled
+                self.release_blob(id)
+                filepath = self.get_path(id, self.filename)
+                metadata = None
+                algorithm = self.get_hash_algorithm()
+                if algorithm and self.settings.hash_metadata:
+                    # The digest is sent with the upload, so the local file
+                    # is read once more to compute it first
+                    digest = self.hash_upload_file(
+                        algorithm, max_size * MB).hexdigest()
+                    metadata = {algorithm: digest}
+                reader = self.upload_to_key(filepath, self.upload_file,
+                                            make_public=self.is_public(id),
+                                            max_size=max_size * MB,
+                                            metadata=metadata)
+                self.update_size_and_hash(id, reader)
 
         # The resource form only sets self.clear (via the input clear_upload)
         # to True when an uploaded file is not replaced by another uploaded
@@ -293,5 +681,93 @@ class S3ResourceUploader(BaseS3Uploader):
         # replaced by a link, we should remove the previously uploaded file to
         # clean up the file system.
         if self.clear and self.old_filename:
-            filepath = self.get_path(id, self.old_filename)
-            self.clear_key(filepath)
+            if not self.release_blob(id):
+                filepath = self.get_path(id, self.old_filename)
+                self.clear_key(filepath)
+
+    def is_public(self, id):
+        '''Return whether the file of resource `id` should be public-read.
+
+        That is only the case with the `auto` download strategy, for
+        resources of public datasets that are not content addressed (blobs
+        can be shared with private datasets). Only reads the database.
+        '''
+        if self.get_download_strategy() != 'auto' or self.content_addressed:
+            return False
+        resource = model.Resource.get(id)
+        package = resource.package if resource else None
+        return package is not None and not package.private
+
+    def upload_blob(self, id, max_size=None):
+        '''Store the file under its sha256 digest and point the resource
+        to it.
+
+        The digest has to be known before uploading, so the local file is
+        read once to compute it. If an object with the same digest is
+        already stored, nothing is uploaded at all. Files over `max_size`
+        bytes raise a ValidationError.
+        '''
+        reader = self.hash_upload_file(BLOB_ALGORITHM, max_size)
+        filepath = self.get_blob_path(reader.hexdigest())
+        # Point to the blob first: that locks its row, so
+        # `paster s3 process-deletes` can't remove it once we know it exists
+        unused_filepath = db.set_resource_blob(id, filepath, reader.size)
+        if self.key_exists(filepath):
+            log.info('{0} is already stored as {1}'.format(self.filename,
+                                                          filepath))
+        else:
+            self.upload_to_key(filepath, self.upload_file)
+        self.update_size_and_hash(id, reader)
+        if unused_filepath:
+            self.queue_blob_delete(unused_filepath)
+
+    def hash_upload_file(self, algorithm, max_size=None):
+        '''Read the whole uploaded file, returning the HashingReader with
+        its size and `algorithm` digest. Files over `max_size` bytes raise
+        a ValidationError.'''
+        _check_size(self.upload_file, max_size)
+        self.upload_file.seek(0)
+        reader = HashingReader(self.upload_file, algorithm, max_size)
+        try:
+            while reader.read(MB):
+                pass
+        except FileTooLargeError:
+            metrics.incr('upload_too_large')
+            _raise_too_large()
+        return reader
+
+    def release_blob(self, id):
+        '''Remove the reference of the resource to its blob, queueing the
+        blob for deletion if no other resource uses it. Returns whether the
+        resource had a blob.'''
+        had_blob = db.get_resource_blob(id) is not None
+        unused_filepath = db.remove_resource_blob(id)
+        if unused_filepath:
+            self.queue_blob_delete(unused_filepath)
+        return had_blob
+
+    def queue_blob_delete(self, filepath):
+        '''Add a blob no resource uses any more to the delete queue.
+
+        Blobs are never deleted straight away, whatever
+        `ckanext.s3filestore.deferred_delete` is: the reference counts are
+        only saved when the request commits, and an identical file uploaded
+        in the meantime can point to the blob again.
+        `paster s3 process-deletes` skips the blobs that are in use when it
+        runs.
+        '''
+        db.enqueue_delete(self.bucket_name, filepath)
+
+    def update_size_and_hash(self, id, reader):
+        '''Store the size and digest of the uploaded file on the resource.
+
+        The resource has already been flushed when the file is uploaded, so
+        the values are set on the model object, and saved with the rest of
+        the resource when the action commits.
+        '''
+        resource = model.Session.query(model.Resource).get(id)
+        if resource is None:
+            return
+        resource.size = reader.size
+        if reader.hexdigest():
+            resource.hash = reader.hexdigest()
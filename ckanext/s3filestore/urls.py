@@ -0,0 +1,118 @@
+'''
+Urls of the stored files, built locally without any request to S3.
+
+Plain urls, used for public-read files, are:
+
+    <ckanext.s3filestore.public_base_url>/<key>
+        if a base url is set, e.g. a CDN in front of the bucket
+    <host_name>/<bucket>/<key>
+        with the default `ckanext.s3filestore.url_style = path`
+    <scheme>://<bucket>.<host>/<key>
+        with `ckanext.s3filestore.url_style = virtual`. This also makes
+        the clients use virtual-hosted style requests and presigned urls.
+
+If `ckanext.s3filestore.cloudfront_key_pair_id` and
+`ckanext.s3filestore.cloudfront_private_key` (the path of the PEM file
+of the key pair) are set, downloads that would be presigned get a url
+under `public_base_url` signed with a CloudFront canned policy instead,
+so private files are also served from the edge caches. Signing needs the
+`cryptography` package (`pip install ckanext-s3filestore[cloudfront]`).
+'''
+import urllib
+import datetime
+import threading
+import urlparse
+
+from botocore.signers import CloudFrontSigner
+
+from ckanext.s3filestore import settings
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    default_backend = None
+
+_signer = None
+_lock = threading.Lock()
+
+
+def quote_key(key):
+    '''Return `key` quoted for use in a url path.'''
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return urllib.quote(key)
+
+
+def get_base_url(endpoint_url, bucket_name, style='path'):
+    '''Return the url of the bucket at `endpoint_url`, in path or virtual
+    hosted style.'''
+    endpoint_url = endpoint_url.rstrip('/')
+    if style == 'virtual':
+        parts = urlparse.urlsplit(endpoint_url)
+        return urlparse.urlunsplit(
+            (parts.scheme, '{0}.{1}'.format(bucket_name, parts.netloc),
+             parts.path, '', ''))
+    return '{0}/{1}'.format(endpoint_url, bucket_name)
+
+
+def build_url(base_url, key):
+    return '{0}/{1}'.format(base_url.rstrip('/'), quote_key(key))
+
+
+class RSASigner(object):
+    '''Signs messages with SHA1 and the RSA private key in `pem`, as
+    CloudFront expects.'''
+
+    def __init__(self, pem):
+        if default_backend is None:
+            raise RuntimeError('Signing CloudFront urls needs the '
+                               'cryptography package')
+        self._key = serialization.load_pem_private_key(
+            pem, password=None, backend=default_backend())
+
+    def __call__(self, message):
+        return self._key.sign(message, padding.PKCS1v15(), hashes.SHA1())
+
+
+def create_signer(key_pair_id, pem):
+    '''Return a botocore CloudFrontSigner for the given key pair.'''
+    return CloudFrontSigner(key_pair_id, RSASigner(pem))
+
+
+def get_cloudfront_signer():
+    '''Return the configured CloudFrontSigner, or None if CloudFront signed
+    urls are not enabled.
+
+    The private key is read once, the first time it is needed.
+    '''
+    global _signer
+    s3_settings = settings.get()
+    if not s3_settings.cloudfront_key_pair_id:
+        return None
+    if _signer is None:
+        with _lock:
+            if _signer is None:
+                if not s3_settings.public_base_url:
+                    raise RuntimeError(
+                        'ckanext.s3filestore.public_base_url must be set '
+                        'to the CloudFront distribution url')
+                with open(s3_settings.cloudfront_private_key, 'rb') as f:
+                    _signer = create_signer(
+                        s3_settings.cloudfront_key_pair_id, f.read())
+    return _signer
+
+
+def sign_url(signer, url, expires_at):
+    '''Return `url` signed with a canned policy valid until the unix time
+    `expires_at`.'''
+    return signer.generate_presigned_url(
+        url, date_less_than=datetime.datetime.utcfromtimestamp(expires_at))
+
+
+def reset():
+    '''Forget the signer, so the key is read again.'''
+    global _signer
+    with _lock:
+        _signer = None